@@ -0,0 +1,227 @@
+import csv
+import sys
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from link import *
+from loops import program_transfer_loops
+from threaded import decode, execute
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# registers stay on the int64 fast path while their magnitude is below BOUND
+BOUND = 1 << 62
+# iterations of the lock-step loop between overflow checks; a register grows
+# by at most one `add` (far below 2**52) per iteration, so this can't
+# overflow before the check
+CHECK_EVERY = 1024
+
+def require_numpy():
+	if np is None:
+		raise Exception("the batch engine requires numpy (pip install numpy)")
+
+class BatchEmulator:
+	'''
+	Runs one program over many initial register vectors in lock-step.
+
+	Row i of `inputs` is the `registers` line of run i. All rows share one
+	register matrix `R` (rows x slots) and a pc vector; every iteration
+	fetches the instruction of each row, applies `inc`/`decjz` as masked
+	updates and retires rows as they reach HALT. Rows whose registers leave
+	the int64 range (or start outside it) continue on the scalar engine of
+	threaded.py from the state they reached.
+	'''
+	def __init__(self, program : Program, inputs : List[List[int]], accelerate=False):
+		require_numpy()
+		width = max([len(row) for row in inputs], default=0)
+		self.inputs = [list(row) + [0] * (width - len(row)) for row in inputs]
+		self.program = program
+		# slot layout shared by all rows, and the slots of the input registers
+		_, _, self.addrs = program.bind([0] * width)
+		self.input_slots = [self.addrs.index(addr) for addr in range(width)]
+		self.loops = program_transfer_loops(program, width) if accelerate else {}
+		self.regs : List[List[int]] = []
+		self.steps : List[int] = []
+
+	def run(self):
+		program = self.program
+		rows = len(self.inputs)
+		self.regs = [[0] * len(self.addrs) for _ in range(rows)]
+		self.steps = [0] * rows
+
+		fast = [i for i in range(rows) if all(-BOUND < v < BOUND for v in self.inputs[i])]
+		slow = [(i, 0, None) for i in sorted(set(range(rows)) - set(fast))]
+
+		if len(fast) > 0:
+			slow += self.run_vectorized(fast)
+		for i, pc, regs in slow:
+			self.run_scalar(i, pc, regs)
+
+	def run_vectorized(self, rows : List[int]) -> List[Tuple[int, int, List[int]]]:
+		'''
+		Run `rows` in lock-step. Return the `(row, pc, registers)` state of
+		the rows that overflowed.
+		'''
+		program = self.program
+		n = len(program)
+		ops = np.frombuffer(program.ops, dtype=np.int8).astype(np.int64)
+		slots = np.frombuffer(program.slots, dtype=np.dtype(f'i{program.slots.itemsize}')).astype(np.int64)
+		targets = np.frombuffer(program.targets, dtype=np.dtype(f'i{program.targets.itemsize}')).astype(np.int64)
+
+		ids = np.array(rows, dtype=np.int64)
+		R = np.zeros((len(rows), max(len(self.addrs), 1)), dtype=np.int64)
+		if len(self.input_slots) > 0:
+			R[:, self.input_slots] = np.array([self.inputs[i] for i in rows], dtype=np.int64)
+		pc = np.zeros(len(rows), dtype=np.int64)
+		steps = np.zeros(len(rows), dtype=np.int64)
+
+		# transfer loops, indexed by header pc
+		header = np.full(n + 1, -1, dtype=np.int64)
+		transfers = []
+		for h, loop in self.loops.items():
+			header[h] = len(transfers)
+			incs = [(program.slot_of(addr), k) for addr, k in loop.incs.items()]
+			transfers.append((h, program.slot_of(loop.counter), incs, loop))
+
+		overflowed = []
+		iteration = 0
+		while len(ids) > 0:
+			evict = np.zeros(len(ids), dtype=bool)
+			jumped = len(transfers) > 0 and self.apply_transfers(R, pc, steps, evict, header, transfers)
+
+			index = np.arange(len(ids))
+			op = ops[pc]
+			a = slots[pc]
+			value = R[index, a]
+
+			inc = op == OP_INC
+			dec = op == OP_DECJZ
+			add = op == OP_ADD
+			taken = dec & (value == 0)
+			running = op != OP_HALT
+
+			R[index, a] += inc.astype(np.int64) - (dec & ~taken).astype(np.int64) + np.where(add, targets[pc], 0)
+			pc = np.where(taken, targets[pc], np.where(running, pc + 1, pc))
+			steps += running
+
+			iteration += 1
+			if iteration % CHECK_EVERY == 0 or jumped or not running.all():
+				keep = running.copy()
+				big = (np.abs(R) >= BOUND).any(axis=1) | (steps >= BOUND) | evict
+				for j in np.nonzero(big & running)[0]:
+					overflowed.append((int(ids[j]), int(pc[j]), [int(v) for v in R[j]], int(steps[j])))
+				keep &= ~big
+				for j in np.nonzero(~running)[0]:
+					self.finish(int(ids[j]), [int(v) for v in R[j]], int(steps[j]))
+				if not keep.all():
+					ids, R, pc, steps = ids[keep], R[keep], pc[keep], steps[keep]
+
+		ret = []
+		for i, row_pc, regs, row_steps in overflowed:
+			self.steps[i] = row_steps
+			ret.append((i, row_pc, regs))
+		return ret
+
+	def apply_transfers(self, R, pc, steps, evict, header, transfers) -> bool:
+		'''
+		Execute the transfer loops that rows are about to enter in one step.
+		Rows for which a register the loop adds to, or the step count, would
+		reach BOUND are marked in `evict`, for the Python path.
+		Return whether any row was marked or entered a loop.
+		'''
+		at = header[pc]
+		if not (at >= 0).any():
+			return False
+		applied = False
+		for t in np.unique(at[at >= 0]):
+			h, counter, incs, loop = transfers[t]
+			total = max(sum(k for _, k in incs) + 1, loop.length)
+			entering = (at == t) & (R[:, counter] > 0)
+			# below BOUND // total, count * k can't overflow; other rows count
+			# as 0 here and are evicted anyway
+			fits = R[:, counter] < BOUND // total
+			count = np.where(fits, R[:, counter], 0)
+			for slot, k in incs:
+				fits &= R[:, slot] < BOUND - count * k
+			fits &= steps < BOUND - count * loop.length - 1
+			evict |= entering & ~fits
+			applied |= (entering & ~fits).any()
+			rows = np.nonzero(entering & fits)[0]
+			if len(rows) == 0:
+				continue
+			count = R[rows, counter]
+			for slot, k in incs:
+				R[rows, slot] += count * k
+			R[rows, counter] = 0
+			steps[rows] += count * loop.length + 1
+			pc[rows] = loop.exit
+			applied = True
+		return applied
+
+	def run_scalar(self, i : int, pc : int, regs : Optional[List[int]]):
+		program = self.program
+		if regs is None:
+			regs = [0] * len(self.addrs)
+			for slot, value in zip(self.input_slots, self.inputs[i]):
+				regs[slot] = value
+		code, transfers = decode(program, self.loops)
+		pc, steps = execute(code, regs, [True] * len(regs), pc, transfers=transfers)
+		self.finish(i, regs, self.steps[i] + steps)
+
+	def finish(self, i : int, regs : List[int], steps : int):
+		self.regs[i] = regs[:len(self.addrs)]
+		self.steps[i] = steps
+
+	def columns(self) -> List[int]:
+		'''
+		Register addresses of the result table: 0 up to the highest
+		non-negative register of the program.
+		'''
+		return list(range(max([addr + 1 for addr in self.addrs if addr >= 0], default=0)))
+
+	def table(self) -> List[List[int]]:
+		'''
+		One row per run: the columns() registers followed by the step count.
+		'''
+		slot = {addr: s for s, addr in enumerate(self.addrs)}
+		return [[regs[slot[addr]] if addr in slot else 0 for addr in self.columns()] + [steps]
+			for regs, steps in zip(self.regs, self.steps)]
+
+def load_inputs(path : str) -> List[List[int]]:
+	'''
+	Read initial register vectors from a .npy file or a CSV file with one
+	vector per line. Blank lines and lines starting with `#` are skipped.
+	'''
+	if path.endswith('.npy'):
+		require_numpy()
+		array = np.load(path, allow_pickle=False)
+		return [[int(v) for v in row] for row in np.atleast_2d(array)]
+
+	rows = []
+	with open(path, mode='r') as f:
+		for line in f:
+			line = line.strip()
+			if line == '' or line.startswith('#'):
+				continue
+			rows.append([int(v) for v in line.replace(',', ' ').split()])
+	return rows
+
+def save_table(path : Optional[str], columns : List[int], table : List[List[int]]):
+	'''
+	Write a result table as CSV (to stdout when `path` is None) or as .npy.
+	'''
+	if path is not None and path.endswith('.npy'):
+		require_numpy()
+		fits = all(-BOUND < v < BOUND for row in table for v in row)
+		np.save(path, np.array(table, dtype=np.int64 if fits else object), allow_pickle=not fits)
+		return
+
+	f = sys.stdout if path is None else open(path, mode='w', newline='')
+	writer = csv.writer(f)
+	writer.writerow([f"r{addr}" for addr in columns] + ["steps"])
+	writer.writerows(table)
+	if path is not None:
+		f.close()
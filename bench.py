@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""Benchmark suite for rmsim.
+
+Generates parameterized register machine workloads, times the lexer, the
+parser, pre-processing (parsing plus macro expansion), linking and every
+execution engine separately, and keeps the results in a JSON history file
+so a run can be compared with an earlier one. The `startup` workload times
+`rmsim --version` and a run of a tiny program in fresh interpreters and
+fails if they exceed a time budget or import what rmsim only loads lazily.
+
+    ./bench.py                      run every workload, append to the history
+    ./bench.py -w add -w mul        run some workloads
+    ./bench.py --compare            also compare with the previous entry
+    ./bench.py --compare LABEL      compare with the last entry labelled LABEL
+    ./bench.py -w startup --no-save check the startup time only (exit 1 if over budget)
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from frontend import Lexer, Parser, TokenKind
+from pre_process import parse_source
+from macro import expander
+from link import link
+from scan import scan_program
+from emulator import Emulator
+from threaded import ThreadedEmulator
+from compiled import CompiledEmulator, compiled_cache
+
+DEFAULT_HISTORY = 'bench-history.json'
+DEFAULT_THRESHOLD = 0.10
+# phases faster than this are too noisy to flag
+MIN_SECONDS = 0.001
+# a run of a tiny program, interpreter start included, may take this long
+STARTUP_BUDGET = 0.25
+# modules a plain run must not import, see the lazy imports of rmsim; pickle
+# is checked on a run without the program cache, which needs it for hits
+LAZY_MODULES = ('pytest', 'numpy', 'asyncio', 'multiprocessing', 'concurrent.futures', 'dataclasses',
+                'tracing', 'checkpoint', 'debugger', 'cmd', 'units', 'pickle', 'zlib')
+
+
+class Workload:
+    """A generated program: its source and the macro files it imports (name -> source)."""
+
+    def __init__(self, name: str, description: str, source: str, macros=None):
+        self.name = name
+        self.description = description
+        self.source = source
+        self.macros = macros or {}
+
+    def lines(self) -> int:
+        """Source lines, macro files included."""
+        return self.source.count('\n') + sum(source.count('\n') for source in self.macros.values())
+
+
+def add_workload(scale: int) -> Workload:
+    n = 100_000 * scale
+    return Workload('add', f"r0 += r1, r1 = {n}", f"""registers 0 {n}
+loop: decjz r1 HALT
+inc r0
+decjz r-1 loop
+""")
+
+
+def mul_workload(scale: int) -> Workload:
+    a, b = 100 * scale, 400
+    return Workload('mul', f"r0 = r1 * r2 = {a} * {b}", f"""registers 0 {a} {b} 0
+outer: decjz r1 HALT
+inner: decjz r2 restore
+inc r0
+inc r3
+decjz r-1 inner
+restore: decjz r3 outer
+inc r2
+decjz r-1 restore
+""")
+
+
+def square_workload(scale: int) -> Workload:
+    n = 200 * scale
+    return Workload('square', f"r0 = r1 * r1, r1 = {n}", f"""registers 0 {n} 0 0 0
+copy: decjz r1 outer
+inc r2
+inc r4
+decjz r-1 copy
+outer: decjz r4 HALT
+inner: decjz r2 restore
+inc r0
+inc r3
+decjz r-1 inner
+restore: decjz r3 outer
+inc r2
+decjz r-1 restore
+""")
+
+
+def pow_workload(scale: int) -> Workload:
+    base, exp = 3, 8 + scale
+    return Workload('pow', f"r0 = r1 ** r2 = {base} ** {exp}", f"""registers 1 {base} {exp} 0 0
+outer: decjz r2 HALT
+move: decjz r0 mul
+inc r3
+decjz r-1 move
+mul: decjz r3 outer
+add: decjz r1 restore
+inc r0
+inc r4
+decjz r-1 add
+restore: decjz r4 mul
+inc r1
+decjz r-1 restore
+""")
+
+
+def macro_workload(scale: int, directory: str) -> Workload:
+    depth = 13 + scale
+    macros = {'m0.m': "inc $0\n"}
+    for level in range(1, depth + 1):
+        path = os.path.join(directory, f"m{level - 1}.m")
+        macros[f"m{level}.m"] = f'import "{path}" as M\nM $0\nM $0\n'
+    top = os.path.join(directory, f"m{depth}.m")
+    return Workload('macro', f"{depth} nested macros, {2 ** depth} instructions after expansion",
+                    f'import "{top}" as TOP\nregisters 0\nTOP r0\n', macros)
+
+
+def straight_workload(scale: int) -> Workload:
+    n = 100_000 * scale
+    lines = ["registers 1 1 1 1"]
+    for i in range(n):
+        lines.append(f"inc r{i % 4}" if i % 2 == 0 else f"decjz r{i % 4} {i + 1}")
+    return Workload('straight', f"{n} lines of straight-line code", "\n".join(lines) + "\n")
+
+
+WORKLOADS = ['add', 'mul', 'square', 'pow', 'macro', 'straight', 'startup']
+
+
+def make_workloads(names, scale: int, directory: str):
+    makers = {
+        'add': add_workload,
+        'mul': mul_workload,
+        'square': square_workload,
+        'pow': pow_workload,
+        'macro': lambda scale: macro_workload(scale, directory),
+        'straight': straight_workload,
+    }
+    ret = []
+    for name in names:
+        workload = makers[name](scale)
+        for file, source in workload.macros.items():
+            with open(os.path.join(directory, file), mode='w') as f:
+                f.write(source)
+        ret.append(workload)
+    return ret
+
+
+def lex(source: str):
+    lexer = Lexer(io.StringIO(source))
+    while lexer.consume().kind != TokenKind.EOF:
+        pass
+
+
+def parse(source: str):
+    parser = Parser(Lexer(io.StringIO(source)))
+    parser.parse_imports()
+    parser.parse_input()
+
+
+def pre_process(source: str):
+    # macro files are parsed once per process; time the first expansion
+    expander.macros.clear()
+    return parse_source(io.StringIO(source))
+
+
+def run_engine(engine, program, accelerate: bool):
+    compiled_cache.clear()
+    if engine is Emulator:
+        e = Emulator(program.regs, dict(program.labels), program.instrs, accelerate)
+    else:
+        e = engine.from_program(program, accelerate)
+    with contextlib.redirect_stdout(io.StringIO()):
+        e.run()
+    return e.steps
+
+
+def measure(fn, repeat: int, memory: bool):
+    """
+    Best wall-clock time of `repeat` calls of `fn`, its result and, with
+    `memory`, the peak memory allocated by one more call (traced with
+    tracemalloc, which slows allocations down a lot).
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, result, peak
+
+
+def bench_workload(workload: Workload, repeat: int, memory: bool, log):
+    """Time every phase of `workload`. Return phase -> record."""
+    results = {}
+    lines = workload.lines()
+
+    def record(phase, seconds, peak, unit, amount):
+        results[phase] = {
+            'seconds': seconds,
+            'peak_bytes': peak,
+            unit: amount,
+            unit + '_per_sec': amount / seconds if seconds > 0 else None,
+        }
+        rate = results[phase][unit + '_per_sec']
+        rate = f"{rate:14,.0f} {unit}/s" if rate is not None else ""
+        peak = f"{peak / 1024:10,.0f} KiB" if peak is not None else ""
+        log(f"  {phase:<18} {seconds:10.4f} s {rate:>24} {peak:>14}")
+
+    for phase, fn in (('lex', lambda: lex(workload.source)),
+                      ('parse', lambda: parse(workload.source)),
+                      ('pre_process', lambda: pre_process(workload.source))):
+        seconds, result, peak = measure(fn, repeat, memory)
+        record(phase, seconds, peak, 'lines', lines)
+
+    # plain programs are linked straight from the source, see scan.py
+    seconds, program, peak = measure(lambda: scan_program(io.StringIO(workload.source)), repeat, memory)
+    if program is not None:
+        record('scan', seconds, peak, 'lines', lines)
+
+    (regs, labels, instrs), _ = pre_process(workload.source)
+    seconds, program, peak = measure(lambda: link(regs, dict(labels), instrs), repeat, memory)
+    record('link', seconds, peak, 'instructions', len(instrs))
+
+    # the engines run step by step, so the numbers are those of the dispatch
+    # loops; tracing their allocations would take ten times as long
+    for phase, engine, accelerate in (('classic', Emulator, False),
+                                      ('threaded', ThreadedEmulator, False),
+                                      ('compiled', CompiledEmulator, False),
+                                      ('threaded-accel', ThreadedEmulator, True)):
+        seconds, steps, _ = measure(lambda: run_engine(engine, program, accelerate), repeat, False)
+        record(phase, seconds, None, 'steps', steps)
+    return results
+
+
+def rmsim_command(*args: str, options=()):
+    """Command line of `rmsim args`, with the interpreter `options`."""
+    return [sys.executable, *options, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rmsim'), *args]
+
+
+def bench_startup(repeat: int, budget: float, directory: str, log):
+    """
+    Time `rmsim --version` and a run of a tiny program (from the program
+    cache) in fresh interpreters, best of `repeat` runs each. Return phase
+    -> record and the problems found: phases over `budget` seconds and
+    LAZY_MODULES a run of it without the program cache imports.
+    """
+    path = os.path.join(directory, 'tiny.r')
+    with open(path, mode='w') as f:
+        f.write("registers 0 2\nloop: decjz r1 HALT\ninc r0\ndecjz r-1 loop\n")
+    env = dict(os.environ, RMSIM_CACHE_DIR=os.path.join(directory, 'cache'))
+
+    results = {}
+    problems = []
+    for phase, arg in (('version', '--version'), ('run', path)):
+        # also fills the program cache
+        subprocess.run(rmsim_command(arg), env=env, stdout=subprocess.DEVNULL, check=True)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(rmsim_command(arg), env=env, stdout=subprocess.DEVNULL, check=True)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[phase] = {'seconds': best, 'peak_bytes': None, 'runs': 1, 'runs_per_sec': 1 / best}
+        log(f"  {phase:<18} {best:10.4f} s")
+        if best > budget:
+            problems.append(f"{phase} took {best * 1000:.0f} ms, over the budget of {budget * 1000:.0f} ms")
+
+    out = subprocess.run(rmsim_command('--no-cache', path, options=('-X', 'importtime')), env=env, capture_output=True, text=True, check=True)
+    modules = set(line.split('|')[-1].strip() for line in out.stderr.splitlines() if line.startswith('import time:'))
+    log(f"  {'modules':<18} {len(modules):10}")
+    for module in LAZY_MODULES:
+        if module in modules:
+            problems.append(f"a plain run imports {module}")
+    return results, problems
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def load_history(path: str):
+    if not os.path.exists(path):
+        return []
+    with open(path, mode='r') as f:
+        return json.load(f)
+
+
+def save_history(path: str, history):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, mode='w') as f:
+        json.dump(history, f, indent=1)
+        f.write('\n')
+    os.replace(tmp, path)
+
+
+def compare(base, entry, threshold: float, log) -> int:
+    """Print the time ratio of every phase of `entry` to `base`; return the number of regressions."""
+    log(f"\ncompared with {base.get('label') or base['commit'] or '?'} ({base['time']}), "
+        f"threshold {threshold:.0%}:")
+    regressions = 0
+    for name, phases in entry['results'].items():
+        for phase, result in phases.items():
+            before = base['results'].get(name, {}).get(phase)
+            if before is None or not before['seconds'] or not result['seconds']:
+                continue
+            ratio = result['seconds'] / before['seconds']
+            flag = ""
+            if ratio > 1 + threshold and result['seconds'] >= MIN_SECONDS:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif ratio < 1 - threshold and before['seconds'] >= MIN_SECONDS:
+                flag = "  faster"
+            log(f"  {name:<10} {phase:<18} {before['seconds']:10.4f} s -> {result['seconds']:10.4f} s "
+                f"{ratio:7.2f}x{flag}")
+    return regressions
+
+
+def find_base(history, label):
+    if label == '':
+        return history[-1] if history else None
+    for entry in reversed(history):
+        if entry.get('label') == label:
+            return entry
+    raise Exception(f"no history entry labelled '{label}'")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='benchmark the rmsim front end and engines')
+    arg_parser.add_argument("-w", "--workload", action='append', choices=WORKLOADS,
+                            help="workload to run, may be repeated (default: all)")
+    arg_parser.add_argument("--scale", type=int, default=1, help="size factor of the workloads (default: 1)")
+    arg_parser.add_argument("-r", "--repeat", type=int, default=3, help="timed runs per phase, the best counts")
+    arg_parser.add_argument("--no-memory", action='store_true', help="skip the peak memory measurement")
+    arg_parser.add_argument("--history", type=str, default=DEFAULT_HISTORY, metavar="FILE",
+                            help=f"JSON history file (default: {DEFAULT_HISTORY})")
+    arg_parser.add_argument("--no-save", action='store_true', help="don't append this run to the history")
+    arg_parser.add_argument("--label", type=str, default=None, help="label of this run in the history")
+    arg_parser.add_argument("--compare", type=str, nargs='?', const='', default=None, metavar="LABEL",
+                            help="compare with the last history entry labelled LABEL (default: the last entry); "
+                                 "exit with status 1 on a regression")
+    arg_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                            help=f"slowdown counted as a regression (default: {DEFAULT_THRESHOLD})")
+    arg_parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET, metavar="SECONDS",
+                            help="time a run of a tiny program may take in the startup workload; "
+                                 f"exit with status 1 beyond it (default: {STARTUP_BUDGET})")
+    args = arg_parser.parse_args()
+
+    def log(line):
+        print(line, flush=True)
+
+    history = load_history(args.history)
+    base = find_base(history, args.compare) if args.compare is not None else None
+
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'label': args.label,
+        'python': platform.python_version(),
+        'scale': args.scale,
+        'results': {},
+    }
+    names = args.workload or WORKLOADS
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        for workload in make_workloads([name for name in names if name != 'startup'], args.scale, directory):
+            log(f"{workload.name}: {workload.description}")
+            entry['results'][workload.name] = bench_workload(workload, args.repeat, not args.no_memory, log)
+        if 'startup' in names:
+            log("startup: rmsim --version and a tiny program in fresh interpreters")
+            entry['results']['startup'], problems = bench_startup(5 * args.repeat, args.startup_budget,
+                                                                  directory, log)
+
+    entry['max_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    log(f"\npeak resident set size {entry['max_rss_kib']:,} KiB")
+
+    if not args.no_save:
+        history.append(entry)
+        save_history(args.history, history)
+
+    failed = False
+    for problem in problems:
+        log(f"\nSTARTUP: {problem}")
+        failed = True
+    if args.compare is not None:
+        if base is None:
+            log("\nno earlier run to compare with")
+        elif compare(base, entry, args.threshold, log) > 0:
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
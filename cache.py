@@ -0,0 +1,143 @@
+import hashlib
+import os
+import re
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+# bump whenever the cached objects change shape
+CACHE_VERSION = 3
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+IMPORT_RE = re.compile(r'\s*import\s+"([^"]*)"')
+
+def default_cache_dir() -> str:
+	if 'RMSIM_CACHE_DIR' in os.environ:
+		return os.environ['RMSIM_CACHE_DIR']
+	base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+	return os.path.join(base, 'rmsim')
+
+def resolve_import(path : str) -> str:
+	# imports are relative to the working directory, as in pre_process
+	return path if os.path.isabs(path) else os.path.join(os.getcwd(), path)
+
+def imports_of(content : str) -> List[str]:
+	'''
+	The files imported by the `import "..." as ...` header of a program.
+	'''
+	ret = []
+	for line in content.splitlines():
+		stripped = line.strip()
+		if stripped == '' or stripped.startswith('#'):
+			continue
+		m = IMPORT_RE.match(line)
+		if m is None:
+			break
+		ret.append(resolve_import(m.group(1)))
+	return ret
+
+class ProgramCache:
+	'''
+	On-disk cache of loaded programs.
+
+	Entries are pickled into `directory`, keyed by a hash of the main file
+	and, transitively, of every file it imports (path and content), so any
+	edit invalidates them. Reading an entry refreshes its mtime; when the
+	directory grows beyond `max_bytes` the least recently used entries are
+	evicted.
+	'''
+	def __init__(self, directory : Optional[str] = None, max_bytes : Optional[int] = None):
+		self.directory = directory or default_cache_dir()
+		if max_bytes is None:
+			max_bytes = int(os.environ.get('RMSIM_CACHE_SIZE', DEFAULT_MAX_BYTES))
+		self.max_bytes = max_bytes
+
+	def key(self, path : str, variant : str = '') -> str:
+		h = hashlib.sha256(f"rmsim-cache-{CACHE_VERSION}\0{variant}\0".encode())
+		seen = set()
+		todo = [(os.path.abspath(path), True)]
+		while todo:
+			file, is_main = todo.pop()
+			if file in seen:
+				continue
+			seen.add(file)
+			with open(file, mode='rb') as f:
+				content = f.read()
+			# the main file is hashed by content only, so copies share an entry
+			h.update(b"main\0" if is_main else file.encode() + b"\0")
+			h.update(hashlib.sha256(content).digest())
+			todo += [(imported, False) for imported in reversed(imports_of(content.decode(errors='replace')))]
+		return h.hexdigest()
+
+	def entry_path(self, key : str) -> str:
+		return os.path.join(self.directory, key + '.pickle')
+
+	def get(self, key : str) -> Optional[Any]:
+		import pickle
+		path = self.entry_path(key)
+		try:
+			with open(path, mode='rb') as f:
+				value = pickle.load(f)
+			os.utime(path)
+			return value
+		except FileNotFoundError:
+			return None
+		except Exception:
+			# a truncated or stale entry: drop it and load from source
+			self.remove(path)
+			return None
+
+	def put(self, key : str, value : Any):
+		# imported on first use: runs that hit the cache never need it, and
+		# it takes longer to import than a small program takes to run
+		import pickle
+		import tempfile
+		os.makedirs(self.directory, exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+		try:
+			with os.fdopen(fd, mode='wb') as f:
+				pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp, self.entry_path(key))
+		except BaseException:
+			self.remove(tmp)
+			raise
+		self.evict()
+
+	def evict(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if not name.endswith('.pickle'):
+				continue
+			try:
+				st = os.stat(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				continue
+			entries.append((st.st_mtime, st.st_size, name))
+
+		total = sum(size for _, size, _ in entries)
+		for _, size, name in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			self.remove(os.path.join(self.directory, name))
+			total -= size
+
+	def remove(self, path : str):
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+	def load(self, path : str, loader, variant : str = ''):
+		'''
+		Return the cached `loader(path)`, calling it on a miss. Loaders that
+		build different things from one file use different `variant`s.
+		'''
+		key = self.key(path, variant)
+		value = self.get(key)
+		if value is None:
+			value = loader(path)
+			try:
+				self.put(key, value)
+			except OSError:
+				# an unwritable cache only costs speed
+				pass
+		return value
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import pickle
+import threading
+import zlib
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from defaults import CHECKPOINT_EVERY
+from link import Program
+
+# first line of every snapshot file; bump the number whenever the payload
+# changes shape
+MAGIC = b"rmsim-snapshot 1\n"
+
+def program_hash(program : Program) -> str:
+	'''
+	A hash of everything in a linked program that decides how it runs, so a
+	snapshot is never resumed against another program (an edited source,
+	another `registers` line or another optimization level).
+	'''
+	h = hashlib.sha256(MAGIC)
+	for part in (program.ops, program.slots, program.targets, program.addrs, program.init):
+		h.update(",".join(map(str, part)).encode())
+		h.update(b"\0")
+	h.update(str(program.spec_size).encode())
+	return h.hexdigest()
+
+class Snapshot:
+	'''
+	The state of a run: pc, step count and the touched registers by address,
+	for the program with hash `program`.
+	'''
+	def __init__(self, program : str, pc : int, steps : int, regs : Dict[int, int]):
+		self.program = program
+		self.pc = pc
+		self.steps = steps
+		self.regs = regs
+
+	def check(self, program : str):
+		if program != self.program:
+			raise Exception("snapshot was taken from another program (source, registers line or -O level changed)")
+
+def write_snapshot(path : str, snapshot : Snapshot):
+	'''
+	Write `snapshot` to `path` atomically: readers see the old or the new
+	file, never a partial one.
+	'''
+	payload = zlib.compress(pickle.dumps((snapshot.program, snapshot.pc, snapshot.steps, snapshot.regs),
+		protocol=pickle.HIGHEST_PROTOCOL))
+	import tempfile
+	directory = os.path.dirname(os.path.abspath(path))
+	fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path), suffix='.tmp')
+	try:
+		with os.fdopen(fd, mode='wb') as f:
+			f.write(MAGIC)
+			f.write(payload)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, path)
+	except BaseException:
+		try:
+			os.remove(tmp)
+		except FileNotFoundError:
+			pass
+		raise
+
+def read_snapshot(path : str) -> Snapshot:
+	with open(path, mode='rb') as f:
+		data = f.read()
+	if not data.startswith(MAGIC):
+		raise Exception(f"{path}: not an rmsim snapshot")
+	try:
+		program, pc, steps, regs = pickle.loads(zlib.decompress(data[len(MAGIC):]))
+	except Exception:
+		raise Exception(f"{path}: corrupt snapshot")
+	return Snapshot(program, pc, steps, regs)
+
+class Checkpointer:
+	'''
+	Writes a snapshot of a run to `path` every `every` steps.
+
+	The engines hand over a copy of their state with `submit` at sample
+	points and go on; a background thread writes it. If the writer falls
+	behind, only the newest pending state is written. `close` waits for the
+	last write.
+	'''
+	def __init__(self, path : str, program : str, every : int = CHECKPOINT_EVERY):
+		if every <= 0:
+			raise Exception("the checkpoint interval must be positive")
+		self.path = path
+		self.program = program
+		self.every = every
+		self.pending : Optional[Snapshot] = None
+		self.error : Optional[BaseException] = None
+		self.closed = False
+		self.cond = threading.Condition()
+		self.thread : Optional[threading.Thread] = None
+		self.written = 0
+
+	def submit(self, pc : int, steps : int, regs : Dict[int, int]):
+		''' Queue a snapshot of a state; `regs` must not change afterwards. '''
+		with self.cond:
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.writer, name='rmsim-checkpoint', daemon=True)
+				self.thread.start()
+			self.pending = Snapshot(self.program, pc, steps, regs)
+			self.cond.notify()
+
+	def save(self, pc : int, steps : int, regs : Dict[int, int]):
+		''' Write a snapshot of a state now, after the queued one. '''
+		self.close()
+		write_snapshot(self.path, Snapshot(self.program, pc, steps, regs))
+		self.written += 1
+
+	def writer(self):
+		while True:
+			with self.cond:
+				while self.pending is None and not self.closed:
+					self.cond.wait()
+				snapshot, self.pending = self.pending, None
+				if snapshot is None:
+					return
+			try:
+				write_snapshot(self.path, snapshot)
+				self.written += 1
+			except BaseException as e:
+				self.error = e
+
+	def close(self):
+		''' Wait for the queued snapshot to be written. '''
+		with self.cond:
+			self.closed = True
+			self.cond.notify()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		with self.cond:
+			self.closed = False
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise Exception(f"writing snapshot {self.path} failed: {error}")
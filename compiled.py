@@ -0,0 +1,212 @@
+import hashlib
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from link import *
+from loops import TransferLoop
+from threaded import LinkedEmulator
+from profiler import Profile
+
+# generated functions, keyed by the hash of their source
+compiled_cache : Dict[str, Any] = {}
+
+class Block:
+	'''
+	A basic block: the instructions `start` .. `end - 1` of a program. Only
+	the last instruction may be a `decjz`.
+	'''
+	def __init__(self, id : int, start : int, end : int):
+		self.id = id
+		self.start = start
+		self.end = end
+
+	def __len__(self):
+		return self.end - self.start
+
+def split_blocks(program : Program) -> List[Block]:
+	'''
+	Split a program at its labels, branch targets and after every `decjz`.
+	'''
+	n = len(program)
+	leaders = set([0])
+	for pc in range(n):
+		if program.ops[pc] == OP_DECJZ:
+			leaders.add(pc + 1)
+			leaders.add(program.targets[pc])
+	for pc in program.labels.values():
+		leaders.add(pc)
+	leaders = sorted(pc for pc in leaders if pc < n)
+
+	blocks = []
+	for i in range(len(leaders)):
+		end = leaders[i + 1] if i + 1 < len(leaders) else n
+		blocks.append(Block(i, leaders[i], end))
+	return blocks
+
+class CodeGen:
+	'''
+	Translate a `Program` into the source of a Python function
+
+		def run(s): -> (registers, visits)
+
+	Registers live in the locals `s0`, `s1`, ... (one per slot) and every
+	block in a branch of a binary dispatch tree over the block number `b`.
+	`v<b>` counts the visits of block b, which gives both the step count and
+	the registers that were touched. With `profile` the function also counts
+	in `t<b>` how often the `decjz` ending block b jumped, and returns
+	`(registers, visits, taken)`.
+	'''
+	def __init__(self, program : Program, loops : Dict[int, TransferLoop] = {}, profile=False):
+		self.program = program
+		self.loops = loops
+		self.profile = profile
+		self.blocks = split_blocks(program)
+		self.block_at = {block.start: block.id for block in self.blocks}
+		self.halt = len(self.blocks)
+		self.lines : List[str] = []
+
+	def block_of(self, pc : int) -> int:
+		return self.block_at[pc] if pc < len(self.program) else self.halt
+
+	def emit(self, depth : int, line : str):
+		self.lines.append('\t' * depth + line)
+
+	def generate(self) -> str:
+		slots = range(len(self.program.addrs))
+		self.emit(0, "def run(s):")
+		if len(slots) > 0:
+			self.emit(1, ''.join(f"s{slot}, " for slot in slots) + "= s")
+		self.emit(1, ''.join(f"v{block.id} = " for block in self.blocks) + "0")
+		if self.profile:
+			self.emit(1, ''.join(f"t{block.id} = " for block in self.blocks) + "0")
+		self.emit(1, "b = 0")
+		self.emit(1, "while True:")
+		self.gen_dispatch(2, 0, self.halt + 1)
+		ret = "return [" + ''.join(f"s{slot}, " for slot in slots) + "], [" + ''.join(f"v{block.id}, " for block in self.blocks) + "]"
+		if self.profile:
+			ret += ", [" + ''.join(f"t{block.id}, " for block in self.blocks) + "]"
+		self.emit(1, ret)
+		return '\n'.join(self.lines) + '\n'
+
+	def gen_dispatch(self, depth : int, lo : int, hi : int):
+		if hi - lo == 1:
+			if lo == self.halt:
+				self.emit(depth, "break")
+			else:
+				self.gen_block(depth, self.blocks[lo])
+			return
+		mid = (lo + hi) // 2
+		self.emit(depth, f"if b < {mid}:")
+		self.gen_dispatch(depth + 1, lo, mid)
+		self.emit(depth, "else:")
+		self.gen_dispatch(depth + 1, mid, hi)
+
+	def gen_block(self, depth : int, block : Block):
+		program = self.program
+		self.emit(depth, f"v{block.id} += 1")
+
+		if block.start in self.loops:
+			self.gen_transfer(depth, block, self.loops[block.start])
+			return
+
+		# inc and add instructions of a block commute, fold them per register
+		incs : Dict[int, int] = {}
+		pc = block.start
+		while pc < block.end and program.ops[pc] != OP_DECJZ:
+			if program.ops[pc] == OP_INC:
+				incs[program.slots[pc]] = incs.get(program.slots[pc], 0) + 1
+			elif program.ops[pc] == OP_ADD:
+				incs[program.slots[pc]] = incs.get(program.slots[pc], 0) + program.targets[pc]
+			pc += 1
+		for slot, k in incs.items():
+			self.emit(depth, f"s{slot} += {k}")
+
+		if pc < block.end:
+			self.gen_decjz(depth, block, pc)
+		else:
+			self.emit(depth, f"b = {self.block_of(block.end)}")
+
+	def gen_decjz(self, depth : int, block : Block, pc : int):
+		slot = self.program.slots[pc]
+		self.emit(depth, f"if s{slot}:")
+		self.emit(depth + 1, f"s{slot} -= 1")
+		self.emit(depth + 1, f"b = {self.block_of(pc + 1)}")
+		self.emit(depth, "else:")
+		if self.profile:
+			self.emit(depth + 1, f"t{block.id} += 1")
+		self.emit(depth + 1, f"b = {self.block_of(self.program.targets[pc])}")
+
+	def gen_transfer(self, depth : int, block : Block, loop : TransferLoop):
+		program = self.program
+		counter = program.slots[block.start]
+		self.emit(depth, f"if s{counter} > 0:")
+		self.emit(depth + 1, f"n = s{counter}")
+		self.emit(depth + 1, f"s{counter} = 0")
+		for addr, k in loop.incs.items():
+			self.emit(depth + 1, f"s{program.slot_of(addr)} += n * {k}")
+		for body in self.blocks:
+			if loop.header <= body.start < loop.header + loop.length:
+				self.emit(depth + 1, f"v{body.id} += n")
+				# the closing `decjz` jumps back n times, the header once
+				if self.profile and body.end == loop.header + loop.length:
+					self.emit(depth + 1, f"t{body.id} += n")
+		if self.profile:
+			self.emit(depth + 1, f"t{block.id} += 1")
+		self.emit(depth + 1, f"b = {self.block_of(loop.exit)}")
+		self.emit(depth, "else:")
+		self.gen_decjz(depth + 1, block, block.start)
+
+def compile_program(program : Program, loops : Dict[int, TransferLoop] = {}, profile=False):
+	'''
+	Generate, compile and cache the function running `program`.
+	'''
+	source = CodeGen(program, loops, profile).generate()
+	key = hashlib.sha1(source.encode()).hexdigest()
+	if not key in compiled_cache:
+		namespace = {}
+		exec(compile(source, f"<rmsim {key[:8]}>", 'exec'), namespace)
+		compiled_cache[key] = namespace['run']
+	return compiled_cache[key]
+
+class CompiledEmulator(LinkedEmulator):
+	'''
+	Runs a program as generated Python code.
+	'''
+	def run(self, trace=False):
+		if trace:
+			return self.run_trace(trace)
+		self.execute()
+		self.print_regs()
+
+	def profile(self) -> Profile:
+		'''
+		Run the program with execution counters and return them.
+		'''
+		blocks, visits, taken = self.execute(profile=True)
+		self.print_regs()
+		return Profile.from_blocks(self.program, blocks, visits, taken, self.steps, self.loops)
+
+	def execute(self, profile=False):
+		'''
+		Run the program and update `regs` and `steps`. Return the blocks,
+		their visit counts and, with `profile`, their taken counts.
+		'''
+		program = self.program
+		blocks = split_blocks(program)
+		regs, visits, *taken = compile_program(program, self.loops, profile)(list(program.init))
+
+		touched = [slot < program.spec_size for slot in range(len(regs))]
+		self.steps = 0
+		for block in blocks:
+			if visits[block.id] == 0:
+				continue
+			self.steps += visits[block.id] * len(block)
+			for pc in range(block.start, block.end):
+				if program.ops[pc] != OP_NOP:
+					touched[program.slots[pc]] = True
+
+		for slot in range(len(regs)):
+			if touched[slot]:
+				self.regs[program.addrs[slot]] = regs[slot]
+
+		return blocks, visits, taken[0] if profile else None
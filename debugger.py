@@ -0,0 +1,315 @@
+import bisect
+import cmd
+import sys
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from defaults import DEBUG_EVERY
+from instr import *
+from link import *
+from threaded import decode, execute
+
+class Checkpoint:
+	'''
+	The full state of a recorded run before step `step`: pc, register slots,
+	touched flags, and the position of the next bit in the branch bitstream.
+	'''
+	def __init__(self, step : int, pc : int, bit : int, values : List[int], touched : List[bool]):
+		self.step = step
+		self.pc = pc
+		self.bit = bit
+		self.values = values
+		self.touched = touched
+
+class Recording:
+	'''
+	A run recorded for time-travel debugging.
+
+	Instead of the state after every step, it keeps a full checkpoint every
+	`every` steps and one bit per executed `decjz` (1 if it jumped), so
+	memory is O(steps / every) register files plus steps / 8 bytes. The
+	state at any step is rebuilt by replaying from the nearest checkpoint;
+	the pc alone at any step follows from the bits without touching the
+	registers, which is what searching for a label back in time uses.
+	'''
+	def __init__(self, program : Program, every : int = DEBUG_EVERY):
+		if every <= 0:
+			raise Exception("the checkpoint interval must be positive")
+		self.program = program
+		self.every = every
+		self.checkpoints : List[Checkpoint] = []
+		self.starts : List[int] = []
+		self.bits = bytearray()
+		self.steps = 0
+		self.pc = 0
+		self.values, self.touched, self.addrs = program.bind(program.regs)
+
+	def record(self, limit : Optional[int] = None):
+		'''
+		Run the program from the `registers` line until it halts or after
+		`limit` steps, step by step.
+		'''
+		ops, slots, targets = self.program.ops, self.program.slots, self.program.targets
+		values, touched, bits = self.values, self.touched, self.bits
+		pc, step = 0, 0
+		byte, mask = 0, 1
+		while limit is None or step < limit:
+			self.checkpoints.append(Checkpoint(step, pc, len(bits) * 8 + mask.bit_length() - 1, list(values), list(touched)))
+			self.starts.append(step)
+			span = self.every if limit is None else min(self.every, limit - step)
+			for i in range(span):
+				op = ops[pc]
+				if op == OP_DECJZ:
+					a = slots[pc]
+					touched[a] = True
+					if values[a]:
+						values[a] -= 1
+						pc += 1
+					else:
+						byte |= mask
+						pc = targets[pc]
+					mask <<= 1
+					if mask == 256:
+						bits.append(byte)
+						byte, mask = 0, 1
+				elif op == OP_INC:
+					a = slots[pc]
+					touched[a] = True
+					values[a] += 1
+					pc += 1
+				elif op == OP_ADD:
+					a = slots[pc]
+					touched[a] = True
+					values[a] += targets[pc]
+					pc += 1
+				elif op == OP_NOP:
+					pc += 1
+				else:
+					step += i
+					break
+			else:
+				step += span
+				continue
+			break
+		if mask != 1:
+			bits.append(byte)
+		self.steps = step
+		self.pc = pc
+
+	def registers(self) -> Dict[int, int]:
+		''' The touched registers by address after the last step. '''
+		return {self.addrs[slot]: self.values[slot] for slot in range(len(self.values)) if self.touched[slot]}
+
+	@property
+	def halted(self) -> bool:
+		return self.pc >= len(self.program)
+
+	def nbytes(self) -> int:
+		''' Memory held by the checkpoints and the bitstream, roughly. '''
+		slots = len(self.values)
+		return len(self.bits) + len(self.checkpoints) * slots * 2 * 8
+
+	def checkpoint_before(self, step : int) -> Checkpoint:
+		return self.checkpoints[bisect.bisect_right(self.starts, step) - 1]
+
+	def state_at(self, step : int) -> Tuple[int, Dict[int, int]]:
+		'''
+		The pc and the touched registers by address before step `step`
+		(after the last step for `self.steps`).
+		'''
+		if not 0 <= step <= self.steps:
+			raise Exception(f"step {step} is outside the recording (0..{self.steps})")
+		checkpoint = self.checkpoint_before(step)
+		values, touched = list(checkpoint.values), list(checkpoint.touched)
+		code, _ = decode(self.program, touched=touched)
+		pc, _ = execute(code, values, touched, checkpoint.pc, step - checkpoint.step)
+		return pc, {self.addrs[slot]: values[slot] for slot in range(len(values)) if touched[slot]}
+
+	def pcs(self, checkpoint : Checkpoint, end : int):
+		'''
+		Yield `(step, pc)` from `checkpoint` up to step `end` (exclusive),
+		following the branch bits.
+		'''
+		ops, targets, bits = self.program.ops, self.program.targets, self.bits
+		pc, bit = checkpoint.pc, checkpoint.bit
+		for step in range(checkpoint.step, end):
+			yield step, pc
+			op = ops[pc]
+			if op == OP_DECJZ:
+				pc = targets[pc] if bits[bit >> 3] >> (bit & 7) & 1 else pc + 1
+				bit += 1
+			elif op == OP_HALT:
+				return
+			else:
+				pc += 1
+
+	def pc_at(self, step : int) -> int:
+		if step == self.steps:
+			return self.pc
+		for _, pc in self.pcs(self.checkpoint_before(step), step + 1):
+			pass
+		return pc
+
+	def find_back(self, step : int, targets : set) -> Optional[int]:
+		''' The last step before `step` at which pc is in `targets`. '''
+		index = bisect.bisect_right(self.starts, step - 1) - 1
+		while index >= 0:
+			found = None
+			checkpoint = self.checkpoints[index]
+			for at, pc in self.pcs(checkpoint, min(step, self.starts[index + 1] if index + 1 < len(self.starts) else step)):
+				if pc in targets:
+					found = at
+			if found is not None:
+				return found
+			index -= 1
+		return None
+
+	def find_forward(self, step : int, targets : set) -> Optional[int]:
+		''' The first step after `step` at which pc is in `targets`. '''
+		index = bisect.bisect_right(self.starts, step) - 1
+		while index < len(self.checkpoints):
+			end = self.starts[index + 1] if index + 1 < len(self.starts) else self.steps
+			for at, pc in self.pcs(self.checkpoints[index], end):
+				if at > step and pc in targets:
+					return at
+			index += 1
+		if self.steps > step and self.pc in targets:
+			return self.steps
+		return None
+
+def format_regs(regs : Dict[int, int]) -> str:
+	''' Registers the way `Emulator.print_regs` prints them. '''
+	return "registers " + " ".join(str(regs.get(addr, 0)) for addr in range(max(regs.keys(), default=-1) + 1))
+
+class Debugger(cmd.Cmd):
+	'''
+	Command loop over a `Recording`, positioned at one step of the run.
+	'''
+	prompt = "(rmsim) "
+
+	def __init__(self, recording : Recording, stdin=None, stdout=None):
+		super().__init__(stdin=stdin, stdout=stdout)
+		if stdin is not None:
+			self.use_rawinput = False
+		self.recording = recording
+		self.label_at = recording.program.label_at()
+		self.step = recording.steps
+
+	def preloop(self):
+		self.stdout.write("time-travel debugger, type help or ? to list commands\n")
+		self.show_where()
+
+	def emptyline(self):
+		pass
+
+	def default(self, line):
+		self.stdout.write(f"unknown command '{line}'\n")
+
+	def show_where(self):
+		program = self.recording.program
+		pc = self.recording.pc_at(self.step)
+		line = f"step {self.step}/{self.recording.steps}  pc {pc}"
+		if pc in self.label_at:
+			line += f"  {self.label_at[pc]}:"
+		line += f"  {program.disassemble(pc, self.label_at)}"
+		if pc < len(program):
+			line += f"  (line {program.lines[pc] + 1}"
+			line += f", macro {program.macros[pc]})" if program.macros[pc] is not None else ")"
+		self.stdout.write(line + "\n")
+
+	def count(self, arg : str) -> Optional[int]:
+		try:
+			return int(arg) if arg.strip() else 1
+		except ValueError:
+			self.stdout.write(f"not a number: '{arg}'\n")
+			return None
+
+	def locations(self, arg : str) -> Optional[set]:
+		''' The pcs of a label or a pc number. '''
+		arg = arg.strip()
+		labels = self.recording.program.labels
+		if arg in labels:
+			return {labels[arg]}
+		try:
+			return {int(arg)}
+		except ValueError:
+			self.stdout.write(f"no label '{arg}'\n")
+			return None
+
+	def move(self, step : int):
+		self.step = max(0, min(step, self.recording.steps))
+		self.show_where()
+
+	def do_step(self, arg):
+		'''step [N]: go N steps forward (default 1)'''
+		n = self.count(arg)
+		if n is not None:
+			self.move(self.step + n)
+
+	def do_back(self, arg):
+		'''back [N]: go N steps back (default 1)'''
+		n = self.count(arg)
+		if n is not None:
+			self.move(self.step - n)
+
+	def do_goto(self, arg):
+		'''goto STEP: go to the state before step STEP'''
+		try:
+			self.move(int(arg))
+		except ValueError:
+			self.stdout.write(f"not a number: '{arg}'\n")
+
+	def do_next(self, arg):
+		'''next LABEL|PC: run forward to the next time pc reaches LABEL or PC'''
+		targets = self.locations(arg)
+		if targets is None:
+			return
+		step = self.recording.find_forward(self.step, targets)
+		if step is None:
+			self.stdout.write(f"{arg.strip()} is not reached after step {self.step}\n")
+		else:
+			self.move(step)
+
+	def do_rewind(self, arg):
+		'''rewind LABEL|PC: run back to the last time pc was at LABEL or PC'''
+		targets = self.locations(arg)
+		if targets is None:
+			return
+		step = self.recording.find_back(self.step, targets)
+		if step is None:
+			self.stdout.write(f"{arg.strip()} is not reached before step {self.step}\n")
+		else:
+			self.move(step)
+
+	def do_regs(self, arg):
+		'''regs [STEP]: show the registers at the current step or at STEP'''
+		try:
+			step = int(arg) if arg.strip() else self.step
+			_, regs = self.recording.state_at(step)
+		except ValueError:
+			self.stdout.write(f"not a number: '{arg}'\n")
+			return
+		except Exception as e:
+			self.stdout.write(f"{e}\n")
+			return
+		self.stdout.write(format_regs(regs) + "\n")
+
+	def do_where(self, arg):
+		'''where: show the step, pc and instruction'''
+		self.show_where()
+
+	def do_info(self, arg):
+		'''info: show the size of the recording'''
+		r = self.recording
+		end = "halted" if r.halted else "stopped by --max-steps"
+		self.stdout.write(f"{r.steps} steps ({end}), {len(r.checkpoints)} checkpoints every {r.every} steps, "
+			f"{len(r.bits)} bytes of branch bits, about {r.nbytes()} bytes in all\n")
+
+	def do_quit(self, arg):
+		'''quit: leave the debugger'''
+		return True
+
+	do_s = do_step
+	do_b = do_back
+	do_r = do_regs
+	do_q = do_quit
+	do_EOF = do_quit
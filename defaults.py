@@ -0,0 +1,13 @@
+'''
+Defaults of options whose subsystems are only imported when the option is
+used, so the argument parser can show them without importing them.
+'''
+
+# steps between two snapshots of --checkpoint, see checkpoint.py
+CHECKPOINT_EVERY = 100_000_000
+
+# steps between two full-state checkpoints of a --debug recording, see debugger.py
+DEBUG_EVERY = 1 << 16
+
+# call summaries kept by --memo, see units.py
+MEMO_SIZE = 4096
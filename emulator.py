@@ -1,79 +1,152 @@
+import sys
 from instr import *
 from typing import Any, List, Union, Optional, Tuple, Dict
 from frontend import StrLnCol
+from loops import find_transfer_loops
+from watchdog import *
+from regfile import RegisterFile, write_regs
 
 class Emulator:
 	
-	def __init__(self, regs : List[int] , labels : Dict[str, int], instrs : List[Instr]):
-		self.regs = {}
+	def __init__(self, regs : List[int] , labels : Dict[str, int], instrs : List[Instr], accelerate=False):
+		self.regs = RegisterFile(regs)
+		self.steps = 0
 		self.labels = labels
 		self.instrs = instrs
 
-		for i in range(len(regs)):
-			self.regs[i] = regs[i]
-
 		self.labels['HALT'] = len(self.instrs) 
 
+		# transfer loops are executed in one step, see loops.py
+		self.loops = find_transfer_loops(regs, self.labels, self.instrs) if accelerate else {}
+
+		# a watchdog.Budget to run within; `status` and `pcs` tell how the
+		# last run ended
+		self.budget = None
+		self.status = HALTED
+		self.pcs = None
+
+		# a checkpoint.Checkpointer to hand snapshots to, and the
+		# checkpoint.Snapshot to resume from
+		self.checkpointer = None
+		self.start = None
+
+		# how `print_regs` writes the registers, see regfile.write_regs, and
+		# where to (None: stdout)
+		self.regs_format = 'text'
+		self.regs_out = None
+
 	def init_reg(self, addr):
-		if not addr in self.regs:
-			self.regs[addr] = 0
+		self.regs.load(addr)
 
 	def run(self, trace=False):
 		# print (self.regs)
 		# print(self.instrs)
 		# print(self.labels)
+
+		# `trace` is a tracing.Tracer, or True for the full text trace on stdout
+		if trace is True:
+			from tracing import TextTrace
+			trace = TextTrace(sys.stdout)
+		tracer = trace or None
 		
-		if trace == True:
-			print (f"pc 0 ", end='')
-			self.print_regs()
+		watchdog = Watchdog(self.budget) if self.budget is not None else None
+		limit = self.budget.steps if self.budget is not None else None
+		checkpointer = self.checkpointer
+		interval = min(CHECK_EVERY if watchdog is not None else sys.maxsize,
+			checkpointer.every if checkpointer is not None else sys.maxsize)
+		self.status = HALTED
 
 		pc = 0
+		if self.start is not None:
+			pc, self.steps, self.regs = self.start.pc, self.start.steps, RegisterFile(self.start.regs)
+		check_at = min(self.steps + interval, limit if limit is not None else sys.maxsize)
+		next_snapshot = self.steps + checkpointer.every if checkpointer is not None else sys.maxsize
+
+		if tracer is not None:
+			tracer.start(pc, self.regs)
+
+		regs = self.regs
 		while pc < len(self.instrs):
+			if self.steps >= check_at:
+				status = watchdog.check(pc, self.steps, list(self.regs.values())) if watchdog is not None else None
+				if status is not None:
+					self.status = status
+					self.pcs = self.pc_range(pc)
+					if checkpointer is not None:
+						checkpointer.save(pc, self.steps, dict(self.regs))
+					break
+				if self.steps >= next_snapshot:
+					checkpointer.submit(pc, self.steps, dict(self.regs))
+					next_snapshot = self.steps + checkpointer.every
+				check_at = min(self.steps + interval, limit if limit is not None else sys.maxsize)
 		
 			instr = self.instrs[pc]
 		
 			if instr.opcode == Opcode.INC:
 				data_addr = instr.params[0].value
-				self.init_reg(data_addr)
-				self.regs[data_addr] += 1
+				regs.add(data_addr, 1)
 				pc += 1
 
 			elif instr.opcode == Opcode.DECJZ:
 				# if R[i] = 0 then goto j , else subtract 1 from R i
 				
 				data_addr = instr.params[0].value
-				self.init_reg(data_addr)
+				value = regs.load(data_addr)
 				target_branch = instr.params[1].value
 
-				if self.regs[data_addr] == 0: # jump to target_branch
+				if value == 0: # jump to target_branch
 					pc = self.labels[target_branch] if type(target_branch) is StrLnCol else target_branch
+				elif tracer is None and pc in self.loops and value > 0 and \
+						(limit is None or self.steps + self.loops[pc].steps(value) <= limit):
+					pc = self.run_loop(self.loops[pc])
+					continue
 				else: # subtract 1
-					self.regs[data_addr] -= 1
+					regs.add(data_addr, -1)
 					pc += 1
 
 			elif instr.opcode == Opcode.NOP:
+				data_addr = None
+				pc += 1
+
+			elif instr.opcode == Opcode.ADD:
+				data_addr = instr.params[0].value
+				regs.add(data_addr, instr.params[1].value)
 				pc += 1
 
 			else:
 				raise Exception("Unsupported opcode")
 
-			if trace == True and pc < len(self.instrs):
-				print (f"pc {pc} ", end='')
-				self.print_regs()
+			self.steps += 1
+
+			if tracer is not None and pc < len(self.instrs):
+				tracer.step(pc, self.regs, data_addr)
 
+		if tracer is not None:
+			tracer.close()
 		self.print_regs()
 
+	def pc_range(self, pc):
+		""" The lowest and highest pc of the next steps from `pc`, see threaded.pc_range. """
+		# threaded.py imports this module
+		from link import link
+		from threaded import decode, pc_range
+		program = link([], dict(self.labels), self.instrs)
+		values = [0] * len(program.addrs)
+		for addr, value in self.regs.items():
+			if program.slot_of(addr) is not None:
+				values[program.slot_of(addr)] = value
+		code, transfers = decode(program, touched=[True] * len(values))
+		return pc_range(code, values, [True] * len(values), pc, transfers)
+
+	def run_loop(self, loop):
+		""" Apply the effect of a transfer loop entered with a positive counter. """
+		n = self.regs[loop.counter]
+		self.regs[loop.counter] = 0
+		for addr, k in loop.incs.items():
+			self.regs.add(addr, n * k)
+		self.init_reg(loop.zero)
+		self.steps += loop.steps(n)
+		return loop.exit
+
 	def print_regs(self):
-		print ("registers ", end='')
-		for addr in range(max(self.regs.keys()) + 1):
-			if not addr in self.regs:
-				print(0,end='')
-			else:
-				print(self.regs[addr],end='')
-			
-			# if this is  the last , do not print space
-			if addr != max(self.regs.keys()) :
-				print(" ",end='')
-				pass
-		print("")
-		pass
+		write_regs(self.regs_out or sys.stdout, self.regs, self.regs_format)
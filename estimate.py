@@ -0,0 +1,602 @@
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from link import *
+from loops import always_zero_registers
+
+class Poly:
+	'''
+	A polynomial with integer coefficients, used as an upper bound. `terms`
+	maps a monomial, a sorted tuple of variables (repeated for powers), to
+	its coefficient. Variables are `('in', addr)`, the value of register
+	`addr` on the `registers` line, and `('it', header, slot)`, the value
+	of a slot at the start of an iteration of the loop at `header`. All
+	variables are non-negative, so a bound with non-negative coefficients
+	only grows with them; only constants go negative (`x - 1` after a
+	`decjz`).
+	'''
+	def __init__(self, terms : Optional[Dict[Tuple, int]] = None):
+		self.terms = {m: c for m, c in (terms or {}).items() if c != 0}
+
+	@staticmethod
+	def const(k : int) -> 'Poly':
+		return Poly({(): k})
+
+	@staticmethod
+	def var(v : Tuple) -> 'Poly':
+		return Poly({(v,): 1})
+
+	def __add__(self, other : 'Poly') -> 'Poly':
+		terms = dict(self.terms)
+		for m, c in other.terms.items():
+			terms[m] = terms.get(m, 0) + c
+		return Poly(terms)
+
+	def __sub__(self, other : 'Poly') -> 'Poly':
+		return self + Poly({m: -c for m, c in other.terms.items()})
+
+	def __mul__(self, other : 'Poly') -> 'Poly':
+		terms : Dict[Tuple, int] = {}
+		for m1, c1 in self.terms.items():
+			for m2, c2 in other.terms.items():
+				m = tuple(sorted(m1 + m2))
+				terms[m] = terms.get(m, 0) + c1 * c2
+		return Poly(terms)
+
+	def __eq__(self, other) -> bool:
+		return isinstance(other, Poly) and self.terms == other.terms
+
+	def join(self, other : 'Poly') -> 'Poly':
+		''' A bound of both: the larger coefficient of every monomial. '''
+		if self.terms == other.terms:
+			return self
+		terms = {}
+		for m in set(self.terms) | set(other.terms):
+			terms[m] = max(self.terms.get(m, 0), other.terms.get(m, 0))
+		return Poly(terms)
+
+	def positive(self) -> 'Poly':
+		''' The bound without its negative terms, which is never negative. '''
+		return Poly({m: c for m, c in self.terms.items() if c > 0})
+
+	def constant(self) -> Optional[int]:
+		''' The value of a constant polynomial, None if it has variables. '''
+		if any(m != () for m in self.terms):
+			return None
+		return self.terms.get((), 0)
+
+	def variables(self) -> set:
+		return set(v for m in self.terms for v in m)
+
+	def degree(self) -> int:
+		return max([len(m) for m, c in self.terms.items() if c > 0], default=0)
+
+	def substitute(self, values : Dict[Tuple, Optional['Poly']]) -> Optional['Poly']:
+		'''
+		Replace the variables in `values` by their bounds; None if one of
+		them is unknown (None).
+		'''
+		ret = Poly()
+		for m, c in self.terms.items():
+			term = Poly.const(c)
+			for v in m:
+				if v in values:
+					if values[v] is None:
+						return None
+					term = term * values[v].positive()
+				else:
+					term = term * Poly.var(v)
+			ret = ret + term
+		return ret
+
+	def evaluate(self, values : Dict[Tuple, int]) -> int:
+		ret = 0
+		for m, c in self.terms.items():
+			for v in m:
+				c *= values.get(v, 0)
+			ret += c
+		return ret
+
+	def order(self) -> str:
+		''' The terms of the highest degree, as O(...). '''
+		d = self.degree()
+		if d == 0:
+			return "O(1)"
+		top = sorted(m for m, c in self.terms.items() if c > 0 and len(m) == d)
+		return "O(" + " + ".join(monomial_name(m) for m in top) + ")"
+
+	def __str__(self) -> str:
+		if len(self.terms) == 0:
+			return "0"
+		ret = ""
+		for m, c in sorted(self.terms.items(), key=lambda item: (-len(item[0]), item[0])):
+			sign = "-" if c < 0 else "+"
+			c = abs(c)
+			text = monomial_name(m) if m != () else str(c)
+			if m != () and c != 1:
+				text = f"{c}*{text}"
+			ret += f" {sign} {text}" if ret else ("-" + text if sign == "-" else text)
+		return ret
+
+	def __repr__(self) -> str:
+		return f"Poly({self})"
+
+def var_name(v : Tuple) -> str:
+	return f"r{v[1]}" if v[0] == 'in' else f"r{v[2]}@{v[1]}"
+
+def monomial_name(m : Tuple) -> str:
+	parts = []
+	for v in sorted(set(m)):
+		k = m.count(v)
+		parts.append(var_name(v) + (f"^{k}" if k > 1 else ""))
+	return "*".join(parts)
+
+# arithmetic on bounds that may be unknown (None)
+
+def plus(a : Optional[Poly], b : Optional[Poly]) -> Optional[Poly]:
+	return None if a is None or b is None else a + b
+
+def times(a : Optional[Poly], b : Optional[Poly]) -> Optional[Poly]:
+	return None if a is None or b is None else a.positive() * b.positive()
+
+def join(a : Optional[Poly], b : Optional[Poly]) -> Optional[Poly]:
+	if a is b:
+		return a
+	return None if a is None or b is None else a.join(b)
+
+class State:
+	'''
+	Bounds at a program point: of every register (None if unknown) and of
+	the steps taken to get there.
+	'''
+	def __init__(self, regs : Dict[int, Optional[Poly]], steps : Optional[Poly]):
+		self.regs = regs
+		self.steps = steps
+
+	def join(self, other : Optional['State']) -> 'State':
+		if other is None:
+			return self
+		return State({a: join(p, other.regs[a]) for a, p in self.regs.items()}, join(self.steps, other.steps))
+
+	def substitute(self, values : Dict[Tuple, Optional[Poly]]) -> 'State':
+		def sub(p):
+			return None if p is None else p.substitute(values)
+		return State({a: sub(p) for a, p in self.regs.items()}, sub(self.steps))
+
+class Loop:
+	'''
+	A natural loop: the pcs of `body`, all entered through `header`,
+	inside the loop `parent` (None at the top level). `writes` are the
+	registers its instructions change.
+	'''
+	def __init__(self, header : int, body : set):
+		self.header = header
+		self.body = body
+		self.parent : Optional[Loop] = None
+		self.children : List[Loop] = []
+		self.writes : set = set()
+		self.exits : set = set()
+		# the register counting its iterations down, if one was found
+		self.counter : Optional[int] = None
+
+class Estimate:
+	'''
+	What `Estimator` found: upper bounds of the steps of a run and of every
+	register over the whole run, as polynomials in the values of the
+	`registers` line (None where no bound was found), and the loops.
+	'''
+	def __init__(self, program : Program, steps : Optional[Poly], regs : Dict[int, Optional[Poly]],
+			loops : List[Loop], notes : List[str]):
+		self.program = program
+		self.steps = steps
+		self.regs = regs
+		self.loops = loops
+		self.notes = notes
+
+	def inputs(self, regs : List[int]) -> Dict[Tuple, int]:
+		return {('in', addr): value for addr, value in enumerate(regs)}
+
+	def steps_for(self, regs : List[int]) -> Optional[int]:
+		''' The step bound for the `registers` line `regs`, None if unknown. '''
+		return None if self.steps is None else max(0, self.steps.evaluate(self.inputs(regs)))
+
+	def report(self, f):
+		program = self.program
+		values = self.inputs(program.regs)
+		# registers that are 0 on the registers line are usually scratch
+		# registers; the bounds without them are the readable ones
+		zeros = {('in', addr): Poly() for addr, value in enumerate(program.regs) if value == 0}
+
+		def bound(p):
+			if p is None:
+				return "unknown"
+			return f"{str(p):<32} {p.order():<16} = {max(0, p.evaluate(values)):,}"
+
+		rows = [('steps', self.steps)] + [(f"r{addr}", self.regs[addr]) for addr in sorted(self.regs) if addr >= 0]
+		f.write("upper bounds in the values rN of the registers line, those that are 0 taken as 0 "
+			"(= the bound for the registers line):\n")
+		for name, p in rows:
+			f.write(f"  {name:<10} <= {bound(p.substitute(zeros) if p is not None else None)}\n")
+		general = [(name, p) for name, p in rows if p is not None and p.substitute(zeros) != p]
+		if general:
+			f.write("for any registers line:\n")
+		for name, p in general:
+			f.write(f"  {name:<10} <= {p}  {p.order()}\n")
+
+		if self.loops:
+			f.write("loops:\n")
+		for loop in self.loops:
+			depth, outer = 0, loop.parent
+			while outer is not None:
+				depth, outer = depth + 1, outer.parent
+			span = f"{min(loop.body)}..{max(loop.body)}"
+			counter = f"counts down r{program.addrs[loop.counter]}" if loop.counter is not None else "no counter found"
+			f.write(f"  {'  ' * depth}pc {span:<12} line {program.lines[loop.header] + 1:<6} {counter}\n")
+		for note in self.notes:
+			f.write(f"note: {note}\n")
+
+class Estimator:
+	'''
+	Static cost analysis of a linked program, without running it.
+
+	The control-flow graph is split into natural loops, analyzed from the
+	innermost out. One iteration of a loop is run abstractly from symbolic
+	register values (`('it', header, slot)`) to the back edges, which gives
+	the effect of an iteration as bounds in terms of its start. A register
+	that goes down by at least one every iteration bounds the number of
+	iterations by its value on entry. The other registers the loop changes
+	are bounded over all iterations if their new value only depends on
+	registers already bounded, or grow linearly if it is their old value
+	plus such a term; anything else (a register doubling every iteration,
+	say) is unknown. A `decjz` that jumps leaves its register at exactly
+	0, which is what keeps loops restoring a register they consumed
+	bounded. Steps and registers are bounded from above; the estimate
+	holds for any non-negative `registers` line.
+	'''
+	def __init__(self, program : Program):
+		self.program = program
+		self.notes : List[str] = []
+		n = len(program)
+		ops, slots, targets = program.ops, program.slots, program.targets
+		code = [(ops[pc], slots[pc], targets[pc]) for pc in range(n)]
+		# a decjz on a register that is zero throughout is a jump
+		self.zeros = zeros = always_zero_registers(code, lambda slot: program.addrs[slot] >= 0 and program.addrs[slot] < program.spec_size)
+		self.succs : List[List[int]] = []
+		for pc in range(n):
+			if ops[pc] != OP_DECJZ:
+				self.succs.append([pc + 1])
+			elif slots[pc] in zeros or targets[pc] == pc + 1:
+				self.succs.append([targets[pc]])
+			else:
+				self.succs.append([pc + 1, targets[pc]])
+		self.succs.append([])
+		self.loops : List[Loop] = []
+		# innermost loop of every pc
+		self.owner : List[Optional[Loop]] = [None] * (n + 1)
+		self.find_loops()
+
+	def find_loops(self):
+		'''
+		Find the natural loops and their nesting. Sets `irreducible` if a
+		cycle can be entered other than through one header.
+		'''
+		succs = self.succs
+		order, rpo = self.dfs(0)
+		self.reachable = set(order)
+		idom = self.dominators(order, rpo)
+
+		def dominates(a, b):
+			while b != a and idom[b] != b:
+				b = idom[b]
+			return a == b
+
+		self.irreducible = False
+		back : Dict[int, List[int]] = {}
+		for u, v in self.retreating:
+			if dominates(v, u):
+				back.setdefault(v, []).append(u)
+			else:
+				self.irreducible = True
+		if self.irreducible:
+			return
+
+		preds : Dict[int, List[int]] = {}
+		for u in self.reachable:
+			for v in succs[u]:
+				preds.setdefault(v, []).append(u)
+		for header, sources in back.items():
+			body = set([header])
+			stack = [u for u in sources if u != header]
+			while stack:
+				u = stack.pop()
+				if u in body:
+					continue
+				body.add(u)
+				stack.extend(preds.get(u, []))
+			self.loops.append(Loop(header, body))
+
+		self.loops.sort(key=lambda loop: len(loop.body))
+		for i, loop in enumerate(self.loops):
+			for outer in self.loops[i + 1:]:
+				if loop.header in outer.body:
+					loop.parent = outer
+					outer.children.append(loop)
+					break
+		for loop in reversed(self.loops):
+			for pc in loop.body:
+				self.owner[pc] = loop
+		ops, slots, targets = self.program.ops, self.program.slots, self.program.targets
+		for loop in self.loops:
+			loop.writes = set(slots[pc] for pc in loop.body if ops[pc] != OP_NOP and not slots[pc] in self.zeros)
+			loop.exits = set(v for u in loop.body for v in succs[u] if not v in loop.body)
+		self.loops.sort(key=lambda loop: loop.header)
+
+	def dfs(self, start : int) -> Tuple[List[int], List[int]]:
+		'''
+		Depth-first search over the graph from `start`: the pcs in preorder
+		and in reverse postorder. Sets `retreating`, the edges to a pc on
+		the search stack.
+		'''
+		succs = self.succs
+		order, post = [start], []
+		seen = set([start])
+		on_stack = set([start])
+		self.retreating = []
+		stack = [(start, 0)]
+		while stack:
+			u, i = stack[-1]
+			if i < len(succs[u]):
+				stack[-1] = (u, i + 1)
+				v = succs[u][i]
+				if v in on_stack:
+					self.retreating.append((u, v))
+				elif not v in seen:
+					seen.add(v)
+					on_stack.add(v)
+					order.append(v)
+					stack.append((v, 0))
+			else:
+				stack.pop()
+				on_stack.discard(u)
+				post.append(u)
+		return order, post[::-1]
+
+	def dominators(self, order : List[int], rpo : List[int]) -> Dict[int, int]:
+		''' Immediate dominators (Cooper, Harvey and Kennedy). '''
+		index = {u: i for i, u in enumerate(rpo)}
+		preds : Dict[int, List[int]] = {}
+		for u in order:
+			for v in self.succs[u]:
+				preds.setdefault(v, []).append(u)
+		start = rpo[0]
+		idom = {start: start}
+
+		def intersect(a, b):
+			while a != b:
+				while index[a] > index[b]:
+					a = idom[a]
+				while index[b] > index[a]:
+					b = idom[b]
+			return a
+
+		changed = True
+		while changed:
+			changed = False
+			for u in rpo[1:]:
+				new = None
+				for p in preds.get(u, []):
+					if p in idom:
+						new = p if new is None else intersect(p, new)
+				if idom.get(u) != new:
+					idom[u] = new
+					changed = True
+		return idom
+
+	def node_of(self, pc : int, region : Optional[Loop]) -> Optional[int]:
+		'''
+		The node of the graph of `region` that `pc` belongs to: itself, the
+		header of the child loop it is in, or None outside the region (HALT
+		is outside every region).
+		'''
+		if pc >= len(self.program):
+			return None
+		loop = self.owner[pc]
+		if loop is region:
+			return pc
+		while loop is not None and loop.parent is not region:
+			loop = loop.parent
+		if loop is None:
+			return None if region is not None else pc
+		return loop.header
+
+	def estimate(self) -> Estimate:
+		program = self.program
+		n = len(program)
+		if self.irreducible:
+			self.notes.append("a loop can be entered other than through its first instruction, no bound found")
+			return Estimate(program, None, {addr: None for addr in program.addrs}, self.loops, self.notes)
+		regs = {slot: Poly.var(('in', program.addrs[slot])) if slot < program.spec_size else Poly()
+			for slot in range(len(program.addrs))}
+		_, exits, peak = self.region(None, self.node_of(0, None), State(regs, Poly()))
+		halted = exits.get(n)
+		if halted is None:
+			self.notes.append("HALT is never reached")
+		steps = halted.steps if halted is not None else None
+		for loop in self.loops:
+			if loop.counter is None and loop.header in self.reachable:
+				self.notes.append(f"no register counts down every iteration of the loop at pc {loop.header} "
+					f"(line {program.lines[loop.header] + 1})")
+		return Estimate(program, steps, {program.addrs[slot]: p for slot, p in peak.items()}, self.loops, self.notes)
+
+	def child_at(self, pc : int, loop : Optional[Loop]) -> Optional[Loop]:
+		''' The child loop of `loop` with header `pc`, if any. '''
+		child = self.owner[pc]
+		return child if child is not None and child is not loop and child.header == pc else None
+
+	def region(self, loop : Optional[Loop], entry : int, state : State) \
+			-> Tuple[Optional[State], Dict[int, State], Dict[int, Optional[Poly]]]:
+		'''
+		Run `state` abstractly through the pcs of `loop` (the whole program
+		if None) from `entry`, child loops as single nodes. Return the state
+		flowing back to the header, the states leaving the region by target
+		and the bounds of the registers anywhere in the region.
+		'''
+		program = self.program
+		ops, slots, targets = program.ops, program.slots, program.targets
+		header = loop.header if loop is not None else None
+
+		def successors(u):
+			child = self.child_at(u, loop)
+			outs = child.exits if child is not None else self.succs[u]
+			for v in outs:
+				node = self.node_of(v, loop)
+				if node is not None and node != header:
+					yield node
+
+		# topological order of the nodes reachable from `entry`
+		order, post, seen = [], [], set([entry])
+		stack = [(entry, iter(list(successors(entry))))]
+		while stack:
+			u, it = stack[-1]
+			v = next(it, None)
+			if v is None:
+				stack.pop()
+				post.append(u)
+			elif not v in seen:
+				seen.add(v)
+				stack.append((v, iter(list(successors(v)))))
+		order = post[::-1]
+
+		incoming : Dict[int, State] = {entry: state}
+		back : Optional[State] = None
+		exits : Dict[int, State] = {}
+		peak = dict(state.regs)
+
+		def send(target, s):
+			nonlocal back
+			for slot, p in s.regs.items():
+				peak[slot] = join(peak[slot], p)
+			node = self.node_of(target, loop)
+			if node is None:
+				exits[target] = s.join(exits.get(target))
+			elif node == header:
+				back = s.join(back)
+			else:
+				incoming[node] = s.join(incoming.get(node))
+
+		for u in order:
+			s = incoming.pop(u, None)
+			if s is None:
+				continue
+			child = self.child_at(u, loop)
+			if child is not None:
+				outs, inside = self.run_loop(child, s)
+				for slot, p in inside.items():
+					peak[slot] = join(peak[slot], p)
+				for target, out in outs.items():
+					send(target, out)
+				continue
+			op, a = ops[u], slots[u]
+			steps = plus(s.steps, Poly.const(1))
+			if op == OP_INC or op == OP_ADD:
+				regs = dict(s.regs)
+				regs[a] = plus(regs[a], Poly.const(1 if op == OP_INC else targets[u]))
+				send(u + 1, State(regs, steps))
+			elif op == OP_DECJZ:
+				zero = dict(s.regs)
+				zero[a] = Poly()
+				send(targets[u], State(zero, steps))
+				value = s.regs[a]
+				if value is None or value.constant() is None or value.constant() > 0:
+					regs = dict(s.regs)
+					regs[a] = plus(value, Poly.const(-1))
+					send(u + 1, State(regs, steps))
+			elif op == OP_NOP:
+				send(u + 1, State(s.regs, steps))
+		return back, exits, peak
+
+	def run_loop(self, loop : Loop, entry : State) -> Tuple[Dict[int, State], Dict[int, Optional[Poly]]]:
+		'''
+		The states leaving `loop` by target, entered in state `entry`, and
+		the bounds of the registers anywhere in the loop.
+		'''
+		iteration = {slot: ('it', loop.header, slot) for slot in loop.writes}
+		regs = {slot: Poly.var(iteration[slot]) if slot in iteration else p for slot, p in entry.regs.items()}
+		back, exits, inside = self.region(loop, loop.header, State(regs, Poly()))
+
+		# bounds of the written registers at the start of the first
+		# iteration, of the later ones and of every one; `count` bounds the
+		# iterations before the last one
+		first = {v: entry.regs[slot] for slot, v in iteration.items()}
+		later = dict(first)
+		bounds = dict(first)
+		count : Optional[Poly] = Poly()
+		before = entry.steps
+		if back is not None:
+			count = None
+			for slot in sorted(loop.writes):
+				change = back.regs[slot]
+				if change is None:
+					continue
+				change = change - Poly.var(iteration[slot])
+				if change.constant() is not None and change.constant() < 0 and entry.regs[slot] is not None:
+					if count is None or entry.regs[slot].degree() < count.degree():
+						count = entry.regs[slot]
+						loop.counter = slot
+			pending = set(loop.writes)
+			progress = True
+			while progress:
+				progress = False
+				for slot in sorted(pending):
+					v, new = iteration[slot], back.regs[slot]
+					if new is None:
+						continue
+					done = set(s for s in loop.writes if not s in pending)
+					if self.depends(loop, new) <= done:
+						# set from bounded registers
+						later[v] = new.substitute(bounds)
+						bounds[v] = join(entry.regs[slot], later[v])
+					else:
+						# the old value plus an amount set from bounded registers
+						change = new - Poly.var(v)
+						depends = self.depends(loop, change)
+						if count is None or slot in depends or not depends <= done:
+							continue
+						change = change.positive()
+						bounds[v] = plus(entry.regs[slot], self.total(count, change.substitute(first), change.substitute(later)))
+						later[v] = bounds[v]
+					pending.remove(slot)
+					progress = True
+			for slot in pending:
+				bounds[iteration[slot]] = later[iteration[slot]] = None
+			if pending:
+				names = ", ".join(f"r{self.program.addrs[slot]}" for slot in sorted(pending, key=lambda slot: self.program.addrs[slot]))
+				self.notes.append(f"no polynomial bound of {names} in the loop at pc {loop.header} "
+					f"(line {self.program.lines[loop.header] + 1}); it may grow exponentially")
+			if back.steps is None:
+				before = None
+			else:
+				before = plus(before, self.total(count, back.steps.substitute(first), back.steps.substitute(later)))
+
+		outs = {}
+		for target, s in exits.items():
+			s = s.substitute(bounds)
+			outs[target] = State(s.regs, plus(before, s.steps))
+		return outs, State(inside, None).substitute(bounds).regs
+
+	def total(self, count : Optional[Poly], first : Optional[Poly], later : Optional[Poly]) -> Optional[Poly]:
+		'''
+		A bound of the sum of at most `count` amounts, the first one at most
+		`first` and the others at most `later`: `first + (count - 1) * later`
+		for a positive count, without going below 0 for none.
+		'''
+		if first is None or later is None:
+			return None
+		return plus(times(count, later), (first - later).positive())
+
+	def depends(self, loop : Loop, p : Poly) -> set:
+		''' The registers `p` depends on at the start of an iteration of `loop`. '''
+		return set(v[2] for v in p.variables() if v[0] == 'it' and v[1] == loop.header)
+
+def estimate(program : Program) -> Estimate:
+	''' `Estimator(program).estimate()` '''
+	return Estimator(program).estimate()
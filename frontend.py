@@ -3,9 +3,10 @@ from errmsg import *
 from instr import *
 from io import TextIOBase
 from enum import Enum, auto
-from dataclasses import dataclass
-import io
-from typing import Any, List, Union, Optional, Tuple, Dict
+from collections import deque
+import os
+import re
+from typing import Any, List, Union, Optional, Tuple, Dict, Deque
 
 NOT_FOUND="token of kind {expected} not found."
 
@@ -36,18 +37,26 @@ class TokenKind(Enum):
     PARAM = auto()
     DIRECTORY = auto()
 
-@dataclass
 class Token:
-    kind: TokenKind
-    value: Any = None
-    line : int = -1
-    col : int = -1
-    length : int = 0
-
     '''
     line and column of the starting character
     index starts from 0
-    '''    
+    '''
+    # a plain class rather than a dataclass: importing dataclasses costs
+    # more than lexing a short program
+    def __init__(self, kind: TokenKind, value: Any = None, line: int = -1, col: int = -1, length: int = 0):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.col = col
+        self.length = length
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.kind, self.value, self.line, self.col, self.length) == \
+            (other.kind, other.value, other.line, other.col, other.length)
+
     def __repr__(self) -> str:
         return self.kind.name + (
             (":" + str(self.value)) if self.value is not None else "")
@@ -65,231 +74,180 @@ class StrLnCol(str):
     def __add__(self, other):
         obj = StrLnCol(str(self) + str(other), self.line, self.col)
         return obj    
+    def __reduce__(self):
+        return (StrLnCol, (str(self), self.line, self.col))
         
-class Scanner:
-    line : int = 0
-    col : int = 0
+# One token (or run of blanks) of a physical line. Line breaks are handled
+# by Tokenizer.tokenize_line, everything else by this pattern.
+TOKEN_RE = re.compile(r'''
+      (?P<blank>[^\S\r\n]+)
+    | (?P<comment>\#[^\r\n]*)
+    | (?P<colon>:)
+    | (?P<register>r-?\d+(?![\w/-]))
+    | (?P<param>\$\d+(?![\w/-]))
+    | (?P<name>(?:[^\W\d]|\$)[\w/-]*)
+    | (?P<integer>[-\d]\d*)
+    | (?P<directory>"[^"\r\n]*")
+    | (?P<linebreak>\r)
+''', re.VERBOSE)
+
+KEYWORDS = {
+    'nop': (TokenKind.NOP, 3),
+    'registers': (TokenKind.REGISTERS_SYMBOL, 9),
+    'import': (TokenKind.IMPORT, 6),
+    'as': (TokenKind.AS, 2),
+    'decjz': (TokenKind.DECJZ, 9),
+    'inc': (TokenKind.INC, 4),
+}
 
-    file_content_by_line = []
+class Tokenizer:
 
     def __init__(self, stream: TextIOBase):
-        """ Create a new scanner.
-
-        The scanner's input is a stream derived from a string or a file.
+        """ Create a new tokenizer.
 
-        # Lexing a string
-        s = io.StringIO("1 + 2")
-        Scanner(s)
-
-        # Lexing a file
-        s = open("file.choc")
-        Scanner(s)
+        The input is a stream derived from a string or a file. It is read one
+        line at a time; every line is split into tokens with TOKEN_RE, and
+        a NEWLINE token ends each line that produced at least one token.
+        Lines are not kept: error messages read theirs again from the
+        stream, so only unseekable streams (pipes, terminals) keep a copy.
 
         :param stream: The stream of characters to be lexed.
         """
-
-        self.file_content_by_line = stream.readlines()
-        self.stream = io.StringIO(''.join(self.file_content_by_line))
-        self.buffer: Optional[StrLnCol] = None  # A buffer of one character.
-
-    def peek(self) -> StrLnCol:
-        """ Return the next character from input without consuming it.
-        :return: The next character in the input stream or None at the end of the stream.
-        """
-        # A buffer of one character is used to store the last scanned character.
-        # If the buffer is empty, it is filled with the next character from the input.
-        if not self.buffer:
-            self.buffer = self.consume()
-        return self.buffer
-
-    def consume(self) -> StrLnCol:
-        """ Consume and return the next character from input.
-        :return: The next character in the input stream or None at the end of the stream.
-        """
-        # If the buffer is full, we empty the buffer and return the character it contains.
-        if self.buffer:
-            c = self.buffer
-            self.buffer = None
-            return c
-
-        c = self.stream.read(1)
-        line_ret = self.line
-        col_ret = self.col
-        
-        # update value 
-        if (c == '\n'): 
-            self.line += 1
-            self.col = 0
-        else: 
-            self.col += 1
-
-        return StrLnCol(c, line_ret, col_ret)
-
-class Tokenizer:
-
-    def __init__(self, scanner: Scanner):
-        self.scanner = scanner
-        self.buffer: List[Token] = []  
-        self.is_new_line = True
+        self.stream = stream
+        self.origin = stream.tell() if stream.seekable() else None
+        self.lines_read = 0
+        self.last_line = ''
+        self.kept_lines: Optional[List[str]] = [] if self.origin is None else None
+        self.buffer: Deque[Token] = deque()
         self.is_logical_line = False
-        self.line_indent_lvl = 0  
-        self.indent_stack = [0]
+        self.eof: Optional[Token] = None
 
     def peek(self, k: int = 1) -> Union[Token, List[Token]]:
         """ Peeks through the next `k` number of tokens.
-        This functions looks ahead the next `k` number of tokens,
-        and returns them as a list.
-        It uses a FIFO buffer to store tokens temporarily.
         :param k: number of tokens
         :return: one token or a list of tokens
         """
-        if not self.buffer:
-            self.buffer = [self.consume()]
-
-        # Fill the buffer up to `k` tokens, if needed.
-        buffer_size = len(self.buffer)
-        if buffer_size < k:
-            for _ in list(range(k - buffer_size)):
-                self.buffer.append(self.consume(keep_buffer=True))
+        if k == 1 and self.buffer:
+            return self.buffer[0]
+        while len(self.buffer) < k:
+            self.fill()
 
         # If you need only one token, return it as an element,
         # not as a list with one element.
         if k == 1:
             return self.buffer[0]
 
-        return self.buffer[0:k]
-
-    def consume(self, keep_buffer: bool = False) -> Token:
-        """ Consumes one token and implements peeking through the next one.
+        return [self.buffer[i] for i in range(k)]
 
-        If we want to only peek and not consume, we set the `keep_buffer` flag.
-        This argument is passed to additional calls to `next`.
-        The idea is that we can peek through more than one tokens (by keeping them in the buffer),
-        but we consume tokens only one by one.
-        :param keep_buffer: whether to keep the buffer intact, or consume a token from it
+    def consume(self) -> Token:
+        """ Consumes one token.
         :return: one token
         """
-        if self.buffer and not keep_buffer:
-            c = self.buffer[0]
-            self.buffer = self.buffer[1:]
-            return c
-
-        c : StrLnCol = self.scanner.peek()
-
-        while True:
-            if c.isspace():
-                if c == '\t':
-                    pass
-                elif c == '\n':  # line feed handling
-                    self.is_new_line = True
-                    if self.is_logical_line:
-                        self.is_logical_line = False
-                        self.scanner.consume()
-                        return Token(TokenKind.NEWLINE, None, c.line, c.col) 
-                elif c == '\r':  # carriage return handling
-                    self.is_new_line = True
-                    if self.is_logical_line:
-                        self.is_logical_line = False
-                        self.scanner.consume()
-                        return Token(TokenKind.NEWLINE, None, c.line, c.col) 
-                # Consume whitespace
-                self.scanner.consume()
-                return self.consume(keep_buffer)
-
-            # One line comments
-            elif c == '#':
-                self.scanner.consume()
-                c = self.scanner.peek()
-                while c and c != '\n' and c != '\r':
-                    self.scanner.consume()
-                    c = self.scanner.peek()
-                return self.consume(keep_buffer)
-
-            elif c and not c.isspace() and c != '#' and self.is_new_line:
-                self.is_logical_line = True
-                self.is_new_line = False
-            
-            elif c == ':':
-                self.scanner.consume()
-                return Token(TokenKind.COLON, None, c.line, c.col, 1)
-
-            # Identifier: [a-zA-Z_][a-zA-Z0-9_]*
-            elif c.isalpha() or c == '_' or c == '$':
-                token_start_line, token_start_col = c.line, c.col
-                name = self.scanner.consume()
-                c = self.scanner.peek()
-                while c.isalnum() or c == '_' or c == '-' or c == 'r' or c == '/' :
-                    name += self.scanner.consume()
-                    c = self.scanner.peek()
-                
-                if name == 'nop':
-                    return Token(TokenKind.NOP, None, token_start_line, token_start_col, 3)
-                if name == 'registers':
-                    return Token(TokenKind.REGISTERS_SYMBOL, None, token_start_line, token_start_col, 9)
-                if name == 'import':
-                    return Token(TokenKind.IMPORT, None, token_start_line, token_start_col, 6)
-                if name == 'as':
-                    return Token(TokenKind.AS, None, token_start_line, token_start_col, 2)
-                elif name == 'decjz':
-                    return Token(TokenKind.DECJZ, None, token_start_line, token_start_col, 9)
-                elif name == 'inc':
-                    return Token(TokenKind.INC, None, token_start_line, token_start_col, 4)
-                elif name[0] == 'r' and name[1::].isnumeric():
-                    return Token(TokenKind.REGISTER , int(name[1::]) , c.line, c.col, None)
-                elif name[0] == 'r' and ((name[1] == '-' and name[2::].isnumeric())):
-                    return Token(TokenKind.REGISTER , -1*int(name[2::]) , c.line, c.col, None)
-                elif name[0] == '$' and name[1::].isnumeric():
-                    return Token(TokenKind.PARAM , int(name[1::]) , c.line, c.col, None)
-                return Token(TokenKind.IDENTIFIER, name, token_start_line, token_start_col, len(name))
-            
-            # Number: [0-9]+
-            elif c.isdigit() or c == '-':
-                value = self.scanner.consume()
-                while self.scanner.peek().isnumeric():
-                    value += self.scanner.consume()
-                return Token(TokenKind.INTEGER, int(value), c.line, c.col, len(value))
-
-            # directory "./x/y"
-            elif c == '"':
-                self.scanner.consume()
-                value = ""
-                while True: #self.scanner.peek().isnumeric():
-                    if self.scanner.peek() == '"':
-                        self.scanner.consume()
-                        break
-                    value += self.scanner.consume()
-                return Token(TokenKind.DIRECTORY, value, c.line, c.col, len(value)+2)
-
-
-            # End of file
-            elif not c:
-                # The end of input also serves as an implicit terminator of the physical line.
-                # For a logical line emit a newline token.
+        while not self.buffer:
+            self.fill()
+        return self.buffer.popleft()
+
+    def fill(self):
+        """ Tokenize the next line into the buffer, or add EOF. """
+        if self.eof is not None:
+            self.buffer.append(self.eof)
+            return
+
+        line = self.stream.readline()
+        if line == '':
+            # The end of input also serves as an implicit terminator of the physical line.
+            if self.lines_read == 0:
+                line_no, col = 0, 0
+            elif self.last_line.endswith('\n'):
+                line_no, col = self.lines_read, 0
+            else:
+                line_no, col = self.lines_read - 1, len(self.last_line)
+            if self.is_logical_line:
+                self.is_logical_line = False
+                self.buffer.append(Token(TokenKind.NEWLINE, None, line_no, col))
+            self.eof = Token(TokenKind.EOF, None, line_no, col)
+            self.buffer.append(self.eof)
+            return
+
+        self.last_line = line
+        self.lines_read += 1
+        if self.kept_lines is not None:
+            self.kept_lines.append(line)
+        self.tokenize_line(line, self.lines_read - 1)
+
+    def source_line(self, line_no: int) -> str:
+        """ The text of line `line_no` of the stream, read so far. """
+        if self.kept_lines is not None:
+            return self.kept_lines[line_no]
+        if line_no == self.lines_read - 1:
+            return self.last_line
+        pos = self.stream.tell()
+        self.stream.seek(self.origin)
+        for _ in range(line_no + 1):
+            line = self.stream.readline()
+        self.stream.seek(pos)
+        return line
+
+    def tokenize_line(self, line: str, line_no: int):
+        buffer = self.buffer
+        pos = 0
+        end = len(line) - 1 if line.endswith('\n') else len(line)
+        while pos < end:
+            m = TOKEN_RE.match(line, pos, end)
+            if m is None:
+                if line[pos] == '"':
+                    raise Exception("Unterminated directory string at line " + str(line_no + 1))
+                raise Exception("Invalid character detected: '" + line[pos] + "'")
+            kind = m.lastgroup
+            text = m.group()
+
+            if kind == 'blank' or kind == 'comment':
+                pass
+            elif kind == 'linebreak':
                 if self.is_logical_line:
                     self.is_logical_line = False
-                    return Token(TokenKind.NEWLINE, None, c.line, c.col)
-
-                return Token(TokenKind.EOF, None, c.line, c.col)
+                    buffer.append(Token(TokenKind.NEWLINE, None, line_no, pos))
             else:
-                raise Exception("Invalid character detected: '" + c + "'")
+                self.is_logical_line = True
+                # registers and params are located at the character after them
+                if kind == 'register':
+                    buffer.append(Token(TokenKind.REGISTER, int(text[1:]), line_no, m.end(), None))
+                elif kind == 'name':
+                    buffer.append(self.name_token(text, line_no, pos))
+                elif kind == 'param':
+                    buffer.append(Token(TokenKind.PARAM, int(text[1:]), line_no, m.end(), None))
+                elif kind == 'integer':
+                    buffer.append(Token(TokenKind.INTEGER, int(text), line_no, pos, len(text)))
+                elif kind == 'colon':
+                    buffer.append(Token(TokenKind.COLON, None, line_no, pos, 1))
+                else:
+                    buffer.append(Token(TokenKind.DIRECTORY, text[1:-1], line_no, pos, len(text)))
+            pos = m.end()
+
+        if end < len(line) and self.is_logical_line:
+            self.is_logical_line = False
+            buffer.append(Token(TokenKind.NEWLINE, None, line_no, end))
+
+    def name_token(self, name: str, line_no: int, col: int) -> Token:
+        """ Keywords and identifiers. """
+        if name in KEYWORDS:
+            kind, length = KEYWORDS[name]
+            return Token(kind, None, line_no, col, length)
+        return Token(TokenKind.IDENTIFIER, StrLnCol(name, line_no, col), line_no, col, len(name))
 
 class Lexer:
 
-    # line : int = 0
-    # col : int = 0
-
     def __init__(self, stream: TextIOBase):
-        scanner = Scanner(stream)
-        self.tokenizer = Tokenizer(scanner)
+        self.tokenizer = Tokenizer(stream)
+
+    def source_line(self, line_no: int) -> str:
+        return self.tokenizer.source_line(line_no)
 
     def peek(self, k: int = 1) -> Union[Token, List[Token]]:
         return self.tokenizer.peek(k)
 
     def consume(self) -> Token:
-        # self.line = self.tokenizer.scanner.line
-        # self.col = self.tokenizer.scanner.col
-        ret = self.tokenizer.consume()
-        return ret
+        return self.tokenizer.consume()
 
 class Parser:
 
@@ -331,11 +289,10 @@ class Parser:
         print(f"SyntaxError (line {token.line+1}, column {token.col+1}): ",end='')
 
     def print_err_line(self, token : Token ):
-        
-        for char in self.lexer.tokenizer.scanner.file_content_by_line[token.line]:
-            print(char, end='')
+        line = self.lexer.source_line(token.line)
+        print(line, end='')
 
-        if self.lexer.tokenizer.scanner.file_content_by_line[token.line][-1] != '\n':
+        if not line.endswith('\n'):
             print()
 
         print('-' * token.col + "^")
@@ -360,6 +317,27 @@ class Parser:
 
         return ((regs, labels, instrs))
 
+    def parse_imports(self) -> Dict[str, str]:
+        """
+            imports := (`import` directory `as` identifier NEWLINE)*
+        :return: alias -> path of the imported macro file; relative paths
+                 are resolved against the working directory
+        """
+        imports = {}
+        while self.check(TokenKind.IMPORT):
+            self.match(TokenKind.IMPORT)
+            dir = self.match(TokenKind.DIRECTORY).value
+            self.match(TokenKind.AS)
+            alias = self.match(TokenKind.IDENTIFIER).value
+            self.match(TokenKind.NEWLINE)
+
+            if alias in imports:
+                raise Exception(f"macro '{alias}' imported again (line {alias.line+1})")
+            if not os.path.isabs(dir):
+                dir = os.path.join(os.getcwd(), dir)
+            imports[alias] = dir
+        return imports
+
     def parse_reg_spec(self):
         """
             `registers` (number)*
@@ -405,19 +383,19 @@ class Parser:
         return (labels, instructions)
     
     def is_labInst_first_set(self):
-        if self.check(TokenKind.DECJZ) or self.check(TokenKind.INC) or self.check(TokenKind.NOP) or self.check(TokenKind.IDENTIFIER):
-            return True
-        else: return False
+        return self.lexer.peek().kind in (TokenKind.DECJZ, TokenKind.INC, TokenKind.NOP, TokenKind.IDENTIFIER)
 
     def parse_labInst(self) -> Instr:
         """
           labInst := (label `:`)? inst
             instr := `inc` register
                    | `decjz` register label
-                   | macro params
+                   | macro arg*
          register := `r` number
          macro := label
+         arg := register | number | label
         """
+        line = self.lexer.peek().line
         if self.check([TokenKind.IDENTIFIER,TokenKind.COLON]): # instruction with label
             label = self.match(TokenKind.IDENTIFIER).value
             self.match(TokenKind.COLON)
@@ -425,9 +403,15 @@ class Parser:
             label = None
         instr = self.parse_instr()
         instr.label = label
+        instr.line = line
         return instr
 
 
+    def macro_arg_kinds(self):
+        if self.is_macro:
+            return (TokenKind.REGISTER, TokenKind.INTEGER, TokenKind.IDENTIFIER, TokenKind.PARAM)
+        return (TokenKind.REGISTER, TokenKind.INTEGER, TokenKind.IDENTIFIER)
+
     def parse_instr(self) -> Instr:
 
         if self.check(TokenKind.INC):
@@ -461,6 +445,14 @@ class Parser:
             self.match(TokenKind.NOP)
             return Instr(Opcode.NOP, [])
 
+        elif self.check(TokenKind.IDENTIFIER):
+            # macro call, expanded by macro.py
+            name = self.match(TokenKind.IDENTIFIER)
+            args = [name]
+            while self.lexer.peek().kind in self.macro_arg_kinds():
+                args.append(self.match(self.lexer.peek().kind))
+            return Instr(Opcode.CALL, args)
+
         else:
             print(self.lexer.peek(10))
             raise Exception("unmatch" + self.lexer.peek().value)
\ No newline at end of file
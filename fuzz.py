@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+"""Differential fuzzer for rmsim.
+
+Generates random register machine programs (labels, integer branch targets,
+HALT, negative registers, nops, comments and calls of generated macro files
+that may import each other), runs each one on the classic interpreter as
+the reference and on every other engine at every optimization level, and
+compares the final registers touched, the step counts and what the runs
+print. A failing program is minimized and written, with its macro files,
+to the output directory.
+
+    ./fuzz.py                       100 programs from a random seed
+    ./fuzz.py -n 10000 --seed 7     10000 programs from seed 7
+    ./fuzz.py --check case.r        cross-check one program
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import random
+import signal
+import sys
+import tempfile
+
+from instr import Opcode
+from pre_process import parse_source
+from link import link
+from optimize import LEVELS, optimize
+from emulator import Emulator
+from threaded import ThreadedEmulator, run_guarded
+from compiled import CompiledEmulator, compiled_cache
+from loops import program_transfer_loops
+from debugger import Recording
+from tracing import TextTrace
+from units import UnitCache
+from parallel import Job, init_installed, run_installed, run_one
+from watchdog import Budget, HALTED
+from regfile import FORMATS, write_regs
+from batch import np, BatchEmulator
+
+DEFAULT_COUNT = 100
+DEFAULT_SIZE = 12
+DEFAULT_MAX_STEPS = 10_000
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_OUT = 'fuzz-failures'
+# generated macro files per program, and the most statements of each
+MAX_MACROS = 3
+MACRO_SIZE = 4
+# call summaries kept by the --memo engines, small so they get evicted
+MEMO_SIZE = 4
+
+
+class Line:
+    """
+    One statement: `op` is 'inc', 'decjz', 'nop' or 'call'. `reg` is a
+    register number, or '$N' for an argument in a macro body; `target` a
+    label, an int or 'HALT', or for a call the index of the macro called,
+    whose arguments are `args`.
+    """
+
+    def __init__(self, op: str, reg=0, target=None, label: str = None, comment: bool = False, args=()):
+        self.op = op
+        self.reg = reg
+        self.target = target
+        self.label = label
+        self.comment = comment
+        self.args = list(args)
+
+    def copy(self, **changes):
+        line = Line(self.op, self.reg, self.target, self.label, self.comment, self.args)
+        line.__dict__.update(changes)
+        return line
+
+    def __str__(self):
+        text = f"{self.label}: " if self.label is not None else ""
+        if self.op == 'nop':
+            text += "nop"
+        elif self.op == 'inc':
+            text += f"inc {register(self.reg)}"
+        elif self.op == 'decjz':
+            text += f"decjz {register(self.reg)} {self.target}"
+        else:
+            text += " ".join([f"M{self.target}"] + [register(reg) for reg in self.args])
+        return text + ("  # fuzz" if self.comment else "")
+
+
+def register(reg) -> str:
+    return reg if isinstance(reg, str) else f"r{reg}"
+
+
+class Macro:
+    """A generated macro file: the statements of its body, which uses `$0`..`$params-1`."""
+
+    def __init__(self, params: int, lines):
+        self.params = params
+        self.lines = lines
+
+
+class Case:
+    """
+    A generated program: the `registers` line, the statements and the macro
+    files. Macro i may call macros before it; every file imports all of
+    those, the program all of them, macro i as `Mi`.
+    """
+
+    def __init__(self, regs, lines, macros=()):
+        self.regs = regs
+        self.lines = lines
+        self.macros = list(macros)
+
+    def copy(self, **changes):
+        case = Case(self.regs, self.lines, self.macros)
+        case.__dict__.update(changes)
+        return case
+
+    def files(self, directory: str):
+        """The path of every macro file in `directory` and its contents, by macro index."""
+        ret = []
+        for macro in self.macros:
+            content = header(ret, len(ret)) + "".join(f"{line}\n" for line in macro.lines)
+            # named by content, as the expander keeps parsed files by path
+            # and stamp, which an edit of the same size may not change
+            name = hashlib.sha256(content.encode()).hexdigest()[:16]
+            ret.append((os.path.join(directory, f"{name}.m"), content))
+        return ret
+
+    def source(self, directory: str) -> str:
+        """The program, its macro files written to `directory`."""
+        files = self.files(directory)
+        for path, content in files:
+            if not os.path.exists(path):
+                with open(path, mode='w') as f:
+                    f.write(content)
+        return header(files, len(files)) + "\n".join(
+            ["registers " + " ".join(map(str, self.regs))] + [str(line) for line in self.lines]) + "\n"
+
+
+def header(files, count: int) -> str:
+    return "".join(f'import "{files[i][0]}" as M{i}\n' for i in range(count))
+
+
+def generate_lines(rng: random.Random, n: int, regs, macros, end: int):
+    """
+    `n` random statements on the registers `regs`, calling `macros`; integer
+    targets up to `end`, where the program halts or the macro returns.
+    """
+    labels = [f"L{i}" if rng.random() < 0.3 else None for i in range(n)]
+    named = [label for label in labels if label is not None]
+    lines = []
+    for i in range(n):
+        kind = rng.random()
+        reg = rng.choice(regs)
+        if macros and kind < 0.15:
+            index = rng.randrange(len(macros))
+            line = Line('call', target=index, args=[rng.choice(regs) for _ in range(macros[index].params)])
+        elif kind < 0.4:
+            line = Line('inc', reg)
+        elif kind < 0.87:
+            where = rng.random()
+            if named and where < 0.4:
+                target = rng.choice(named)
+            elif where < 0.55:
+                target = 'HALT'
+            else:
+                target = rng.randint(0, end)
+            line = Line('decjz', reg, target)
+        else:
+            line = Line('nop')
+        line.label = labels[i]
+        line.comment = rng.random() < 0.05
+        lines.append(line)
+    return lines
+
+
+def generate(rng: random.Random, size: int) -> Case:
+    """A random program of at most `size` statements, calling up to MAX_MACROS macros."""
+    concrete = list(range(-2, 6))
+    macros = []
+    for _ in range(rng.choice([0, 0, 1, MAX_MACROS])):
+        params = rng.randint(1, 3)
+        arguments = [f"${i}" for i in range(params)]
+        n = rng.randint(1, MACRO_SIZE)
+        if rng.random() < 0.3:
+            # a transfer loop: $1 += $0, $0 = 0
+            lines = [Line('decjz', '$0', 3), Line('inc', arguments[-1]), Line('decjz', -1, 0)]
+        else:
+            # a target past the end continues after the call
+            lines = generate_lines(rng, n, arguments * 2 + concrete, macros, n + 1)
+        macros.append(Macro(params, lines))
+    regs = [rng.randint(0, 4) for _ in range(rng.randint(0, 4))]
+    n = rng.randint(1, size)
+    # one past the end behaves like HALT
+    return Case(regs, generate_lines(rng, n, concrete, macros, n + 1), macros)
+
+
+class Timeout(Exception):
+    pass
+
+
+def on_alarm(signum, frame):
+    raise Timeout()
+
+
+class Outcome:
+    """
+    The final registers, the step count and the output of one run. `kind`
+    says what `regs` holds: 'touched', the touched registers by address;
+    'slots', every register the program names by address, touched or not
+    (the batch engine); 'dense', the list of registers 0 up to the highest
+    touched one (the runs of `rmsim batch` and the server).
+    """
+
+    def __init__(self, regs, steps: int, output: str = None, kind: str = 'touched'):
+        self.regs = regs
+        self.steps = steps
+        self.output = output
+        self.kind = kind
+
+
+def emulate(e, trace=False) -> Outcome:
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        e.run(trace=TextTrace(out) if trace else False)
+    return Outcome(dict(e.regs), e.steps, out.getvalue())
+
+
+def engines(program):
+    """name -> function running `program` on an engine and returning its Outcome."""
+    loops = program_transfer_loops(program)
+    ret = {}
+    for name, accelerate in (('classic', False), ('classic-accel', True)):
+        ret[name] = lambda accelerate=accelerate: emulate(
+            Emulator(program.regs, dict(program.labels), program.instrs, accelerate))
+    ret['classic-trace'] = lambda: emulate(Emulator(program.regs, dict(program.labels), program.instrs), True)
+    for engine in (ThreadedEmulator, CompiledEmulator):
+        base = 'threaded' if engine is ThreadedEmulator else 'compiled'
+        ret[base] = lambda engine=engine: emulate(engine.from_program(program, False))
+        ret[base + '-accel'] = lambda engine=engine: emulate(engine.from_program(program, True))
+        ret[base + '-trace'] = lambda engine=engine: emulate(engine.from_program(program, False), True)
+
+    def guarded():
+        regs, steps, _, status, _ = run_guarded(program, program.regs, loops, Budget(cycles=True))
+        if status != HALTED:
+            raise Exception(f"stopped with status {status}")
+        return Outcome(regs, steps)
+    ret['guarded'] = guarded
+
+    def recording():
+        r = Recording(program, every=64)
+        r.record()
+        _, regs = r.state_at(r.steps)
+        if regs != r.registers():
+            raise Exception("the replayed registers differ from the recorded ones")
+        return Outcome(regs, r.steps)
+    ret['debugger'] = recording
+
+    # --memo, on a fresh cache and on one a run of the program filled
+    memo = UnitCache(MEMO_SIZE)
+
+    def memoized():
+        e = ThreadedEmulator.from_program(program, True)
+        e.memo = memo
+        return emulate(e)
+    ret['memo'] = memoized
+    ret['memo-warm'] = memoized
+
+    def pooled(result):
+        if result['status'] != HALTED:
+            raise Exception(f"stopped with status {result['status']}")
+        return Outcome(result['registers'], result['steps'], kind='dense')
+    job = Job('<fuzz>', program)
+    for accelerate in (False, True):
+        suffix = '-accel' if accelerate else ''
+        ret['parallel' + suffix] = lambda accelerate=accelerate: pooled(
+            run_one(job, program.regs, Budget(cycles=True), accelerate))
+
+    def served():
+        # the first run installs the job in the worker, the second finds it by key
+        init_installed(1)
+        run_installed('fuzz', program.regs, Budget(cycles=True), True, Job('<fuzz>', program))
+        result = run_installed('fuzz', program.regs, Budget(cycles=True), True)
+        if result is None:
+            raise Exception("the installed job was not found")
+        return pooled(result)
+    ret['server'] = served
+
+    if np is not None:
+        def batch(accelerate):
+            e = BatchEmulator(program, [program.regs], accelerate)
+            e.run()
+            return Outcome(dict(zip(e.addrs, e.regs[0])), e.steps[0], kind='slots')
+        ret['batch'] = lambda: batch(False)
+        ret['batch-accel'] = lambda: batch(True)
+    return ret
+
+
+def scratch(instrs):
+    """
+    The scratch registers of a parsed program: negative ones it never
+    increments. The optimizer takes them to stay zero and may drop the
+    jumps on them, so whether they are touched changes with -O; they are
+    never printed (see optimize.py and regfile.py).
+    """
+    incremented = set(instr.params[0].value for instr in instrs if instr.opcode in (Opcode.INC, Opcode.ADD))
+    return set(instr.params[0].value for instr in instrs
+               if instr.opcode == Opcode.DECJZ and instr.params[0].value < 0 and not instr.params[0].value in incremented)
+
+
+def without(regs, addrs):
+    return {addr: value for addr, value in regs.items() if not addr in addrs}
+
+
+def expected(got: Outcome, want: Outcome):
+    """The registers an engine reporting like `got` should give for the touched registers of `want`."""
+    if got.kind == 'slots':
+        # an untouched slot is zero; a touched register missing from the slots shows up as None
+        return {addr: want.regs.get(addr, 0) for addr in got.regs}, \
+               {addr: got.regs.get(addr) for addr in want.regs}
+    if got.kind == 'dense':
+        high = max((addr for addr in want.regs if addr >= 0), default=-1)
+        return [want.regs.get(addr, 0) for addr in range(high + 1)], None
+    return want.regs, None
+
+
+def printed(regs):
+    """format -> what rmsim prints for the final registers `regs` in that format."""
+    ret = {}
+    for format in FORMATS:
+        f = io.BytesIO() if format == 'binary' else io.StringIO()
+        write_regs(f, regs, format)
+        ret[format] = f.getvalue()
+    return ret
+
+
+def compare(name: str, got: Outcome, want: Outcome):
+    """A description of how `got` differs from the reference `want`, None if it doesn't."""
+    regs, touched = expected(got, want)
+    if got.regs != regs:
+        return f"registers {got.regs}, expected {regs}"
+    if touched is not None and touched != want.regs:
+        return f"touched registers {want.regs} missing from the slots {got.regs}"
+    if got.steps != want.steps:
+        return f"{got.steps} steps, expected {want.steps}"
+    if got.output is not None and want.output is not None and got.output != want.output:
+        return f"printed {got.output[-200:]!r}, expected {want.output[-200:]!r}"
+    return None
+
+
+def run_case(source: str, max_steps: int, timeout: float):
+    """
+    Cross-check `source`. Return None if every engine agrees with the
+    reference, 'skip' if the reference doesn't halt within `max_steps`
+    steps or the program doesn't link, else `(engine, level, message)`.
+    """
+    try:
+        (regs, labels, instrs), _ = parse_source(io.StringIO(source))
+        program = link(regs, dict(labels), instrs)
+    except Exception:
+        return 'skip'
+    reference = Emulator(program.regs, dict(program.labels), program.instrs)
+    reference.budget = Budget(steps=max_steps)
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference.run()
+    if reference.status != HALTED:
+        return 'skip'
+    reference = Outcome(dict(reference.regs), reference.steps)
+    reference_output = printed(reference.regs)
+    zeros = scratch(instrs)
+
+    for level in LEVELS:
+        compiled_cache.clear()
+        (regs, labels, instrs), _ = parse_source(io.StringIO(source))
+        try:
+            program = link(*optimize(regs, labels, instrs, level))
+        except Exception as e:
+            return ('optimize', level, f"raised {e!r}")
+        results = {}
+        for name, run in engines(program).items():
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                results[name] = run()
+            except Timeout:
+                return (name, level, f"did not halt within {timeout} s")
+            except Exception as e:
+                return (name, level, f"raised {e!r}")
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+        # the engines agree with the classic interpreter at the same level,
+        # traces with the classic trace
+        want = results['classic']
+        for name, got in results.items():
+            base = results['classic-trace'] if name.endswith('-trace') else want
+            message = compare(name, got, base)
+            if message is not None:
+                return (name, level, message)
+        # the optimizer keeps the registers touched, scratch registers
+        # aside, and never adds steps
+        if without(want.regs, zeros) != without(reference.regs, zeros):
+            return ('classic', level, f"registers {without(want.regs, zeros)}, "
+                                      f"unoptimized {without(reference.regs, zeros)}")
+        if want.steps > reference.steps:
+            return ('classic', level, f"{want.steps} steps, more than the {reference.steps} unoptimized")
+        # and what is printed, in every --regs-format
+        output = printed(want.regs)
+        for format in FORMATS:
+            if output[format] != reference_output[format]:
+                return ('classic', level, f"--regs-format {format} printed {output[format]!r}, "
+                                          f"unoptimized {reference_output[format]!r}")
+    return None
+
+
+def remove(case: Case, start: int, count: int) -> Case:
+    """`case` without lines `start..start+count-1`, integer targets moved along."""
+    lines = []
+    for line in case.lines[:start] + case.lines[start + count:]:
+        if line.op == 'decjz' and type(line.target) is int and line.target > start:
+            line = line.copy(target=max(start, line.target - count))
+        lines.append(line)
+    return case.copy(lines=lines)
+
+
+def candidates(case: Case):
+    """Smaller or simpler variants of `case`, the most promising first."""
+    n = len(case.lines)
+    chunk = n // 2
+    while chunk >= 1:
+        for start in range(0, n, chunk):
+            yield remove(case, start, chunk)
+        chunk //= 2
+    for i in range(len(case.regs)):
+        yield case.copy(regs=case.regs[:i] + case.regs[i + 1:])
+        if case.regs[i] > 0:
+            yield case.copy(regs=case.regs[:i] + [case.regs[i] // 2] + case.regs[i + 1:])
+            yield case.copy(regs=case.regs[:i] + [case.regs[i] - 1] + case.regs[i + 1:])
+    for i, line in enumerate(case.lines):
+        simpler = []
+        if line.comment:
+            simpler.append(line.copy(comment=False))
+        if line.label is not None:
+            simpler.append(line.copy(label=None))
+        if line.op != 'nop':
+            simpler.append(line.copy(op='nop', target=None, args=[]))
+        if line.reg != 0:
+            simpler.append(line.copy(reg=0))
+        if line.op == 'decjz' and line.target != 'HALT':
+            simpler.append(line.copy(target='HALT'))
+        for simple in simpler:
+            yield case.copy(lines=case.lines[:i] + [simple] + case.lines[i + 1:])
+    for m, macro in enumerate(case.macros):
+        for i, line in enumerate(macro.lines):
+            if line.op != 'nop':
+                lines = macro.lines[:i] + [Line('nop', label=line.label)] + macro.lines[i + 1:]
+                yield case.copy(macros=case.macros[:m] + [Macro(macro.params, lines)] + case.macros[m + 1:])
+
+
+def minimize(case: Case, failure, max_steps: int, timeout: float, directory: str) -> Case:
+    """Shrink `case` while it keeps failing on the same engine at the same level."""
+    progress = True
+    while progress:
+        progress = False
+        for candidate in candidates(case):
+            result = run_case(candidate.source(directory), max_steps, timeout)
+            if isinstance(result, tuple) and result[:2] == failure[:2]:
+                case, failure = candidate, result
+                progress = True
+                break
+    return case, failure
+
+
+def describe(failure) -> str:
+    name, level, message = failure
+    return f"{name} -O{level}: {message}"
+
+
+def save(out: str, name: str, case: Case, failure) -> str:
+    """Write `case` to `out`, its macro files next to it."""
+    os.makedirs(out, exist_ok=True)
+    path = os.path.join(out, name)
+    with open(path, mode='w') as f:
+        f.write(f"# {describe(failure)}\n")
+        f.write(case.source(out))
+    return path
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='cross-check the rmsim engines on random programs')
+    arg_parser.add_argument("-n", "--count", type=int, default=DEFAULT_COUNT,
+                            help=f"programs to generate (default: {DEFAULT_COUNT})")
+    arg_parser.add_argument("--seed", type=int, default=None,
+                            help="seed of the first program, program i uses seed+i (default: random)")
+    arg_parser.add_argument("--size", type=int, default=DEFAULT_SIZE,
+                            help=f"most instructions per program (default: {DEFAULT_SIZE})")
+    arg_parser.add_argument("--max-steps", type=int, default=DEFAULT_MAX_STEPS,
+                            help=f"programs the reference doesn't halt within are skipped (default: {DEFAULT_MAX_STEPS})")
+    arg_parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                            help=f"seconds an engine may take on one program (default: {DEFAULT_TIMEOUT})")
+    arg_parser.add_argument("--out", type=str, default=DEFAULT_OUT, metavar="DIR",
+                            help=f"where minimized failing programs are written (default: {DEFAULT_OUT})")
+    arg_parser.add_argument("--no-minimize", action='store_true', help="save failing programs as generated")
+    arg_parser.add_argument("--check", type=str, default=None, metavar="FILE",
+                            help="cross-check the program in FILE instead of generating programs")
+    args = arg_parser.parse_args()
+
+    signal.signal(signal.SIGALRM, on_alarm)
+
+    if args.check is not None:
+        with open(args.check, mode='r') as f:
+            result = run_case(f.read(), args.max_steps, args.timeout)
+        if result == 'skip':
+            print(f"{args.check}: does not halt within {args.max_steps} steps")
+        elif result is not None:
+            print(f"{args.check}: {describe(result)}")
+            sys.exit(1)
+        else:
+            print(f"{args.check}: ok")
+        return
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    print(f"seed {seed}", flush=True)
+    checked = skipped = failed = 0
+    with tempfile.TemporaryDirectory(prefix='rmsim-fuzz-') as directory:
+        for i in range(args.count):
+            case = generate(random.Random(seed + i), args.size)
+            result = run_case(case.source(directory), args.max_steps, args.timeout)
+            if result is None:
+                checked += 1
+                continue
+            if result == 'skip':
+                skipped += 1
+                continue
+            failed += 1
+            print(f"seed {seed + i}: {describe(result)}", flush=True)
+            if not args.no_minimize:
+                case, result = minimize(case, result, args.max_steps, args.timeout, directory)
+            path = save(args.out, f"case-{seed + i}.r", case, result)
+            print(f"  {len(case.lines)} instructions: {describe(result)}\n  saved to {path}", flush=True)
+    print(f"{checked} programs agree, {skipped} skipped (no halt within {args.max_steps} steps), {failed} failed")
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,29 @@
 from enum import Enum, auto
-from dataclasses import dataclass
 from typing import Any, List, Union, Optional, Tuple
 
-from pytest import param
 
 class Opcode(Enum):
 	DECJZ = auto()
 	INC = auto()
 	NOP = auto()
+	CALL = auto() # macro call, only before macro expansion
+	ADD = auto() # `add r n`, n fused `inc r`, only made by the optimizer
 
-@dataclass
 class Param:
-	value: Any = None
+	def __init__(self, value : Any = None):
+		self.value = value
 
 	def __repr__(self) -> str: 
-		str(self.value)
+		return str(self.value)
 
 
 class Instr:
-	def __init__(self, opcode : Opcode, params : List[Param], label:str=None):
+	def __init__(self, opcode : Opcode, params : List[Param], label:str=None, line:int=-1, macro:str=None):
 		self.opcode = opcode
 		self.params = params
 		self.label = label
+		self.line = line # source line, starting from 0
+		self.macro = macro # macros this instruction was expanded from, e.g. "CLR>GOTO"
 
 	def __repr__(self) -> str: 
 		ret = ""
@@ -0,0 +1,229 @@
+from array import array
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from frontend import StrLnCol, Token, TokenKind
+
+# opcodes of the linked program image
+OP_INC = 0
+OP_DECJZ = 1
+OP_NOP = 2
+OP_HALT = 3
+OP_ADD = 4
+
+class Program:
+	'''
+	A linked program image.
+
+	Instructions are flattened into parallel integer arrays indexed by pc:
+	`ops[pc]` is the opcode, `slots[pc]` the register operand and
+	`targets[pc]` the resolved branch target of a `decjz` (HALT and every
+	label already replaced by an address) or the amount of an `add`, the
+	super-instruction of optimize.py. One extra HALT instruction is
+	appended at `len(instrs)`, so the engines never bound-check pc.
+
+	Registers are renamed to dense slots 0..len(addrs)-1. `addrs[slot]` is
+	the register address of a slot and `init[slot]` its initial value. The
+	registers of the `registers` line always occupy the first slots, so
+	`spec_size` slots are live from the start. `bind` gives the initial
+	register file for another `registers` line, so one image can be run
+	over many inputs.
+
+	`lines[pc]` is the source line of an instruction and `macros[pc]` the
+	macros it was expanded from (None outside macros). The `Instr` list is
+	only kept while it is at hand; a program loaded from the program cache
+	rebuilds it on first use of `instrs`.
+	'''
+	def __init__(self, ops : array, slots : array, targets : array,
+			addrs : List[int], init : List[int], spec_size : int,
+			instrs : Optional[List[Instr]], labels : Dict[str, int], lines : array,
+			macros : List[Optional[str]]):
+		self.ops = ops
+		self.slots = slots
+		self.targets = targets
+		self.addrs = addrs
+		self.init = init
+		self.spec_size = spec_size
+		self._instrs = instrs
+		self.labels = {str(label): pc for label, pc in labels.items()}
+		self.labels['HALT'] = len(ops) - 1
+		self.lines = lines
+		self.macros = macros
+		self.slot_map = {addr: slot for slot, addr in enumerate(addrs)}
+
+	def __len__(self):
+		return len(self.ops) - 1
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		state['_instrs'] = None
+		return state
+
+	@property
+	def regs(self) -> List[int]:
+		''' The `registers` line. '''
+		return self.init[:self.spec_size]
+
+	@property
+	def instrs(self) -> List[Instr]:
+		if self._instrs is None:
+			self._instrs = self.to_instrs()
+		return self._instrs
+
+	def to_instrs(self) -> List[Instr]:
+		'''
+		Rebuild the `Instr` list, with branch targets as addresses.
+		'''
+		label_at = {pc: label for label, pc in self.labels.items() if label != 'HALT'}
+		instrs = []
+		for pc in range(len(self)):
+			op, line = self.ops[pc], self.lines[pc]
+			if op != OP_NOP:
+				reg = Token(TokenKind.REGISTER, self.addrs[self.slots[pc]], line)
+			if op == OP_INC:
+				instr = Instr(Opcode.INC, [reg])
+			elif op == OP_DECJZ:
+				instr = Instr(Opcode.DECJZ, [reg, Token(TokenKind.INTEGER, self.targets[pc], line)])
+			elif op == OP_ADD:
+				instr = Instr(Opcode.ADD, [reg, Token(TokenKind.INTEGER, self.targets[pc], line)])
+			else:
+				instr = Instr(Opcode.NOP, [])
+			if pc in label_at:
+				instr.label = StrLnCol(label_at[pc], line, 0)
+			instr.line = line
+			instr.macro = self.macros[pc]
+			instrs.append(instr)
+		return instrs
+
+	def label_at(self) -> Dict[int, str]:
+		''' The first label of every labelled address. '''
+		ret = {}
+		for label, pc in sorted(self.labels.items(), key=lambda item: item[1]):
+			ret.setdefault(pc, label)
+		return ret
+
+	def disassemble(self, pc : int, label_at : Optional[Dict[int, str]] = None) -> str:
+		''' Source text of the instruction at `pc`, targets by label if `label_at` is given. '''
+		op = self.ops[pc]
+		if op == OP_INC:
+			return f"inc r{self.addrs[self.slots[pc]]}"
+		if op == OP_DECJZ:
+			target = self.targets[pc]
+			if label_at is not None and target in label_at:
+				target = label_at[target]
+			return f"decjz r{self.addrs[self.slots[pc]]} {target}"
+		if op == OP_ADD:
+			return f"add r{self.addrs[self.slots[pc]]} {self.targets[pc]}"
+		if op == OP_NOP:
+			return "nop"
+		return "HALT"
+
+	def slot_of(self, addr : int) -> Optional[int]:
+		return self.slot_map.get(addr)
+
+	def bind(self, regs : List[int]) -> Tuple[List[int], List[bool], List[int]]:
+		'''
+		Initial register file for the `registers` line `regs`: the value and
+		touched flag of every slot, and the slot addresses, which are `addrs`
+		plus one slot per register of `regs` the program never mentions.
+		'''
+		addrs = list(self.addrs)
+		values = [0] * len(addrs)
+		touched = [False] * len(addrs)
+		for addr in range(len(regs)):
+			slot = self.slot_map.get(addr)
+			if slot is None:
+				slot = len(addrs)
+				addrs.append(addr)
+				values.append(0)
+				touched.append(False)
+			values[slot] = regs[addr]
+			touched[slot] = True
+		return values, touched, addrs
+
+	def bind_state(self, regs : Dict[int, int]) -> Tuple[List[int], List[bool], List[int]]:
+		'''
+		`bind` for the state of a run, the touched registers by address (any
+		address, unlike a `registers` line).
+		'''
+		addrs = list(self.addrs)
+		values = [0] * len(addrs)
+		touched = [False] * len(addrs)
+		for addr, value in regs.items():
+			slot = self.slot_map.get(addr)
+			if slot is None:
+				slot = len(addrs)
+				addrs.append(addr)
+				values.append(0)
+				touched.append(False)
+			values[slot] = value
+			touched[slot] = True
+		return values, touched, addrs
+
+def resolve_target(target : Any, labels : Dict[str, int], n : int) -> int:
+	'''
+	Resolve a `decjz` branch target to an address. Jumping past the last
+	instruction behaves like HALT.
+	'''
+	if type(target) is StrLnCol or type(target) is str:
+		if target == 'HALT':
+			return n
+		if not target in labels:
+			raise Exception(f"undefined label '{target}' (line {target.line+1})" if type(target) is StrLnCol else f"undefined label '{target}'")
+		return labels[target]
+	if target < 0:
+		raise Exception(f"negative branch target {target}")
+	return min(target, n)
+
+def link(regs : List[int], labels : Dict[str, int], instrs : List[Instr]) -> Program:
+	'''
+	Turn the `(regs, labels, instrs)` tuple of `Parser.parse_input` into a
+	`Program`.
+	'''
+	n = len(instrs)
+	slot_map : Dict[int, int] = {}
+	addrs : List[int] = []
+	init : List[int] = []
+
+	def slot(addr : int) -> int:
+		if not addr in slot_map:
+			slot_map[addr] = len(addrs)
+			addrs.append(addr)
+			init.append(0)
+		return slot_map[addr]
+
+	for i in range(len(regs)):
+		init[slot(i)] = regs[i]
+
+	ops = array('b')
+	slots = array('l')
+	targets = array('l')
+	lines = array('l')
+	macros = []
+	for instr in instrs:
+		lines.append(instr.line)
+		macros.append(instr.macro)
+		if instr.opcode == Opcode.INC:
+			ops.append(OP_INC)
+			slots.append(slot(instr.params[0].value))
+			targets.append(0)
+		elif instr.opcode == Opcode.DECJZ:
+			ops.append(OP_DECJZ)
+			slots.append(slot(instr.params[0].value))
+			targets.append(resolve_target(instr.params[1].value, labels, n))
+		elif instr.opcode == Opcode.ADD:
+			ops.append(OP_ADD)
+			slots.append(slot(instr.params[0].value))
+			targets.append(instr.params[1].value)
+		elif instr.opcode == Opcode.NOP:
+			ops.append(OP_NOP)
+			slots.append(0)
+			targets.append(0)
+		else:
+			raise Exception("Unsupported opcode")
+
+	ops.append(OP_HALT)
+	slots.append(0)
+	targets.append(0)
+
+	return Program(ops, slots, targets, addrs, init, len(regs), instrs, labels, lines, macros)
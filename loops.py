@@ -0,0 +1,115 @@
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from link import *
+
+class TransferLoop:
+	'''
+	A counted loop that moves the value of `counter` into other registers
+
+		header: decjz counter exit
+		        inc r_a            # any number of inc / add / nop
+		        ...
+		        decjz zero header  # `zero` is never incremented
+
+	Entered with `counter` = n > 0 it runs its `length` instructions n times
+	and the header once more, so its effect is `counter` = 0,
+	`r_a += n * incs[r_a]` for every incremented register, pc = `exit`,
+	after `n * length + 1` steps.
+	'''
+	def __init__(self, header : int, counter : int, exit : int, incs : Dict[int, int], zero : int, length : int):
+		self.header = header
+		self.counter = counter
+		self.exit = exit
+		self.incs = incs
+		self.zero = zero
+		self.length = length
+
+	def steps(self, n : int) -> int:
+		return n * self.length + 1
+
+	def __repr__(self) -> str:
+		return f"TransferLoop(pc {self.header}: r{self.counter} -> {self.incs}, exit {self.exit})"
+
+def always_zero_registers(code : List[Tuple[int, int, Optional[int]]], nonzero) -> set:
+	'''
+	Registers that no instruction increments and that start at zero, i.e.
+	registers on which `decjz` is an unconditional jump. `nonzero(addr)`
+	tells whether a register may start nonzero.
+	'''
+	incremented = set(addr for op, addr, _ in code if op == OP_INC or op == OP_ADD)
+	mentioned = set(addr for op, addr, _ in code if op == OP_DECJZ)
+	return set(addr for addr in mentioned if not addr in incremented and not nonzero(addr))
+
+def scan_transfer_loops(code : List[Tuple[int, int, Optional[int]]], nonzero) -> Dict[int, TransferLoop]:
+	'''
+	Find the transfer loops of `code`, one `(op, register, target)` triple per
+	instruction using the opcodes of link.py. `target` is the resolved
+	branch target of a `decjz`, None if it is undefined, or the amount of
+	an `add`.
+	'''
+	n = len(code)
+	zeros = always_zero_registers(code, nonzero)
+	loops = {}
+
+	for header in range(n):
+		op, counter, exit = code[header]
+		if op != OP_DECJZ:
+			continue
+
+		incs : Dict[int, int] = {}
+		pc = header + 1
+		while pc < n and code[pc][0] in (OP_INC, OP_ADD, OP_NOP):
+			if code[pc][0] == OP_INC:
+				addr = code[pc][1]
+				incs[addr] = incs.get(addr, 0) + 1
+			elif code[pc][0] == OP_ADD:
+				addr = code[pc][1]
+				incs[addr] = incs.get(addr, 0) + code[pc][2]
+			pc += 1
+		if pc == n or counter in incs:
+			continue
+
+		back, zero, target = code[pc]
+		if back != OP_DECJZ or not zero in zeros or zero == counter or target != header:
+			continue
+		if exit is None or header <= exit <= pc:
+			continue
+
+		loops[header] = TransferLoop(header, counter, exit, incs, zero, pc - header + 1)
+
+	return loops
+
+def find_transfer_loops(regs : List[int], labels : Dict[str, int], instrs : List[Instr]) -> Dict[int, TransferLoop]:
+	'''
+	Find every `TransferLoop` of a parsed program, keyed by its header pc.
+	'''
+	n = len(instrs)
+	code = []
+	for instr in instrs:
+		if instr.opcode == Opcode.INC:
+			code.append((OP_INC, instr.params[0].value, None))
+		elif instr.opcode == Opcode.ADD:
+			code.append((OP_ADD, instr.params[0].value, instr.params[1].value))
+		elif instr.opcode == Opcode.DECJZ:
+			target = instr.params[1].value
+			if isinstance(target, str) and target != 'HALT' and not target in labels:
+				target = None
+			else:
+				target = resolve_target(target, labels, n)
+			code.append((OP_DECJZ, instr.params[0].value, target))
+		else:
+			code.append((OP_NOP, 0, None))
+	return scan_transfer_loops(code, lambda addr: 0 <= addr < len(regs) and regs[addr] != 0)
+
+def program_transfer_loops(program : Program, width : Optional[int] = None) -> Dict[int, TransferLoop]:
+	'''
+	`find_transfer_loops` for a linked program. With `width`, the loops are
+	valid for any `registers` line of up to `width` values.
+	'''
+	code = [(program.ops[pc], program.addrs[program.slots[pc]] if program.ops[pc] != OP_NOP else 0, program.targets[pc])
+		for pc in range(len(program))]
+	if width is None:
+		regs = program.regs
+		return scan_transfer_loops(code, lambda addr: 0 <= addr < len(regs) and regs[addr] != 0)
+	return scan_transfer_loops(code, lambda addr: 0 <= addr < width)
@@ -0,0 +1,224 @@
+import gc
+import os
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from frontend import Lexer, Parser, Token, TokenKind, StrLnCol
+
+class Macro:
+	'''
+	A macro file, parsed once and flattened into a template: its body with
+	every nested macro call already expanded.
+
+	Registers of the template are REGISTER or PARAM (`$N`) tokens. Branch
+	targets are `HALT`, PARAM tokens, or INTEGER tokens holding an address
+	relative to the start of the body, where `len(template)` falls through
+	to the instruction after the call.
+
+	The parsed body (`labels`, `instrs`) is kept too, so the template can
+	be rebuilt when an imported macro changes without reading the file.
+	'''
+	def __init__(self, path : str, stamp : Tuple[int, int], imports : Dict[str, 'Macro'], template : List[Instr],
+			labels : Dict[str, int], instrs : List[Instr]):
+		self.path = path
+		self.stamp = stamp
+		self.imports = imports
+		self.template = template
+		self.labels = labels
+		self.instrs = instrs
+
+	def __len__(self):
+		return len(self.template)
+
+def file_stamp(path : str) -> Tuple[int, int]:
+	st = os.stat(path)
+	return (st.st_mtime_ns, st.st_size)
+
+class MacroExpander:
+	'''
+	Expands macro calls into a flat instruction stream.
+
+	Every macro file is parsed and flattened once per process, parsed again
+	only when it changes on disk and flattened again when it or one of its
+	imports does, so expanding a call costs one pass over its template and
+	layered macros expand in time linear in the output. Integer branch
+	targets count statements of the body they appear in (a macro call is
+	one statement) and are relocated to addresses; labels inside macro
+	bodies are resolved per call site.
+	'''
+	def __init__(self):
+		self.macros : Dict[str, Macro] = {}
+		# macro files being loaded, innermost last
+		self.loading : List[str] = []
+		# macro files found up to date during the current expand(), and of
+		# those the ones parsed and the ones only flattened again
+		self.checked = set()
+		self.parsed = set()
+		self.relinked = set()
+
+	def load(self, path : str) -> Macro:
+		if path in self.loading:
+			cycle = self.loading[self.loading.index(path):] + [path]
+			raise Exception("cyclic macro import: " + " -> ".join(cycle))
+		if path in self.checked:
+			return self.macros[path]
+
+		self.loading.append(path)
+		try:
+			macro = self.macros.get(path)
+			stamp = file_stamp(path)
+			if macro is None or macro.stamp != stamp:
+				macro = self.parse_macro(path, stamp)
+				self.macros[path] = macro
+				self.parsed.add(path)
+			elif any(self.load(dep.path) is not dep for dep in macro.imports.values()):
+				macro = self.relink(macro)
+				self.macros[path] = macro
+				self.relinked.add(path)
+		finally:
+			self.loading.pop()
+		self.checked.add(path)
+		return macro
+
+	def parse_macro(self, path : str, stamp : Tuple[int, int]) -> Macro:
+		with open(path, mode='r') as f:
+			parser = Parser(Lexer(f), is_macro=True)
+			imports = parser.parse_imports()
+			labels, instrs = parser.parse_program()
+			parser.match(TokenKind.EOF)
+		macros = {alias: self.load(dep) for alias, dep in imports.items()}
+		return Macro(path, stamp, macros, self.flatten(labels, instrs, macros, path), labels, instrs)
+
+	def relink(self, macro : Macro) -> Macro:
+		''' `macro` flattened again from its parsed body, with its imports as they are now. '''
+		macros = {alias: self.load(dep.path) for alias, dep in macro.imports.items()}
+		return Macro(macro.path, macro.stamp, macros, self.flatten(macro.labels, macro.instrs, macros, macro.path),
+			macro.labels, macro.instrs)
+
+	def expand(self, regs : List[int], labels : Dict[str, int], instrs : List[Instr], imports : Dict[str, str]):
+		'''
+		Expand the macro calls of a parsed program. Labels and label targets
+		of the program itself are kept, with the labels moved to the
+		address of their statement.
+		:return: `(regs, labels, instrs)` without macro calls
+		'''
+		self.checked = set()
+		self.parsed = set()
+		self.relinked = set()
+		macros = {alias: self.load(path) for alias, path in imports.items()}
+		if not any(instr.opcode == Opcode.CALL for instr in instrs):
+			return regs, labels, instrs
+
+		starts = self.statement_starts(instrs, macros, None)
+		# expansion allocates millions of acyclic objects; without this the
+		# collector rescans them over and over
+		enabled = gc.isenabled()
+		gc.disable()
+		try:
+			out = self.flatten(labels, instrs, macros, None, starts)
+		finally:
+			if enabled:
+				gc.enable()
+		return regs, {label: starts[k] for label, k in labels.items()}, out
+
+	def callee(self, call : Instr, macros : Dict[str, Macro], source : Optional[str]) -> Macro:
+		name = call.params[0].value
+		if not name in macros:
+			raise Exception(f"undefined macro '{name}' ({where(source, call.line)})")
+		return macros[name]
+
+	def statement_starts(self, instrs : List[Instr], macros : Dict[str, Macro], source : Optional[str]) -> List[int]:
+		''' Address of every statement, followed by the size of the body. '''
+		starts = [0]
+		for instr in instrs:
+			size = len(self.callee(instr, macros, source)) if instr.opcode == Opcode.CALL else 1
+			starts.append(starts[-1] + size)
+		return starts
+
+	def flatten(self, labels : Dict[str, int], instrs : List[Instr], macros : Dict[str, Macro],
+			source : Optional[str], starts : Optional[List[int]] = None) -> List[Instr]:
+		'''
+		Expand the statements of a macro body (or of the program, when
+		`source` is None) into instructions with relocated targets.
+		'''
+		if starts is None:
+			starts = self.statement_starts(instrs, macros, source)
+
+		def target(token : Token) -> Token:
+			if token.kind == TokenKind.INTEGER:
+				if token.value < 0:
+					raise Exception(f"negative branch target {token.value} ({where(source, token.line)})")
+				return Token(TokenKind.INTEGER, starts[min(token.value, len(instrs))], token.line, token.col, token.length)
+			if token.kind == TokenKind.IDENTIFIER and source is not None and token.value != 'HALT':
+				if not token.value in labels:
+					raise Exception(f"undefined label '{token.value}' ({where(source, token.line)})")
+				return Token(TokenKind.INTEGER, starts[labels[token.value]], token.line, token.col, token.length)
+			return token
+
+		out : List[Instr] = []
+		for instr in instrs:
+			if instr.opcode == Opcode.DECJZ:
+				out.append(Instr(Opcode.DECJZ, [instr.params[0], target(instr.params[1])], instr.label, instr.line))
+			elif instr.opcode == Opcode.CALL:
+				args = [arg if arg.kind in (TokenKind.REGISTER, TokenKind.PARAM) else target(arg) for arg in instr.params[1:]]
+				start = len(out)
+				self.instantiate(self.callee(instr, macros, source), args, instr, out)
+				if instr.label is not None and len(out) > start:
+					out[start].label = instr.label
+			else:
+				out.append(instr)
+		if source is not None:
+			for instr in out:
+				instr.label = None
+		return out
+
+	def instantiate(self, macro : Macro, args : List[Token], call : Instr, out : List[Instr]):
+		'''
+		Append the template of `macro` at address `len(out)`, with the
+		params replaced by `args`.
+		'''
+		base = len(out)
+		alias = str(call.params[0].value)
+		line = call.line
+		origins = {None: alias}
+		# enum members are slow to look up, bind them once
+		INC, DECJZ, NOP = Opcode.INC, Opcode.DECJZ, Opcode.NOP
+		INTEGER, PARAM, REGISTER = TokenKind.INTEGER, TokenKind.PARAM, TokenKind.REGISTER
+
+		# params used as registers must get registers and vice versa
+		for instr in macro.template:
+			for i, token in enumerate(instr.params):
+				if token.kind != PARAM:
+					continue
+				if token.value >= len(args):
+					raise Exception(f"macro '{alias}' uses ${token.value} but is called with {len(args)} arguments (line {line+1})")
+				value = args[token.value]
+				if (i == 0) != (value.kind == REGISTER) and value.kind != PARAM:
+					raise Exception(f"macro '{alias}' expects a {'register' if i == 0 else 'branch target'} as ${token.value} (line {line+1})")
+
+		for instr in macro.template:
+			origin = origins.get(instr.macro)
+			if origin is None:
+				origin = origins[instr.macro] = alias + '>' + instr.macro
+			opcode = instr.opcode
+			if opcode is NOP:
+				out.append(Instr(NOP, [], None, line, origin))
+				continue
+			reg = instr.params[0]
+			if reg.kind is PARAM:
+				reg = args[reg.value]
+			if opcode is INC:
+				out.append(Instr(INC, [reg], None, line, origin))
+				continue
+			target = instr.params[1]
+			if target.kind is INTEGER:
+				target = Token(INTEGER, base + target.value, target.line, target.col, target.length)
+			elif target.kind is PARAM:
+				target = args[target.value]
+			out.append(Instr(DECJZ, [reg, target], None, line, origin))
+
+def where(source : Optional[str], line : int) -> str:
+	return f"line {line+1}" if source is None else f"{source} line {line+1}"
+
+# shared by every program parsed in this process
+expander = MacroExpander()
@@ -0,0 +1,201 @@
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from frontend import Token, TokenKind
+from link import resolve_target
+
+LEVELS = (0, 1, 2)
+
+class Optimizer:
+	'''
+	Peephole and control-flow passes over a parsed (and macro expanded)
+	program, run between the parser and linking.
+
+	-O1 removes `nop`s and jumps to the next instruction, threads jumps
+	through unconditional jumps and removes unreachable code. -O2 also
+	fuses runs of `inc r` into one `add r n`.
+
+	A `decjz` on a negative register that is never incremented is an
+	unconditional jump (the `GOTO` macro jumps on r-1). Only such registers
+	are relied on: they are zero for every `registers` line and never
+	printed, so the final registers are the same as without optimizing.
+	The step count shrinks by the steps of the removed instructions.
+	'''
+	def __init__(self, level : int):
+		self.level = level
+		self.stats : Dict[str, int] = {
+			'nops removed': 0,
+			'jumps removed': 0,
+			'jumps threaded': 0,
+			'dead instructions removed': 0,
+			'incs fused': 0,
+		}
+		self.before = 0
+		self.after = 0
+
+	def optimize(self, regs : List[int], labels : Dict[str, int], instrs : List[Instr]):
+		'''
+		:return: the optimized `(regs, labels, instrs)`; branch targets of
+		         the new instructions are addresses
+		'''
+		self.before = self.after = len(instrs)
+		if self.level == 0:
+			return regs, labels, instrs
+
+		n = len(instrs)
+		# one [opcode, register, target or amount, original instruction] per pc
+		code = []
+		for instr in instrs:
+			reg = instr.params[0].value if instr.opcode != Opcode.NOP else None
+			if instr.opcode == Opcode.DECJZ:
+				arg = resolve_target(instr.params[1].value, labels, n)
+			elif instr.opcode == Opcode.ADD:
+				arg = instr.params[1].value
+			else:
+				arg = None
+			code.append([instr.opcode, reg, arg, instr])
+		labels = {label: pc for label, pc in labels.items() if label != 'HALT'}
+
+		incremented = set(reg for op, reg, _, _ in code if op == Opcode.INC or op == Opcode.ADD)
+		self.zeros = set(reg for op, reg, _, _ in code if op == Opcode.DECJZ and reg < 0 and not reg in incremented)
+
+		changed = True
+		while changed:
+			self.thread_jumps(code)
+			removed = self.stats['nops removed'] + self.stats['jumps removed'] + self.stats['dead instructions removed']
+			code, labels = self.compact(code, labels, self.useless(code))
+			code, labels = self.compact(code, labels, self.reachable(code))
+			changed = removed != self.stats['nops removed'] + self.stats['jumps removed'] + self.stats['dead instructions removed']
+		if self.level >= 2:
+			code, labels = self.compact(code, labels, self.fuse_incs(code, labels))
+
+		self.after = len(code)
+		return regs, labels, self.to_instrs(code, labels)
+
+	def is_jump(self, entry) -> bool:
+		''' Whether `entry` is an unconditional jump. '''
+		return entry[0] == Opcode.DECJZ and entry[1] in self.zeros
+
+	def thread_jumps(self, code):
+		''' Let every `decjz` jump past the nops and unconditional jumps it lands on. '''
+		n = len(code)
+		for entry in code:
+			if entry[0] != Opcode.DECJZ:
+				continue
+			target = entry[2]
+			seen = set()
+			while target < n and not target in seen:
+				seen.add(target)
+				if code[target][0] == Opcode.NOP:
+					target += 1
+				elif self.is_jump(code[target]):
+					target = code[target][2]
+				else:
+					break
+			if target != entry[2] and not target in seen:
+				entry[2] = target
+				self.stats['jumps threaded'] += 1
+
+	def useless(self, code) -> List[bool]:
+		''' Keep everything but nops and unconditional jumps to the next instruction. '''
+		keep = []
+		for pc, entry in enumerate(code):
+			if entry[0] == Opcode.NOP:
+				self.stats['nops removed'] += 1
+				keep.append(False)
+			elif self.is_jump(entry) and entry[2] == pc + 1:
+				self.stats['jumps removed'] += 1
+				keep.append(False)
+			else:
+				keep.append(True)
+		return keep
+
+	def reachable(self, code) -> List[bool]:
+		''' Keep the instructions reachable from pc 0. '''
+		n = len(code)
+		keep = [False] * n
+		todo = [0]
+		while todo:
+			pc = todo.pop()
+			if pc >= n or keep[pc]:
+				continue
+			keep[pc] = True
+			if code[pc][0] == Opcode.DECJZ:
+				todo.append(code[pc][2])
+				if self.is_jump(code[pc]):
+					continue
+			todo.append(pc + 1)
+		self.stats['dead instructions removed'] += keep.count(False)
+		return keep
+
+	def fuse_incs(self, code, labels : Dict[str, int]) -> List[bool]:
+		'''
+		Turn every run of `inc`/`add` on one register that is only entered at
+		its first instruction into a single `add`.
+		'''
+		entries = set(entry[2] for entry in code if entry[0] == Opcode.DECJZ) | set(labels.values())
+		keep = [True] * len(code)
+		run = None
+		for pc, entry in enumerate(code):
+			op = entry[0]
+			if op != Opcode.INC and op != Opcode.ADD:
+				run = None
+				continue
+			if run is not None and code[run][1] == entry[1] and not pc in entries:
+				head = code[run]
+				head[2] = (1 if head[0] == Opcode.INC else head[2]) + (1 if op == Opcode.INC else entry[2])
+				head[0] = Opcode.ADD
+				keep[pc] = False
+				self.stats['incs fused'] += 1
+			else:
+				run = pc
+		return keep
+
+	def compact(self, code, labels : Dict[str, int], keep : List[bool]):
+		'''
+		Drop the instructions not kept. Branches and labels to a dropped
+		instruction move to the next kept one.
+		'''
+		if all(keep):
+			return code, labels
+		new_pc = [0] * (len(code) + 1)
+		count = 0
+		for pc in range(len(code)):
+			new_pc[pc] = count
+			count += keep[pc]
+		new_pc[len(code)] = count
+
+		ret = []
+		for pc, entry in enumerate(code):
+			if not keep[pc]:
+				continue
+			if entry[0] == Opcode.DECJZ:
+				entry[2] = new_pc[entry[2]]
+			ret.append(entry)
+		return ret, {label: new_pc[pc] for label, pc in labels.items()}
+
+	def to_instrs(self, code, labels : Dict[str, int]) -> List[Instr]:
+		label_at = {}
+		for label, pc in labels.items():
+			label_at.setdefault(pc, label)
+		instrs = []
+		for pc, (op, reg, arg, orig) in enumerate(code):
+			if op == Opcode.NOP:
+				params = []
+			elif op == Opcode.INC:
+				params = [orig.params[0]]
+			else:
+				reg = orig.params[0]
+				params = [reg, Token(TokenKind.INTEGER, arg, reg.line)]
+			instrs.append(Instr(op, params, label_at.get(pc), orig.line, orig.macro))
+		return instrs
+
+	def report(self, f):
+		f.write(f"optimizer -O{self.level}: {self.before} -> {self.after} instructions\n")
+		for name, count in self.stats.items():
+			if count > 0:
+				f.write(f"  {name:<26} {count:>8}\n")
+
+def optimize(regs : List[int], labels : Dict[str, int], instrs : List[Instr], level : int):
+	''' `Optimizer(level).optimize(...)` '''
+	return Optimizer(level).optimize(regs, labels, instrs)
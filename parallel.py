@@ -0,0 +1,164 @@
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from link import *
+from loops import program_transfer_loops
+from threaded import decode, run_guarded
+from watchdog import Budget, HALTED
+
+# runs per task sent to a worker; tiny machines finish in microseconds, so
+# shipping them one by one would cost more than running them
+CHUNK_SIZE = 64
+
+class Job:
+	'''
+	A linked program together with the transfer loops that are valid for
+	every input of a given width, computed once per width, and its decoded
+	code per width, kept by each process that runs it.
+	'''
+	def __init__(self, path : str, program : Program):
+		self.path = path
+		self.program = program
+		self.loops_by_width : Dict[int, Dict] = {}
+		self.decoded_by_width : Dict[Tuple[int, bool], Tuple] = {}
+
+	def __getstate__(self):
+		# cheaper to decode again than to ship
+		state = dict(self.__dict__)
+		state['decoded_by_width'] = {}
+		return state
+
+	def loops(self, width : int):
+		if not width in self.loops_by_width:
+			self.loops_by_width[width] = program_transfer_loops(self.program, width)
+		return self.loops_by_width[width]
+
+	def decoded(self, width : int, accelerate : bool):
+		''' `decode` of the program for runs on `width` input registers, see `run_guarded`. '''
+		key = (width, accelerate)
+		if not key in self.decoded_by_width:
+			_, touched, _ = self.program.bind([0] * width)
+			self.decoded_by_width[key] = decode(self.program, self.loops(width) if accelerate else {}, touched)
+		return self.decoded_by_width[key]
+
+# the jobs of a worker process, installed once by init_worker
+worker_jobs : List[Job] = []
+
+def init_worker(jobs : List[Job]):
+	global worker_jobs
+	worker_jobs = jobs
+
+# the jobs a worker of the server was sent, by the server's key of the
+# program, least recently run first; at most installed_size of them
+installed_jobs : 'OrderedDict[str, Job]' = OrderedDict()
+installed_size = 0
+
+def init_installed(size : int):
+	global installed_size
+	installed_size = size
+
+def run_installed(key : str, regs : List[int], budget : Optional[Budget], accelerate : bool,
+		job : Optional[Job] = None) -> Optional[Dict[str, Any]]:
+	'''
+	`run_one` of the job installed under `key`, after installing `job` if
+	given. None if this worker has no job under `key`: the caller sends it
+	again with the job.
+	'''
+	if job is not None:
+		installed_jobs[key] = job
+		while len(installed_jobs) > installed_size:
+			installed_jobs.popitem(last=False)
+	job = installed_jobs.get(key)
+	if job is None:
+		return None
+	installed_jobs.move_to_end(key)
+	return run_one(job, regs, budget, accelerate)
+
+def run_one(job : Job, regs : List[int], budget : Optional[Budget], accelerate : bool) -> Dict[str, Any]:
+	start = time.perf_counter()
+	values, steps, pc, status, pcs = run_guarded(job.program, regs, job.loops(len(regs)) if accelerate else {}, budget,
+		decoded=job.decoded(len(regs), accelerate))
+	result = {
+		'registers': [values.get(addr, 0) for addr in range(max(values.keys(), default=-1) + 1)],
+		'steps': steps,
+		'status': status,
+		'pc': pc,
+		'seconds': time.perf_counter() - start,
+	}
+	if status != HALTED:
+		result['pcs'] = list(pcs)
+	return result
+
+def run_chunk(tasks : List[Tuple[int, int, List[int]]], budget : Optional[Budget], accelerate : bool) -> List[Dict[str, Any]]:
+	results = []
+	for job_index, input_index, regs in tasks:
+		job = worker_jobs[job_index]
+		result = {'program': job.path, 'input': input_index}
+		result.update(run_one(job, regs, budget, accelerate))
+		results.append(result)
+	return results
+
+class ParallelRunner:
+	'''
+	Runs every program of `jobs` on every register vector of `inputs` (or on
+	its own `registers` line) across a process pool, each run within
+	`budget`. Programs are parsed and linked once in the parent and handed to
+	each worker once; results are yielded as chunks of runs finish, not in
+	submission order.
+	'''
+	def __init__(self, jobs : List[Job], inputs : Optional[List[List[int]]] = None,
+			workers : Optional[int] = None, budget : Optional[Budget] = None, accelerate=True):
+		self.jobs = jobs
+		self.inputs = inputs
+		self.workers = workers or os.cpu_count() or 1
+		self.budget = budget
+		self.accelerate = accelerate
+
+	def tasks(self):
+		for job_index, job in enumerate(self.jobs):
+			if self.inputs is None:
+				yield (job_index, 0, job.program.regs)
+			else:
+				for input_index, regs in enumerate(self.inputs):
+					yield (job_index, input_index, regs)
+
+	def chunks(self):
+		chunk = []
+		for task in self.tasks():
+			chunk.append(task)
+			if len(chunk) == CHUNK_SIZE:
+				yield chunk
+				chunk = []
+		if len(chunk) > 0:
+			yield chunk
+
+	def run(self):
+		# keep a bounded number of chunks in flight so huge suites are
+		# never materialized at once
+		max_pending = self.workers * 4
+		with ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.jobs,)) as executor:
+			pending = set()
+			for chunk in self.chunks():
+				pending.add(executor.submit(run_chunk, chunk, self.budget, self.accelerate))
+				if len(pending) >= max_pending:
+					done, pending = wait(pending, return_when=FIRST_COMPLETED)
+					for future in done:
+						yield from future.result()
+			while len(pending) > 0:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					yield from future.result()
+
+def write_jsonl(results, f=sys.stdout):
+	'''
+	Stream results as one JSON object per line as they arrive.
+	'''
+	for result in results:
+		f.write(json.dumps(result) + '\n')
+		f.flush()
@@ -1,32 +1,59 @@
 import io
-import os
 from typing import List
 
 from frontend import Lexer, Parser, TokenKind, Token
+from link import link
+from macro import expander
+from optimize import optimize
+from scan import scan_program
 
-def pre_process(f, replace_label_with_addr=False):
+def pre_process(f):
+    """ Read the `import "..." as ALIAS` header of a program.
+    :return: the lines of the program without the header, a stream of
+             them, and alias -> path of the imported macro files
+    """
     lines = f.readlines()
     stream = io.StringIO(''.join(lines))
     parser = Parser(Lexer(stream))
-    alias_macro_map = {}
-    
-    # read all lines starting with "IMPORT"
-    # and also read macros
-    while parser.check(TokenKind.IMPORT):
-        parser.match(TokenKind.IMPORT)
-        dir = parser.match(TokenKind.DIRECTORY).value
-        parser.match(TokenKind.AS)
-        alias = parser.match(TokenKind.IDENTIFIER).value
-        parser.match(TokenKind.NEWLINE)
-
-        if not os.path.isabs(dir):
-            dir = os.path.join(os.getcwd(), dir)
-        macro_content,_,_ = pre_process(open(dir,mode='r'), replace_label_with_addr=True)
-        alias_macro_map[alias] = (dir,macro_content)
-    
-    # chop off import haeding
+    alias_macro_map = parser.parse_imports()
+
+    # chop off import heading
     line_of_registers_symbol = parser.lexer.peek().line
     lines = lines[line_of_registers_symbol:]
-        
+
     return lines, io.StringIO(''.join(lines)), alias_macro_map
 
+def parse_source(f):
+    """ Parse a program and expand its macro calls.
+    :return: `(regs, labels, instrs)` and alias -> path of its imports
+    """
+    parser = Parser(Lexer(f))
+    alias_macro_map = parser.parse_imports()
+    regs, labels, instrs = parser.parse_input()
+    return expander.expand(regs, labels, instrs, alias_macro_map), alias_macro_map
+
+def parse_file(path):
+    """ Parse the program at `path` and expand its macro calls.
+    :return: `(regs, labels, instrs)` and the macros it imports
+    """
+    with open(path, mode='r') as f:
+        return parse_source(f)
+
+def link_file(path, level=0):
+    """ Pre-process, parse, optimize at -O`level` and link the program at `path`.
+    Plain programs are linked straight from the file by scan.py.
+    :return: a link.Program and the macros it imports
+    """
+    if level == 0:
+        with open(path, mode='r') as f:
+            program = scan_program(f)
+        if program is not None:
+            return program, {}
+    program, alias_macro_map = parse_file(path)
+    return link(*optimize(*program, level)), alias_macro_map
+
+def load_program(path, cache=None, level=0):
+    """ `link_file`, through `cache` (a cache.ProgramCache) if given. """
+    if cache is None:
+        return link_file(path, level)
+    return cache.load(path, lambda path: link_file(path, level), f"O{level}")
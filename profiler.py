@@ -0,0 +1,145 @@
+import json
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from link import *
+from loops import TransferLoop
+from estimate import Estimator
+
+class Profile:
+	'''
+	Execution counts of one run: how often every instruction was executed,
+	how often every `decjz` jumped, and the total number of steps. Transfer
+	loops executed in one step are counted as if run step by step.
+	'''
+	def __init__(self, program : Program, counts : List[int], taken : List[int], steps : int,
+			loops : Dict[int, TransferLoop] = {}):
+		self.program = program
+		self.counts = counts
+		self.taken = taken
+		self.steps = steps
+		self.loops = loops
+
+	@classmethod
+	def from_blocks(cls, program : Program, blocks, visits : List[int], taken : List[int], steps : int,
+			loops : Dict[int, TransferLoop] = {}):
+		''' Counts from the block counters of the compiled engine. '''
+		counts = [0] * len(program)
+		taken_at = [0] * len(program)
+		for block in blocks:
+			for pc in range(block.start, block.end):
+				counts[pc] = visits[block.id]
+			if program.ops[block.end - 1] == OP_DECJZ:
+				taken_at[block.end - 1] = taken[block.id]
+		return cls(program, counts, taken_at, steps, loops)
+
+	def instructions(self) -> List[Dict[str, Any]]:
+		''' One record per instruction, in program order. '''
+		program = self.program
+		label_at = program.label_at()
+		ret = []
+		for pc in range(len(program)):
+			is_decjz = program.ops[pc] == OP_DECJZ
+			ret.append({
+				'pc': pc,
+				'line': program.lines[pc] + 1,
+				'label': label_at.get(pc),
+				'macro': program.macros[pc],
+				'instruction': program.disassemble(pc, label_at),
+				'count': self.counts[pc],
+				'taken': self.taken[pc] if is_decjz else None,
+				'not_taken': self.counts[pc] - self.taken[pc] if is_decjz else None,
+			})
+		return ret
+
+	def hot_loops(self) -> List[Dict[str, Any]]:
+		'''
+		Every loop that iterated, most steps first. A loop is the natural
+		loop of a header in the control-flow graph of `estimate.Estimator`:
+		the pcs that reach one of its back edges without passing through
+		the header. Its steps are summed over those pcs (the span `start`..
+		`end` may include pcs outside it) and its iterations are the times a
+		back edge was taken. If the graph is irreducible, which has no
+		natural loops, every backward `decjz` that jumped is reported as
+		the span from its target to itself.
+		'''
+		program = self.program
+		estimator = Estimator(program)
+		if estimator.irreducible:
+			loops = [(program.targets[pc], set(range(program.targets[pc], pc + 1)))
+				for pc in range(len(program)) if program.ops[pc] == OP_DECJZ and program.targets[pc] <= pc]
+		else:
+			loops = [(loop.header, loop.body) for loop in estimator.loops]
+
+		label_at = program.label_at()
+		ret = []
+		for start, body in loops:
+			iterations = sum(self.edge_count(u, start) for u in body)
+			if iterations == 0:
+				continue
+			ret.append({
+				'start': start,
+				'end': max(body),
+				'size': len(body),
+				'line': program.lines[start] + 1,
+				'label': label_at.get(start),
+				'macro': program.macros[start],
+				'iterations': iterations,
+				'steps': sum(self.counts[pc] for pc in body),
+				'accelerated': start in self.loops,
+			})
+		ret.sort(key=lambda loop: (-loop['steps'], loop['start']))
+		return ret
+
+	def edge_count(self, u : int, v : int) -> int:
+		''' How often the run went from pc `u` to pc `v`. '''
+		program = self.program
+		if program.ops[u] != OP_DECJZ:
+			return self.counts[u] if v == u + 1 else 0
+		ret = self.taken[u] if program.targets[u] == v else 0
+		if v == u + 1:
+			ret += self.counts[u] - self.taken[u]
+		return ret
+
+	def to_json(self) -> Dict[str, Any]:
+		return {
+			'steps': self.steps,
+			'instructions': self.instructions(),
+			'loops': self.hot_loops(),
+		}
+
+	def dump(self, path : str):
+		with open(path, mode='w') as f:
+			json.dump(self.to_json(), f, indent=1)
+			f.write('\n')
+
+	def report(self, f, top : int = 20):
+		'''
+		Print the `top` most executed instructions and hottest loops.
+		'''
+		def share(count):
+			return f"{100 * count / self.steps:6.2f}%" if self.steps > 0 else "      -"
+
+		def where(record):
+			ret = f"{record['line']:>5}  {record['label'] or '':<12}"
+			return ret + (f"  [{record['macro']}]" if record['macro'] is not None else "")
+
+		f.write(f"steps {self.steps}\n\n")
+		f.write(f"{'count':>12} {'share':>7} {'pc':>6}  {'instruction':<20} {'taken':>10} {'not taken':>10}  {'line':>5}  {'label':<12}  macro\n")
+		instrs = sorted(self.instructions(), key=lambda r: (-r['count'], r['pc']))
+		for r in instrs[:top]:
+			taken = '' if r['taken'] is None else r['taken']
+			not_taken = '' if r['not_taken'] is None else r['not_taken']
+			f.write(f"{r['count']:>12} {share(r['count'])} {r['pc']:>6}  {r['instruction']:<20} {taken:>10} {not_taken:>10}  {where(r)}\n")
+		if len(instrs) > top:
+			f.write(f"{'':>12} ({len(instrs) - top} more)\n")
+
+		loops = self.hot_loops()
+		if len(loops) == 0:
+			return
+		f.write(f"\n{'steps':>12} {'share':>7} {'loop':>13}  {'iterations':>10}  {'accel':<5}  {'line':>5}  {'label':<12}  macro\n")
+		for r in loops[:top]:
+			span = f"{r['start']}..{r['end']}"
+			accel = 'yes' if r['accelerated'] else ''
+			f.write(f"{r['steps']:>12} {share(r['steps'])} {span:>13}  {r['iterations']:>10}  {accel:<5}  {where(r)}\n")
+		if len(loops) > top:
+			f.write(f"{'':>12} ({len(loops) - top} more)\n")
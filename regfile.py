@@ -0,0 +1,213 @@
+from collections.abc import Mapping, MutableMapping
+from typing import Any, List, Union, Optional, Tuple, Dict, Iterator
+
+# registers 0..DENSE_LIMIT-1 live in a list, all others in a dict
+DENSE_LIMIT = 1 << 16
+# registers formatted per write
+CHUNK = 4096
+
+# output formats of `write_regs`
+FORMATS = ('text', 'sparse', 'json', 'binary')
+
+# first line of a binary register dump; bump the number whenever the format changes
+MAGIC = b"rmsim-regs 1\n"
+
+class RegisterFile(MutableMapping):
+	'''
+	The registers of a run by address. Only touched registers (those of the
+	`registers` line and those an executed instruction used) are in the
+	file; reading another one raises KeyError, `load` and `add` touch it.
+
+	Low addresses are kept in a dense list (None for untouched), high ones
+	and negative scratch registers like `r-1` in a dict, so `r1000000`
+	costs one entry. Registers are iterated in address order, negative ones
+	last (r-1, r-2, ...).
+	'''
+	def __init__(self, regs : Union[List[int], Mapping, None] = None):
+		self.dense : List[Optional[int]] = []
+		self.sparse : Dict[int, int] = {}
+		if regs is not None:
+			self.update(regs if isinstance(regs, Mapping) else dict(enumerate(regs)))
+
+	def load(self, addr : int) -> int:
+		''' The value of register `addr`, touching it. '''
+		dense = self.dense
+		if 0 <= addr < len(dense):
+			value = dense[addr]
+			if value is None:
+				dense[addr] = value = 0
+			return value
+		value = self.sparse.get(addr)
+		if value is None:
+			self[addr] = value = 0
+		return value
+
+	def add(self, addr : int, k : int):
+		''' Add `k` to register `addr`, touching it. '''
+		dense = self.dense
+		if 0 <= addr < len(dense) and dense[addr] is not None:
+			dense[addr] += k
+		else:
+			self[addr] = self.get(addr, 0) + k
+
+	def top(self) -> int:
+		''' The highest non-negative touched address, -1 if there is none. '''
+		high = [addr for addr in self.sparse if addr >= 0]
+		if high:
+			return max(high)
+		dense = self.dense
+		for addr in range(len(dense) - 1, -1, -1):
+			if dense[addr] is not None:
+				return addr
+		return -1
+
+	def values_in(self, start : int, stop : int) -> List[int]:
+		''' The values of registers `start..stop-1`, 0 for untouched ones. '''
+		split = max(start, min(stop, DENSE_LIMIT))
+		values = [0 if value is None else value for value in self.dense[start:split]]
+		values.extend([0] * (split - start - len(values)))
+		if stop > split:
+			get = self.sparse.get
+			values.extend(get(addr, 0) for addr in range(split, stop))
+		return values
+
+	def __getitem__(self, addr : int) -> int:
+		if 0 <= addr < len(self.dense):
+			value = self.dense[addr]
+			if value is not None:
+				return value
+			raise KeyError(addr)
+		return self.sparse[addr]
+
+	def __setitem__(self, addr : int, value : int):
+		if 0 <= addr < DENSE_LIMIT:
+			dense = self.dense
+			if addr >= len(dense):
+				dense.extend([None] * (addr + 1 - len(dense)))
+			dense[addr] = value
+		else:
+			self.sparse[addr] = value
+
+	def __delitem__(self, addr : int):
+		if 0 <= addr < len(self.dense):
+			if self.dense[addr] is None:
+				raise KeyError(addr)
+			self.dense[addr] = None
+		else:
+			del self.sparse[addr]
+
+	def __contains__(self, addr) -> bool:
+		if type(addr) is int and 0 <= addr < len(self.dense):
+			return self.dense[addr] is not None
+		return addr in self.sparse
+
+	def __iter__(self) -> Iterator[int]:
+		for addr, value in enumerate(self.dense):
+			if value is not None:
+				yield addr
+		yield from sorted(addr for addr in self.sparse if addr >= 0)
+		yield from sorted((addr for addr in self.sparse if addr < 0), reverse=True)
+
+	def __len__(self) -> int:
+		return len(self.dense) - self.dense.count(None) + len(self.sparse)
+
+	def copy(self) -> 'RegisterFile':
+		ret = RegisterFile()
+		ret.dense = list(self.dense)
+		ret.sparse = dict(self.sparse)
+		return ret
+
+	def __repr__(self) -> str:
+		return f"RegisterFile({dict(self.items())})"
+
+def write_regs(f, regs : Mapping, format : str = 'text'):
+	'''
+	Write the registers `regs` (by address) to the text stream `f`, in
+	pieces of CHUNK registers:
+
+	text    `registers r0 r1 ...`, every register from r0 to the highest
+	        touched one, 0 if untouched
+	sparse  `registers r0=.. r114=..`, only the touched registers
+	json    `{"registers": {"0": .., "114": ..}}`
+	binary  MAGIC, then per touched register the address (difference to
+	        the previous one) and the value as variable-length integers;
+	        written to `f.buffer` for a text stream, see `read_regs`
+
+	Negative scratch registers are left out of every format: optimize.py
+	drops jumps on them, so whether they were touched depends on -O.
+	'''
+	if not isinstance(regs, RegisterFile):
+		regs = RegisterFile(regs)
+	if format == 'text':
+		top = regs.top()
+		f.write("registers ")
+		for start in range(0, top + 1, CHUNK):
+			stop = min(start + CHUNK, top + 1)
+			f.write(" ".join(map(str, regs.values_in(start, stop))) + (" " if stop <= top else ""))
+		f.write("\n")
+	elif format == 'sparse':
+		f.write("registers")
+		for items in chunks(printed(regs)):
+			f.write("".join(f" r{addr}={value}" for addr, value in items))
+		f.write("\n")
+	elif format == 'json':
+		import json
+		f.write('{"registers": {')
+		sep = ""
+		for items in chunks(printed(regs)):
+			f.write(sep + ", ".join(f'"{addr}": {json.dumps(value)}' for addr, value in items))
+			sep = ", "
+		f.write("}}\n")
+	elif format == 'binary':
+		from tracing import BUFFER_BYTES, put_signed
+		if hasattr(f, 'buffer'):
+			f.flush()
+			f = f.buffer
+		out = bytearray(MAGIC)
+		last = 0
+		for addr, value in printed(regs):
+			put_signed(out, addr - last)
+			put_signed(out, value)
+			last = addr
+			if len(out) >= BUFFER_BYTES:
+				f.write(out)
+				out.clear()
+		f.write(out)
+		f.flush()
+	else:
+		raise Exception(f"unknown register format '{format}'")
+
+def printed(regs : RegisterFile) -> Iterator[Tuple[int, int]]:
+	''' The touched registers that are printed, in address order. '''
+	for addr, value in regs.items():
+		if addr < 0:
+			# negative ones come last
+			return
+		yield addr, value
+
+def chunks(items) -> Iterator[List[Tuple[int, int]]]:
+	chunk = []
+	for item in items:
+		chunk.append(item)
+		if len(chunk) == CHUNK:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def read_regs(path : str) -> RegisterFile:
+	''' The registers of a binary dump of `write_regs`. '''
+	from tracing import get_signed
+	with open(path, mode='rb') as f:
+		data = f.read()
+	if not data.startswith(MAGIC):
+		raise Exception(f"{path}: not an rmsim register dump")
+	regs = RegisterFile()
+	pos = len(MAGIC)
+	addr = 0
+	while pos < len(data):
+		delta, pos = get_signed(data, pos)
+		value, pos = get_signed(data, pos)
+		addr += delta
+		regs[addr] = value
+	return regs
@@ -0,0 +1,128 @@
+import re
+from array import array
+from typing import Any, List, Union, Optional, Tuple, Dict, Iterable
+
+from frontend import KEYWORDS
+from link import *
+
+# the pieces of frontend.TOKEN_RE a plain program is made of
+BLANK = r'[^\S\r\n]'
+NAME = r'(?:[^\W\d]|\$)[\w/-]*'
+END = rf'{BLANK}*(?:\#[^\r\n]*)?\n?'
+
+EMPTY_RE = re.compile(END)
+REGISTERS_RE = re.compile(rf'{BLANK}*registers(?P<values>(?:{BLANK}+-?\d+)*){END}')
+INSTR_RE = re.compile(rf'''{BLANK}*(?:(?P<label>{NAME}){BLANK}*:{BLANK}*)?
+	(?: (?P<op>inc|decjz){BLANK}+r(?P<reg>-?\d+)(?:{BLANK}+(?P<target>{NAME}|\d+))?
+	  | (?P<nop>nop)
+	){END}''', re.VERBOSE)
+# names the tokenizer reads as registers or macro parameters
+NOT_NAME_RE = re.compile(r'r-?\d+|\$\d+')
+
+def is_name(text : str) -> bool:
+	''' Whether the tokenizer reads `text` as an identifier. '''
+	return not text in KEYWORDS and NOT_NAME_RE.fullmatch(text) is None
+
+def scan_program(lines : Iterable[str]) -> Optional[Program]:
+	'''
+	Link a plain program straight from its `lines` (a file or any iterable
+	of lines), without tokens or `Instr` objects: every line is matched
+	against one pattern and appended to the arrays of the `Program`, and
+	only label targets are kept aside until the end. Memory stays a small
+	multiple of the instruction count, whatever the size of the source.
+
+	Return None for anything but a `registers` line followed by one
+	`inc`, `decjz` or `nop` per line (imports, macro calls, unusual
+	layouts and errors), which the parser has to handle. The result is
+	the `Program` link() makes of the parser output, without `instrs`.
+	'''
+	regs = None
+	ops, slots, targets, line_nos = array('b'), array('l'), array('l'), array('l')
+	slot_map : Dict[int, int] = {}
+	addrs : List[int] = []
+	init : List[int] = []
+	labels : Dict[str, int] = {}
+	# label targets are stored as -1-id until every label is known
+	label_ids : Dict[str, int] = {}
+	label_names : List[str] = []
+
+	match = INSTR_RE.fullmatch
+	for line_no, line in enumerate(lines):
+		if regs is None:
+			if EMPTY_RE.fullmatch(line):
+				continue
+			m = REGISTERS_RE.fullmatch(line)
+			if m is None:
+				return None
+			regs = [int(value) for value in m.group('values').split()]
+			for addr, value in enumerate(regs):
+				slot_map[addr] = addr
+				addrs.append(addr)
+				init.append(value)
+			continue
+
+		m = match(line)
+		if m is None:
+			if EMPTY_RE.fullmatch(line):
+				continue
+			return None
+		label, op, reg, target, _ = m.groups()
+		if label is not None:
+			if not is_name(label) or label in labels:
+				return None
+			labels[label] = len(ops)
+		line_nos.append(line_no)
+		if op is None:
+			ops.append(OP_NOP)
+			slots.append(0)
+			targets.append(0)
+			continue
+
+		addr = int(reg)
+		slot = slot_map.get(addr)
+		if slot is None:
+			slot = slot_map[addr] = len(addrs)
+			addrs.append(addr)
+			init.append(0)
+		slots.append(slot)
+		if op == 'inc':
+			if target is not None:
+				return None
+			ops.append(OP_INC)
+			targets.append(0)
+		else:
+			if target is None:
+				return None
+			ops.append(OP_DECJZ)
+			if target[0].isdigit():
+				targets.append(int(target))
+			elif is_name(target):
+				if not target in label_ids:
+					label_ids[target] = len(label_names)
+					label_names.append(target)
+				targets.append(-1 - label_ids[target])
+			else:
+				return None
+
+	if regs is None:
+		return None
+	n = len(ops)
+	for pc in range(n):
+		if ops[pc] != OP_DECJZ:
+			continue
+		target = targets[pc]
+		if target >= 0:
+			targets[pc] = min(target, n)
+			continue
+		name = label_names[-1 - target]
+		if name == 'HALT':
+			targets[pc] = n
+		elif name in labels:
+			targets[pc] = labels[name]
+		else:
+			raise Exception(f"undefined label '{name}' (line {line_nos[pc] + 1})")
+
+	ops.append(OP_HALT)
+	slots.append(0)
+	targets.append(0)
+	return Program(ops, slots, targets, addrs, init, len(regs), None, labels, line_nos, [None] * n)
@@ -0,0 +1,429 @@
+import ast
+import itertools
+import multiprocessing
+import os
+import random
+import re
+import time
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, List, Union, Optional, Tuple, Dict, Iterator
+
+import parallel
+from checkpoint import program_hash
+from link import *
+from parallel import CHUNK_SIZE, Job, init_worker, run_one
+from watchdog import Budget, HALTED
+
+# largest value of an input register when no range is given
+DEFAULT_BOUND = 15
+# step budget of every run unless another is given
+DEFAULT_MAX_STEPS = 1_000_000
+# (program hash, registers) pairs remembered
+DEFAULT_MEMO_SIZE = 1 << 18
+# the inputs every mutant is checked on are kept in memory, so there can't
+# be too many of them
+MAX_MUTANT_INPUTS = 100_000
+
+COUNTEREXAMPLE = 'counterexample'
+MATCH = 'match'
+
+EXPECT_RE = re.compile(r'\s*r(\d+)\s*=(?!=)(.*)', re.DOTALL)
+RANGE_RE = re.compile(r'\s*(\d+)\s*(?:\.\.\s*(\d+)\s*)?')
+REGISTER_RE = re.compile(r'r(\d+)')
+
+# what an expected value may be made of
+EXPR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Call, ast.Load,
+	ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd)
+EXPR_FUNCTIONS = {'min': min, 'max': max, 'abs': abs}
+
+class Expect:
+	'''
+	`rK=EXPR`: register K ends up holding EXPR, an integer expression over
+	the input registers r0, r1, ... with `+ - * // % **`, parentheses,
+	`min`, `max` and `abs`.
+	'''
+	def __init__(self, text : str):
+		m = EXPECT_RE.fullmatch(text)
+		if m is None:
+			raise Exception(f"--expect '{text}': expected rK=EXPR")
+		self.text = text.strip()
+		self.register = int(m.group(1))
+		try:
+			tree = ast.parse(m.group(2).strip(), mode='eval')
+		except SyntaxError:
+			raise Exception(f"--expect '{text}': not an expression")
+		for node in ast.walk(tree):
+			if not isinstance(node, EXPR_NODES) or \
+					isinstance(node, ast.Constant) and type(node.value) is not int or \
+					isinstance(node, ast.Name) and not node.id in EXPR_FUNCTIONS and REGISTER_RE.fullmatch(node.id) is None or \
+					isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or not node.func.id in EXPR_FUNCTIONS):
+				raise Exception(f"--expect '{text}': only integers, input registers rN, + - * // % **, min, max and abs are allowed")
+		self.code = compile(tree, '<expect>', 'eval')
+		self.inputs = sorted({int(node.id[1:]) for node in ast.walk(tree)
+			if isinstance(node, ast.Name) and not node.id in EXPR_FUNCTIONS})
+
+	def value(self, regs : List[int]) -> int:
+		''' The expected value for the input `regs`. '''
+		names = {f"r{addr}": regs[addr] if addr < len(regs) else 0 for addr in self.inputs}
+		names.update(EXPR_FUNCTIONS)
+		return eval(self.code, {'__builtins__': {}}, names)
+
+class Spec:
+	'''
+	What a run must do: halt within the budget and leave every register
+	of `expects` at its expected value.
+	'''
+	def __init__(self, expects : List[Expect]):
+		self.expects = expects
+
+	def check(self, regs : List[int], result : Dict[str, Any]) -> Tuple[bool, Dict[str, int]]:
+		''' Whether `result`, the run on `regs`, meets the spec, and the expected values. '''
+		expected = {}
+		ok = result['status'] == HALTED
+		out = result['registers']
+		for expect in self.expects:
+			try:
+				value = expect.value(regs)
+			except (ArithmeticError, ValueError):
+				# no value to compare with, e.g. a division by zero
+				continue
+			expected[f"r{expect.register}"] = value
+			if (out[expect.register] if expect.register < len(out) else 0) != value:
+				ok = False
+		return ok, expected
+
+class InputSpace:
+	'''
+	The input register vectors of a search: register N takes every value
+	of `ranges[N]`.
+	'''
+	def __init__(self, ranges : List[range]):
+		self.ranges = ranges
+
+	def __len__(self) -> int:
+		size = 1
+		for values in self.ranges:
+			size *= len(values)
+		return size
+
+	def __iter__(self) -> Iterator[List[int]]:
+		for regs in itertools.product(*self.ranges):
+			yield list(regs)
+
+	def sample(self, rng : random.Random, count : int) -> Iterator[List[int]]:
+		''' `count` vectors drawn at random, repeats possible. '''
+		for _ in range(count):
+			yield [rng.choice(values) for values in self.ranges]
+
+	def __str__(self) -> str:
+		return ", ".join(f"r{addr} in {values.start}..{values.stop - 1}" for addr, values in enumerate(self.ranges))
+
+def parse_ranges(text : Optional[str], width : int) -> InputSpace:
+	'''
+	The input space of `--regs LO..HI,N,...` (bounds included), by default
+	0..DEFAULT_BOUND for every register of a `registers` line of `width`.
+	'''
+	if text is None:
+		return InputSpace([range(DEFAULT_BOUND + 1)] * width)
+	ranges = []
+	for part in text.split(','):
+		m = RANGE_RE.fullmatch(part)
+		if m is None:
+			raise Exception(f"--regs: '{part}' is not LO..HI or a number")
+		low = int(m.group(1))
+		high = int(m.group(2)) if m.group(2) is not None else low
+		if high < low:
+			raise Exception(f"--regs: empty range {part.strip()}")
+		ranges.append(range(low, high + 1))
+	return InputSpace(ranges)
+
+def mutate(program : Program, rng : random.Random, count : int = 1) -> Tuple[Program, List[Tuple[int, str]]]:
+	'''
+	`program` with `count` random point mutations (another register,
+	another branch target, `inc` and `decjz` swapped, an instruction
+	replaced by `nop`) and the pc and a description of each.
+	'''
+	n = len(program)
+	if n == 0:
+		raise Exception("a program without instructions can't be mutated")
+	ops, slots, targets = array('b', program.ops), array('l', program.slots), array('l', program.targets)
+	mutated = Program(ops, slots, targets, program.addrs, program.init, program.spec_size, None,
+		program.labels, program.lines, program.macros)
+	changes = []
+	for _ in range(count):
+		pc = rng.randrange(n)
+		before = mutated.disassemble(pc)
+		op = ops[pc]
+		kinds = ['nop'] if op != OP_NOP or not program.addrs else ['inc', 'decjz']
+		if op in (OP_INC, OP_DECJZ):
+			kinds += ['register', 'swap']
+		if op == OP_DECJZ:
+			kinds.append('target')
+		kind = rng.choice(kinds)
+		if kind == 'nop':
+			ops[pc], slots[pc], targets[pc] = OP_NOP, 0, 0
+		elif kind == 'register':
+			slots[pc] = rng.randrange(len(program.addrs))
+		elif kind == 'target':
+			targets[pc] = rng.randint(0, n)
+		elif kind == 'swap' and op == OP_DECJZ or kind == 'inc':
+			ops[pc], targets[pc] = OP_INC, 0
+			if kind == 'inc':
+				slots[pc] = rng.randrange(len(program.addrs))
+		else:
+			ops[pc], targets[pc] = OP_DECJZ, rng.randint(0, n)
+			if kind == 'decjz':
+				slots[pc] = rng.randrange(len(program.addrs))
+		changes.append((pc, f"pc {pc}: {before} -> {mutated.disassemble(pc)}"))
+	return mutated, changes
+
+def program_source(program : Program) -> str:
+	''' Source text of a linked program, branch targets as addresses. '''
+	lines = ["registers " + " ".join(map(str, program.regs))]
+	for pc in range(len(program)):
+		lines.append(program.disassemble(pc))
+	return "\n".join(lines) + "\n"
+
+# set by the search once it stops, polled by its workers between runs
+stop_event = None
+
+def init_search_worker(jobs : List[Job], stop):
+	global stop_event
+	init_worker(jobs)
+	stop_event = stop
+
+def run_tasks(job : Optional[Job], tasks : List[Tuple[Optional[int], List[int]]], budget : Optional[Budget],
+		accelerate : bool) -> List[Tuple[Optional[int], List[int], Dict[str, Any]]]:
+	''' The runs of `tasks`, cut short once the search stops. '''
+	# `job` is a mutant, or None for the program the worker was started with
+	job = job or parallel.worker_jobs[0]
+	ret = []
+	for tag, regs in tasks:
+		if stop_event is not None and stop_event.is_set():
+			break
+		ret.append((tag, regs, run_one(job, regs, budget, accelerate)))
+	return ret
+
+class Memo:
+	'''
+	The keys of the work done, the `max_size` most recently used kept: a
+	duplicate would come to the same verdict, so it is skipped.
+	'''
+	def __init__(self, max_size : int = DEFAULT_MEMO_SIZE):
+		self.max_size = max_size
+		self.keys : 'OrderedDict[Any, None]' = OrderedDict()
+		self.hits = 0
+
+	def seen(self, key) -> bool:
+		''' Whether `key` was seen before; it is from now on. '''
+		if key in self.keys:
+			self.keys.move_to_end(key)
+			self.hits += 1
+			return True
+		self.keys[key] = None
+		if len(self.keys) > self.max_size:
+			self.keys.popitem(last=False)
+		return False
+
+class Trial:
+	''' A mutant being checked on every input. '''
+	def __init__(self, index : int, job : Job, changes : List[str], runs : int):
+		self.index = index
+		self.job = job
+		self.changes = changes
+		self.remaining = runs
+
+class Stats:
+	''' Run counts, throughput and coverage of a `Search`. '''
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.runs = 0
+		self.checked = 0
+		self.failed = 0
+		self.statuses : Counter = Counter()
+		self.mutants = 0
+		self.duplicates = 0
+		self.killed = 0
+		self.survived = 0
+		self.sites = set()
+
+	def report(self, f, search : 'Search'):
+		seconds = time.perf_counter() - self.started
+		rate = f"{self.runs / seconds:.0f}" if seconds > 0 else "-"
+		f.write(f"rmsim search: {self.runs} runs in {seconds:.2f} s ({rate} runs/s), {search.memo.hits} memo hits\n")
+		size = len(search.space)
+		if search.mutants == 0:
+			f.write(f"  inputs   {self.checked} of {size} ({100 * self.checked / size:.1f}%)"
+				f"{', ' + str(search.space) if search.space.ranges else ''}; {self.failed} failed the spec\n")
+		else:
+			f.write(f"  inputs   {len(search.inputs)} of {size} per mutant ({100 * len(search.inputs) / size:.1f}%)"
+				f"{', ' + str(search.space) if search.space.ranges else ''}\n")
+			f.write(f"  mutants  {self.mutants} tried, {self.duplicates} duplicates, {self.killed} killed, "
+				f"{self.survived} met the spec; {len(self.sites)} of {len(search.job.program)} instructions mutated\n")
+		if self.statuses:
+			f.write("  status   " + ", ".join(f"{status} {count}" for status, count in self.statuses.most_common()) + "\n")
+		f.flush()
+
+class Search:
+	'''
+	Looks for inputs or programs meeting or failing `spec`, running
+	candidates in parallel on a process pool.
+
+	Without `mutants`, the program is run on the vectors of `space` (all of
+	them, or `samples` random ones) and, for `find` COUNTEREXAMPLE, every
+	run failing the spec is reported; for MATCH every run meeting it. With
+	`mutants`, that many random variants of the program with `mutations`
+	point mutations each are run on the inputs, and the mutants meeting
+	the spec on all of them are reported. Unless `all` is set, the search
+	stops at the first report.
+
+	Sampled runs are keyed by the hash of the linked program and their
+	registers, mutants by their hash; keys seen before (repeated samples,
+	identical mutants) are not run again.
+	'''
+	def __init__(self, job : Job, spec : Spec, space : InputSpace, samples : Optional[int] = None,
+			find : str = COUNTEREXAMPLE, all : bool = False, mutants : int = 0, mutations : int = 1,
+			seed : Optional[int] = None, workers : Optional[int] = None, budget : Optional[Budget] = None,
+			accelerate : bool = True, memo_size : int = DEFAULT_MEMO_SIZE):
+		self.job = job
+		self.spec = spec
+		self.space = space
+		self.samples = samples
+		self.find = find
+		self.all = all
+		self.mutants = mutants
+		self.mutations = mutations
+		self.rng = random.Random(seed)
+		self.workers = workers or os.cpu_count() or 1
+		self.budget = budget
+		self.accelerate = accelerate
+		self.memo = Memo(memo_size)
+		self.stats = Stats()
+		self.hash = program_hash(job.program)
+		self.inputs : List[List[int]] = []
+		if samples is not None and samples <= 0:
+			raise Exception("the number of samples must be positive")
+		if mutants > 0:
+			if len(job.program) == 0:
+				raise Exception("a program without instructions can't be mutated")
+			if samples is None and len(space) > MAX_MUTANT_INPUTS:
+				raise Exception(f"{len(space)} inputs per mutant are too many, sample at most {MAX_MUTANT_INPUTS}")
+			self.inputs = list(space if samples is None else space.sample(self.rng, samples))
+		# mutants being checked by index
+		self.trials : Dict[int, Trial] = {}
+		self.stopped = False
+
+	def candidates(self) -> Iterator[List[int]]:
+		return iter(self.space) if self.samples is None else self.space.sample(self.rng, self.samples)
+
+	def chunks(self) -> Iterator[Tuple[Optional[Job], List[Tuple[Any, List[int]]]]]:
+		'''
+		The runs to do, as (job, [(tag, registers)]): None and None for the
+		program searched, a mutant and its index otherwise.
+		'''
+		if self.mutants == 0:
+			chunk = []
+			for regs in self.candidates():
+				# an enumeration never repeats itself, samples may
+				if self.samples is not None and self.memo.seen((self.hash, tuple(regs))):
+					continue
+				chunk.append((None, regs))
+				if len(chunk) == CHUNK_SIZE:
+					yield None, chunk
+					chunk = []
+			if chunk:
+				yield None, chunk
+			return
+		width = len(self.space.ranges)
+		for index in range(self.mutants):
+			program, changes = mutate(self.job.program, self.rng, self.mutations)
+			self.stats.mutants += 1
+			key = program_hash(program)
+			if key == self.hash or self.memo.seen((key, None)):
+				self.stats.duplicates += 1
+				continue
+			self.stats.sites.update(pc for pc, _ in changes)
+			job = Job(self.job.path, program)
+			# computed once here rather than in every worker
+			if self.accelerate:
+				job.loops(width)
+			self.trials[index] = Trial(index, job, [change for _, change in changes], len(self.inputs))
+			for start in range(0, len(self.inputs), CHUNK_SIZE):
+				# a mutant failing on one input needs no more runs
+				if not index in self.trials:
+					break
+				yield job, [(index, regs) for regs in self.inputs[start:start + CHUNK_SIZE]]
+
+	def run(self) -> Iterator[Dict[str, Any]]:
+		''' Search, yielding every report as it is found. '''
+		if self.accelerate:
+			self.job.loops(len(self.space.ranges))
+		# a bounded number of chunks in flight, so the candidates are never
+		# materialized at once and stopping wastes little work
+		max_pending = self.workers * 4
+		stop = multiprocessing.Event()
+		executor = ProcessPoolExecutor(self.workers, initializer=init_search_worker, initargs=([self.job], stop))
+		pending = set()
+		try:
+			for job, tasks in self.chunks():
+				pending.add(executor.submit(run_tasks, job, tasks, self.budget, self.accelerate))
+				while len(pending) >= max_pending:
+					done, pending = wait(pending, return_when=FIRST_COMPLETED)
+					yield from self.collect(done)
+					if self.stopped:
+						return
+			while pending and not self.stopped:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				yield from self.collect(done)
+		finally:
+			# stopped early, the runs left are not wanted: chunks not started
+			# are cancelled and running ones end after their current run. The
+			# pool is shut down here, not left to the interpreter's exit hook,
+			# which can end in a traceback.
+			stop.set()
+			executor.shutdown(wait=True, cancel_futures=True)
+
+	def collect(self, done) -> Iterator[Dict[str, Any]]:
+		for future in done:
+			for tag, regs, result in future.result():
+				if self.stopped:
+					return
+				report = self.result(tag, regs, result)
+				if report is not None:
+					yield report
+					if not self.all:
+						self.stopped = True
+
+	def result(self, tag : Optional[int], regs : List[int], result : Dict[str, Any]) -> Optional[Dict[str, Any]]:
+		''' Account for the run on `regs`; the report it makes, if any. '''
+		self.stats.runs += 1
+		self.stats.statuses[result['status']] += 1
+		ok, expected = self.spec.check(regs, result)
+		if tag is None:
+			self.stats.checked += 1
+			if not ok:
+				self.stats.failed += 1
+			if ok != (self.find == MATCH):
+				return None
+			report = {'found': self.find, 'input': regs}
+			report.update(result)
+			report['expected'] = expected
+			return report
+
+		trial = self.trials.get(tag)
+		if trial is None:
+			# decided by an earlier run
+			return None
+		if not ok:
+			del self.trials[tag]
+			self.stats.killed += 1
+			return None
+		trial.remaining -= 1
+		if trial.remaining > 0:
+			return None
+		del self.trials[tag]
+		self.stats.survived += 1
+		return {'found': MATCH, 'mutant': trial.index, 'mutations': trial.changes,
+			'program': program_source(trial.job.program)}
@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import signal
+import stat
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from cache import ProgramCache
+from estimate import estimate
+from link import Program, link
+from optimize import LEVELS, optimize
+from parallel import Job, init_installed, run_installed, run_one
+from pre_process import load_program, parse_source
+from watchdog import Budget
+
+# linked programs kept in memory by default
+DEFAULT_CACHE_SIZE = 256
+# requests read ahead of their responses, over all connections
+DEFAULT_MAX_PENDING = 256
+# a run within this many steps (by estimate.py) is cheaper to do in the
+# server than to ship to a worker
+INLINE_STEPS = 10_000
+# programs larger than this are not estimated and always run in a worker
+ESTIMATE_SIZE = 10_000
+# longest request line
+MAX_LINE = 64 * 1024 * 1024
+# completed requests the latency and recent throughput figures cover
+STATS_WINDOW = 1024
+
+class Loaded:
+	'''
+	A program of the server's cache: its cache key, the `Job` handed to
+	the workers and the step bound of its runs, None if unknown.
+	'''
+	def __init__(self, key : str, job : Job, bound):
+		self.key = key
+		self.job = job
+		self.bound = bound
+
+	def steps_for(self, regs : List[int]) -> Optional[int]:
+		# the estimate assumes non-negative inputs; a negative register may
+		# never count down to zero
+		if self.bound is None or any(value < 0 for value in regs):
+			return None
+		return self.bound.steps_for(regs)
+
+class Stats:
+	'''
+	Request counts, throughput and latency of a `Server`.
+	'''
+	def __init__(self):
+		self.started = time.monotonic()
+		self.requests = 0
+		self.errors = 0
+		self.inline = 0
+		self.pooled = 0
+		# pooled runs whose worker did not have the job yet
+		self.shipped = 0
+		self.hits = 0
+		self.misses = 0
+		# (completion time, seconds) of the last requests
+		self.recent : deque = deque(maxlen=STATS_WINDOW)
+
+	def record(self, seconds : float, ok : bool):
+		self.requests += 1
+		if not ok:
+			self.errors += 1
+		self.recent.append((time.monotonic(), seconds))
+
+	def to_json(self) -> Dict[str, Any]:
+		now = time.monotonic()
+		uptime = now - self.started
+		latencies = sorted(seconds for _, seconds in self.recent)
+
+		def percentile(p):
+			return 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+		span = now - self.recent[0][0] if self.recent else 0
+		return {
+			'uptime': uptime,
+			'requests': self.requests,
+			'errors': self.errors,
+			'runs_inline': self.inline,
+			'runs_pooled': self.pooled,
+			'jobs_shipped': self.shipped,
+			'cache_hits': self.hits,
+			'cache_misses': self.misses,
+			'requests_per_sec': self.requests / uptime if uptime > 0 else None,
+			'recent_requests_per_sec': len(self.recent) / span if span > 0 else None,
+			'latency_ms': {
+				'p50': percentile(0.5),
+				'p90': percentile(0.9),
+				'p99': percentile(0.99),
+				'max': 1000 * latencies[-1] if latencies else None,
+			},
+		}
+
+class Server:
+	'''
+	Runs programs for JSON requests, one per line, on a connection.
+
+	A request is `{"program": PATH}` or `{"source": TEXT}` with optional
+	`"registers"` (default: the program's `registers` line), `"optimize"`
+	(-O level), `"accelerate"`, `"max_steps"`, `"max_seconds"`,
+	`"max_register"`, `"detect_cycles"` and an `"id"` echoed in the
+	response; `{"op": "stats"}` returns the statistics. Responses are
+	written as runs finish, so pipelined requests may be answered out of
+	order.
+
+	Linked programs are kept in an LRU cache keyed by their content (and
+	that of their imports) and -O level. Runs the step estimate of
+	estimate.py shows to be tiny are done in the server, all others in a
+	process pool. Pooled runs send only the program's key; each worker
+	keeps the jobs it was sent in an LRU cache of the same size, and the
+	job is sent along only when the worker running the request misses
+	it. At most `max_pending` requests are in progress; beyond
+	that, connections are not read, so clients feel the backpressure. The
+	server's `budget` caps the limits of every run.
+	'''
+	def __init__(self, workers : Optional[int] = None, cache_size : int = DEFAULT_CACHE_SIZE,
+			max_pending : int = DEFAULT_MAX_PENDING, budget : Optional[Budget] = None,
+			files : Optional[ProgramCache] = None):
+		if cache_size <= 0 or max_pending <= 0:
+			raise Exception("the cache size and the number of pending requests must be positive")
+		self.workers = workers or os.cpu_count() or 1
+		self.cache_size = cache_size
+		self.budget = budget or Budget()
+		# the on-disk program cache, None to always parse from source
+		self.files = files
+		self.programs : 'OrderedDict[str, Loaded]' = OrderedDict()
+		# programs being built, so concurrent requests for one build it once
+		self.loading : Dict[str, asyncio.Task] = {}
+		self.stats = Stats()
+		self.executor = ProcessPoolExecutor(self.workers, initializer=init_installed, initargs=(cache_size,))
+		self.pending = asyncio.Semaphore(max_pending)
+		self.in_progress = 0
+
+	def start_workers(self):
+		''' Start the worker processes now rather than on the first runs. '''
+		for future in [self.executor.submit(int) for _ in range(self.workers)]:
+			future.result()
+
+	def close(self):
+		self.executor.shutdown(cancel_futures=True)
+
+	async def handle(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+		''' Serve one connection until the client closes it. '''
+		lock = asyncio.Lock()
+		tasks = set()
+		try:
+			while True:
+				try:
+					line = await reader.readline()
+				except (ConnectionError, ValueError) as e:
+					if isinstance(e, ValueError):
+						await self.send(writer, lock, {'ok': False, 'error': f"request longer than {MAX_LINE} bytes"})
+					break
+				if not line:
+					break
+				if not line.strip():
+					continue
+				# idle connections hold no permit; a request waiting for one
+				# stops its connection from being read
+				await self.pending.acquire()
+				task = asyncio.create_task(self.serve(line, writer, lock))
+				tasks.add(task)
+				task.add_done_callback(tasks.discard)
+			if tasks:
+				await asyncio.gather(*tasks)
+		finally:
+			writer.close()
+			try:
+				await writer.wait_closed()
+			except ConnectionError:
+				pass
+
+	async def serve(self, line : bytes, writer : asyncio.StreamWriter, lock : asyncio.Lock):
+		self.in_progress += 1
+		try:
+			response = await self.respond(line)
+		finally:
+			self.in_progress -= 1
+			self.pending.release()
+		await self.send(writer, lock, response)
+
+	async def send(self, writer : asyncio.StreamWriter, lock : asyncio.Lock, response : Dict[str, Any]):
+		async with lock:
+			if writer.is_closing():
+				return
+			writer.write(json.dumps(response).encode() + b"\n")
+			try:
+				await writer.drain()
+			except ConnectionError:
+				pass
+
+	async def respond(self, line : bytes) -> Dict[str, Any]:
+		start = time.perf_counter()
+		request = None
+		try:
+			request = json.loads(line)
+			if not isinstance(request, dict):
+				raise Exception("a request must be a JSON object")
+			op = request.get('op', 'run')
+			if op == 'run':
+				response = await self.run(request)
+			elif op == 'stats':
+				response = self.stats.to_json()
+				response['cached_programs'] = len(self.programs)
+				response['in_progress'] = self.in_progress
+			else:
+				raise Exception(f"unknown op '{op}'")
+			response['ok'] = True
+		except Exception as e:
+			response = {'ok': False, 'error': str(e) or type(e).__name__}
+		if isinstance(request, dict) and 'id' in request:
+			response['id'] = request['id']
+		self.stats.record(time.perf_counter() - start, response['ok'])
+		return response
+
+	async def run(self, request : Dict[str, Any]) -> Dict[str, Any]:
+		level = request.get('optimize', 0)
+		if not level in LEVELS:
+			raise Exception(f"optimize must be one of {', '.join(map(str, LEVELS))}")
+		loaded = await self.load(request, level)
+		program = loaded.job.program
+		regs = request.get('registers', program.regs)
+		if not isinstance(regs, list) or not all(type(value) is int for value in regs):
+			raise Exception("registers must be a list of integers")
+		budget = self.budget_of(request)
+		accelerate = bool(request.get('accelerate', True))
+
+		bound = loaded.steps_for(regs)
+		if bound is not None and bound <= INLINE_STEPS:
+			self.stats.inline += 1
+			result = run_one(loaded.job, regs, budget, accelerate)
+		else:
+			self.stats.pooled += 1
+			loop = asyncio.get_running_loop()
+			result = await loop.run_in_executor(self.executor, run_installed, loaded.key, regs, budget, accelerate)
+			if result is None:
+				self.stats.shipped += 1
+				result = await loop.run_in_executor(self.executor, run_installed, loaded.key, regs, budget,
+					accelerate, loaded.job)
+		return result
+
+	def budget_of(self, request : Dict[str, Any]) -> Budget:
+		''' The limits of a request, within those of the server. '''
+		def limit(name, cap):
+			value = request.get(name)
+			if value is not None and (type(value) not in (int, float) or value <= 0):
+				raise Exception(f"{name} must be a positive number")
+			if value is None or cap is None:
+				return value if value is not None else cap
+			return min(value, cap)
+
+		steps = limit('max_steps', self.budget.steps)
+		return Budget(int(steps) if steps is not None else None, limit('max_seconds', self.budget.seconds),
+			limit('max_register', self.budget.register), bool(request.get('detect_cycles')) or self.budget.cycles)
+
+	async def load(self, request : Dict[str, Any], level : int) -> Loaded:
+		''' The program of a request, from the cache if it was seen before. '''
+		if 'source' in request:
+			source = request['source']
+			if not isinstance(source, str):
+				raise Exception("source must be a string")
+			path = '<source>'
+			key = hashlib.sha256(f"source\0O{level}\0{source}".encode()).hexdigest()
+
+			def build():
+				return link(*optimize(*parse_source(io.StringIO(source))[0], level))
+		elif 'program' in request:
+			path = request['program']
+			if not isinstance(path, str):
+				raise Exception("program must be a path")
+			files = self.files or ProgramCache()
+			# hashes the file and its imports, so edits are picked up
+			key = "file\0" + await asyncio.to_thread(files.key, path, f"O{level}")
+
+			def build():
+				return load_program(path, self.files, level)[0]
+		else:
+			raise Exception("a run request needs a program or a source")
+
+		loaded = self.programs.get(key)
+		if loaded is not None:
+			self.programs.move_to_end(key)
+			self.stats.hits += 1
+			return loaded
+		task = self.loading.get(key)
+		if task is not None:
+			self.stats.hits += 1
+			return await asyncio.shield(task)
+		self.stats.misses += 1
+		task = self.loading[key] = asyncio.ensure_future(asyncio.to_thread(self.prepare, key, path, build))
+		try:
+			loaded = await asyncio.shield(task)
+		finally:
+			del self.loading[key]
+		self.programs[key] = loaded
+		while len(self.programs) > self.cache_size:
+			self.programs.popitem(last=False)
+		return loaded
+
+	def prepare(self, key : str, path : str, build) -> Loaded:
+		program = build()
+		bound = estimate(program) if len(program) <= ESTIMATE_SIZE else None
+		return Loaded(key, Job(path, program), bound)
+
+async def serve_forever(server : Server, socket : Optional[str], host : str, port : int):
+	if socket is not None:
+		if os.path.exists(socket) and stat.S_ISSOCK(os.stat(socket).st_mode):
+			# left over by a server that was killed
+			os.remove(socket)
+		listener = await asyncio.start_unix_server(server.handle, path=socket, limit=MAX_LINE)
+		where = socket
+	else:
+		listener = await asyncio.start_server(server.handle, host, port, limit=MAX_LINE)
+		where = ", ".join(f"{address[0]}:{address[1]}" for address in
+			(s.getsockname() for s in listener.sockets))
+	sys.stderr.write(f"rmsim serve: listening on {where} with {server.workers} workers\n")
+	sys.stderr.flush()
+	stop = asyncio.Event()
+	loop = asyncio.get_running_loop()
+	for signum in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(signum, stop.set)
+	async with listener:
+		await stop.wait()
+
+def serve(server : Server, socket : Optional[str] = None, host : str = '127.0.0.1', port : int = 0):
+	'''
+	Serve requests on the Unix socket `socket`, or on `host`:`port`, until
+	SIGINT or SIGTERM; then print the statistics to stderr.
+	'''
+	server.start_workers()
+	try:
+		asyncio.run(serve_forever(server, socket, host, port))
+	finally:
+		server.close()
+		if socket is not None and os.path.exists(socket):
+			os.remove(socket)
+		sys.stderr.write("rmsim serve: " + json.dumps(server.stats.to_json()) + "\n")
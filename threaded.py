@@ -0,0 +1,353 @@
+import sys
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from instr import *
+from emulator import Emulator
+from link import *
+from loops import TransferLoop, program_transfer_loops
+from watchdog import *
+from regfile import RegisterFile
+
+# checkpoint.py, tracing.py and units.py are imported where --checkpoint,
+# --trace and --memo need them, so plain runs start without them
+
+# A register that is neither on the `registers` line nor touched by an
+# executed instruction is not printed. Instructions on such registers start
+# "cold": the first execution marks the slot as touched and rewrites itself
+# into the plain opcode, so the hot loop never checks it again.
+COLD = 8
+OP_INC_COLD = OP_INC + COLD
+OP_DECJZ_COLD = OP_DECJZ + COLD
+OP_ADD_COLD = OP_ADD + COLD
+# header of a transfer loop, see loops.py
+OP_XFER = 16
+# start of a memoized call unit, see units.py
+OP_UNIT = 32
+
+class Transfer:
+	'''
+	A `TransferLoop` in terms of register slots.
+	'''
+	def __init__(self, program : Program, loop : TransferLoop):
+		self.length = loop.length
+		self.incs = [(program.slot_of(addr), k) for addr, k in loop.incs.items()]
+		self.slots = [program.slot_of(addr) for addr in [loop.counter, loop.zero] + list(loop.incs)]
+
+def decode(program : Program, loops : Dict[int, TransferLoop] = {},
+		touched : Optional[List[bool]] = None) -> Tuple[List[Tuple[int, int, int]], Dict[int, Transfer]]:
+	'''
+	Pre-decode the program image into one `(op, slot, target)` tuple per pc,
+	the cheapest thing the dispatch loop can fetch and unpack. Instructions
+	on registers not `touched` yet (by default: not on the `registers` line)
+	start cold. The headers of `loops` become `OP_XFER`.
+	'''
+	if touched is None:
+		touched = [slot < program.spec_size for slot in range(len(program.addrs))]
+	code = []
+	for pc in range(len(program.ops)):
+		op, slot = program.ops[pc], program.slots[pc]
+		if (op == OP_INC or op == OP_DECJZ or op == OP_ADD) and not touched[slot]:
+			op += COLD
+		code.append((op, slot, program.targets[pc]))
+
+	transfers = {}
+	for pc, loop in loops.items():
+		transfers[pc] = Transfer(program, loop)
+		code[pc] = (OP_XFER, program.slots[pc], program.targets[pc])
+	return code, transfers
+
+def execute(code : List[Tuple[int, int, int]], regs : List[int], touched : List[bool],
+		pc : int = 0, limit : Optional[int] = None, transfers : Dict[int, Transfer] = {},
+		chunk : Optional[int] = None, units : Optional['UnitRunner'] = None) -> Tuple[int, int]:
+	'''
+	Run decoded `code` from `pc` for at most `limit` steps (no limit if None).
+	With `chunk`, return as soon as at least `chunk` steps were executed; a
+	transfer loop may overshoot `chunk`, never `limit`. `OP_UNIT`s are run
+	by `units`, only without a limit.
+	Return the pc the machine stopped at and the number of steps executed.
+	'''
+	steps = 0
+	while True:
+		if chunk is not None and steps >= chunk:
+			return pc, steps
+		budget = limit - steps if limit is not None else sys.maxsize
+		span = budget if chunk is None else min(budget, chunk - steps)
+		for i in range(span):
+			op, a, t = code[pc]
+			if op == OP_INC:
+				regs[a] += 1
+				pc += 1
+			elif op == OP_DECJZ:
+				if regs[a]:
+					regs[a] -= 1
+					pc += 1
+				else:
+					pc = t
+			elif op == OP_HALT:
+				return pc, steps + i
+			elif op == OP_NOP:
+				pc += 1
+			elif op == OP_ADD:
+				regs[a] += t
+				pc += 1
+			elif op == OP_XFER:
+				n = regs[a]
+				transfer = transfers[pc]
+				if n > 0 and (limit is None or n * transfer.length < budget - i):
+					for slot, k in transfer.incs:
+						regs[slot] += n * k
+					regs[a] = 0
+					for slot in transfer.slots:
+						touched[slot] = True
+					pc = t
+					steps += i + n * transfer.length + 1
+					break
+				touched[a] = True
+				if n:
+					regs[a] -= 1
+					pc += 1
+				else:
+					pc = t
+			elif op == OP_UNIT:
+				pc, n = units.call(pc, regs, touched)
+				steps += i + n
+				break
+			else:
+				touched[a] = True
+				op -= COLD
+				code[pc] = (op, a, t)
+				if op == OP_INC:
+					regs[a] += 1
+					pc += 1
+				elif op == OP_ADD:
+					regs[a] += t
+					pc += 1
+				elif regs[a]:
+					regs[a] -= 1
+					pc += 1
+				else:
+					pc = t
+		else:
+			steps += span
+			if limit is not None and steps >= limit:
+				return pc, steps
+
+def run_program(program : Program, regs : List[int], loops : Dict[int, TransferLoop] = {},
+		limit : Optional[int] = None, cache : Optional['UnitCache'] = None,
+		units : Optional[Dict[int, 'CallUnit']] = None) -> Tuple[Dict[int, int], int, int]:
+	'''
+	Run `program` from the `registers` line `regs` for at most `limit` steps.
+	With `cache`, the call `units` (by default `find_units`) are memoized
+	in it; `limit` must be None then.
+	Return the touched registers by address, the number of steps and the pc
+	the machine stopped at (`len(program)` if it halted).
+	'''
+	values, touched, addrs = program.bind(regs)
+	code, transfers = decode(program, loops, touched)
+	runner = None
+	if cache is not None:
+		from units import find_units
+		runner = UnitRunner(program, loops, units if units is not None else find_units(program, loops), cache, len(values))
+		for start in runner.units:
+			code[start] = (OP_UNIT, 0, 0)
+	pc, steps = execute(code, values, touched, limit=limit, transfers=transfers, units=runner)
+	return {addrs[slot]: values[slot] for slot in range(len(values)) if touched[slot]}, steps, pc
+
+class UnitRunner:
+	'''
+	Runs the `OP_UNIT`s of `execute`: a call whose tested registers are in
+	`cache` is applied from its summary, any other call is run on a plain
+	copy of the code, with the exits of the unit turned into HALT, and
+	summarized.
+	'''
+	def __init__(self, program : Program, loops : Dict[int, TransferLoop], units : Dict[int, 'CallUnit'],
+			cache : 'UnitCache', width : int):
+		self.units = units
+		self.cache = cache
+		self.plain, self.transfers = decode(program, loops, [True] * width)
+		# touched flags of a unit run, all False between runs
+		self.scratch = [False] * width
+
+	def call(self, pc : int, regs : List[int], touched : List[bool]) -> Tuple[int, int]:
+		''' Run the unit at `pc`; return its exit and number of steps. '''
+		unit = self.units[pc]
+		key = (pc,) + tuple([regs[slot] for slot in unit.tested])
+		summary = self.cache.get(key)
+		if summary is None:
+			summary = self.run(unit, regs)
+			self.cache.put(key, summary)
+		else:
+			for slot, value in zip(unit.tested, summary.tested):
+				regs[slot] = value
+			for slot, k in zip(unit.added, summary.added):
+				regs[slot] += k
+		for slot in summary.touched:
+			touched[slot] = True
+		return summary.exit, summary.steps
+
+	def run(self, unit : 'CallUnit', regs : List[int]) -> 'Summary':
+		from units import Summary
+		plain, scratch = self.plain, self.scratch
+		before = [regs[slot] for slot in unit.added]
+		saved = [plain[pc] for pc in unit.exits]
+		for pc in unit.exits:
+			plain[pc] = (OP_HALT, 0, 0)
+		# cold instructions record what the run touches
+		for pc in range(unit.start, unit.end):
+			op, a, t = plain[pc]
+			if op == OP_INC or op == OP_DECJZ or op == OP_ADD:
+				plain[pc] = (op + COLD, a, t)
+		try:
+			exit, steps = execute(plain, regs, scratch, unit.start, transfers=self.transfers)
+		finally:
+			for pc, instr in zip(unit.exits, saved):
+				plain[pc] = instr
+		touched = [slot for slot in unit.slots if scratch[slot]]
+		for slot in touched:
+			scratch[slot] = False
+		return Summary(tuple([regs[slot] for slot in unit.tested]),
+			[regs[slot] - value for slot, value in zip(unit.added, before)], touched, exit, steps)
+
+def run_guarded(program : Program, regs : List[int], loops : Dict[int, TransferLoop] = {},
+		budget : Optional[Budget] = None, checkpointer : Optional['Checkpointer'] = None,
+		start : Optional['Snapshot'] = None,
+		decoded : Optional[Tuple[List[Tuple[int, int, int]], Dict[int, Transfer]]] = None
+		) -> Tuple[Dict[int, int], int, int, str, Optional[Tuple[int, int]]]:
+	'''
+	`run_program` within `budget`, from the state `start` if given and
+	handing a snapshot to `checkpointer` every `checkpointer.every` steps
+	and when the budget stops the run. `decoded` is the `decode` of
+	`program` and `loops` for registers lines as wide as `regs`, to reuse
+	over many runs. Return the touched registers by address, the number
+	of steps, the pc the machine stopped at, the status (see watchdog.py)
+	and, unless it halted, the pc range it was running in.
+	'''
+	if start is None:
+		values, touched, addrs = program.bind(regs)
+		pc, steps = 0, 0
+	else:
+		values, touched, addrs = program.bind_state(start.regs)
+		pc, steps = start.pc, start.steps
+	if decoded is not None and start is None:
+		# execute() patches cold instructions, so every run gets its own copy
+		code, transfers = list(decoded[0]), decoded[1]
+	else:
+		code, transfers = decode(program, loops, touched)
+	watchdog = Watchdog(budget) if budget is not None else None
+	limit = budget.steps if budget is not None else None
+	chunk = CHECK_EVERY if budget is not None and budget.sampled() else None
+	if checkpointer is not None:
+		chunk = min(chunk or checkpointer.every, checkpointer.every)
+		next_snapshot = steps + checkpointer.every
+
+	def state():
+		return {addrs[slot]: values[slot] for slot in range(len(values)) if touched[slot]}
+
+	status, pcs = HALTED, None
+	while True:
+		pc, n = execute(code, values, touched, pc, None if limit is None else limit - steps, transfers, chunk)
+		steps += n
+		if pc >= len(program):
+			break
+		stop = watchdog.check(pc, steps, values) if watchdog is not None else None
+		if stop is not None:
+			status = stop
+			pcs = pc_range(code, values, touched, pc, transfers)
+			if checkpointer is not None:
+				checkpointer.save(pc, steps, state())
+			break
+		if checkpointer is not None and steps >= next_snapshot:
+			checkpointer.submit(pc, steps, state())
+			next_snapshot = steps + checkpointer.every
+	return state(), steps, pc, status, pcs
+
+def pc_range(code : List[Tuple[int, int, int]], regs : List[int], touched : List[bool],
+		pc : int, transfers : Dict[int, Transfer] = {}) -> Tuple[int, int]:
+	'''
+	The lowest and highest pc of the next PC_WINDOW steps from `pc`, run on
+	copies of the machine state.
+	'''
+	code, regs, touched = list(code), list(regs), list(touched)
+	lo = hi = pc
+	for _ in range(PC_WINDOW):
+		pc, n = execute(code, regs, touched, pc, 1, transfers)
+		if n == 0 or pc >= len(code) - 1:
+			break
+		lo, hi = min(lo, pc), max(hi, pc)
+	return lo, hi
+
+class LinkedEmulator(Emulator):
+	'''
+	Base of the engines that run a linked `Program`. They are built either
+	from the parser output, like `Emulator`, or with `from_program` from an
+	already linked program. Tracing runs step by step, see `run_trace`.
+	'''
+	def __init__(self, regs : List[int] , labels : Dict[str, int], instrs : List[Instr], accelerate=False):
+		labels['HALT'] = len(instrs)
+		self.setup(link(regs, labels, instrs), accelerate)
+
+	@classmethod
+	def from_program(cls, program : Program, accelerate=False):
+		self = cls.__new__(cls)
+		self.setup(program, accelerate)
+		return self
+
+	def setup(self, program : Program, accelerate : bool):
+		self.program = program
+		self.regs = RegisterFile(program.regs)
+		self.steps = 0
+		self.loops = program_transfer_loops(program) if accelerate else {}
+		self.budget = None
+		self.status = HALTED
+		self.pcs = None
+		self.checkpointer = None
+		self.start = None
+		# a units.UnitCache to memoize the call `units` in
+		self.memo = None
+		self.units = None
+		self.regs_format = 'text'
+		self.regs_out = None
+
+	def run_trace(self, trace):
+		'''
+		`run(trace)` on the linked program; runs with a budget, checkpoints
+		or a snapshot to resume from go through `Emulator.run`.
+		'''
+		if self.budget is not None or self.checkpointer is not None or self.start is not None:
+			return Emulator.run(self, trace=trace)
+		from tracing import TextTrace, run_traced
+		tracer = TextTrace(sys.stdout) if trace is True else trace
+		regs, self.steps, pc = run_traced(self.program, self.program.regs, tracer)
+		tracer.close()
+		self.regs.update(regs)
+		self.print_regs()
+
+	@property
+	def instrs(self) -> List[Instr]:
+		return self.program.instrs
+
+	@property
+	def labels(self) -> Dict[str, int]:
+		return self.program.labels
+
+class ThreadedEmulator(LinkedEmulator):
+	'''
+	Runs the linked program image with a dispatch loop over a dense register
+	list.
+	'''
+	def run(self, trace=False):
+		if trace:
+			return self.run_trace(trace)
+
+		if self.budget is None and self.checkpointer is None and self.start is None:
+			if self.memo is not None:
+				from units import find_units
+				self.units = find_units(self.program, self.loops)
+			regs, self.steps, pc = run_program(self.program, self.program.regs, self.loops,
+				cache=self.memo, units=self.units)
+		else:
+			regs, self.steps, pc, self.status, self.pcs = run_guarded(self.program, self.program.regs, self.loops,
+				self.budget, self.checkpointer, self.start)
+		self.regs.update(regs)
+
+		self.print_regs()
@@ -0,0 +1,272 @@
+from abc import ABC, abstractmethod
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from link import *
+
+# first line of a binary trace file; bump the number whenever the format changes
+MAGIC = b"rmsim-trace 1\n"
+
+# lines or bytes buffered before a write
+BUFFER_LINES = 4096
+BUFFER_BYTES = 1 << 16
+
+class TraceFilter:
+	'''
+	Which steps and registers a trace shows: only the registers `regs` (all
+	if None), only steps that end at one of the `pcs` (all if None), and of
+	those only every `every`-th one.
+	'''
+	def __init__(self, regs : Optional[List[int]] = None, pcs : Optional[set] = None, every : int = 1):
+		if every <= 0:
+			raise Exception("the trace interval must be positive")
+		self.regs = sorted(set(regs)) if regs is not None else None
+		self.pcs = pcs
+		self.every = every
+
+class Tracer(ABC):
+	'''
+	Base of the trace writers. Engines either call `start` with the initial
+	state, `step` after every step with the register it touched (None for
+	`nop`) and let the tracer apply its `TraceFilter`, or apply the filter
+	themselves and call `emit` with the registers touched since the last
+	call (see `run_traced`). `close` ends the trace. Writers implement
+	`emit`.
+	'''
+	def __init__(self, filter : Optional[TraceFilter] = None):
+		self.filter = filter or TraceFilter()
+		self.countdown = self.filter.every
+		self.dirty = set()
+
+	def start(self, pc : int, regs : Dict[int, int]):
+		if self.filter.pcs is None or pc in self.filter.pcs:
+			self.emit(pc, list(regs.items()))
+		else:
+			self.dirty.update(regs.keys())
+
+	def step(self, pc : int, regs : Dict[int, int], addr : Optional[int]):
+		if addr is not None:
+			self.dirty.add(addr)
+		if self.filter.pcs is not None and not pc in self.filter.pcs:
+			return
+		self.countdown -= 1
+		if self.countdown == 0:
+			self.countdown = self.filter.every
+			self.emit(pc, [(addr, regs[addr]) for addr in self.dirty])
+			self.dirty.clear()
+
+	@abstractmethod
+	def emit(self, pc : int, changes : List[Tuple[int, int]]):
+		''' Write the state at `pc`, given the `(address, value)` of the registers touched since the last write. '''
+
+	def close(self):
+		pass
+
+class TextTrace(Tracer):
+	'''
+	Writes `pc N registers r0 r1 ...` lines, as `Emulator.print_regs` prints
+	registers, or `pc N r3=... r7=...` with a register filter. Lines are
+	buffered and written in blocks.
+	'''
+	def __init__(self, f, filter : Optional[TraceFilter] = None):
+		super().__init__(filter)
+		self.f = f
+		self.lines : List[str] = []
+		# the printed value of every register up to the highest touched one
+		self.cells : List[str] = []
+		self.selected = {addr: 0 for addr in self.filter.regs} if self.filter.regs is not None else None
+
+	def emit(self, pc : int, changes : List[Tuple[int, int]]):
+		if self.selected is None:
+			cells = self.cells
+			for addr, value in changes:
+				if addr < 0:
+					continue
+				if addr >= len(cells):
+					cells.extend(['0'] * (addr + 1 - len(cells)))
+				cells[addr] = str(value)
+			self.lines.append(f"pc {pc} registers " + " ".join(cells))
+		else:
+			selected = self.selected
+			for addr, value in changes:
+				if addr in selected:
+					selected[addr] = value
+			self.lines.append(f"pc {pc} " + " ".join(f"r{addr}={value}" for addr, value in selected.items()))
+		if len(self.lines) >= BUFFER_LINES:
+			self.flush()
+
+	def flush(self):
+		if self.lines:
+			self.f.write("\n".join(self.lines) + "\n")
+			self.lines.clear()
+
+	def close(self):
+		self.flush()
+		self.f.flush()
+
+def put_varint(out : bytearray, n : int):
+	''' Append the unsigned LEB128 encoding of `n`. '''
+	while n >= 0x80:
+		out.append(n & 0x7f | 0x80)
+		n >>= 7
+	out.append(n)
+
+def put_signed(out : bytearray, n : int):
+	put_varint(out, n << 1 if n >= 0 else (-n << 1) - 1)
+
+def get_varint(data : bytes, pos : int) -> Tuple[int, int]:
+	n = shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return n, pos
+		shift += 7
+
+def get_signed(data : bytes, pos : int) -> Tuple[int, int]:
+	n, pos = get_varint(data, pos)
+	return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+class BinaryTrace(Tracer):
+	'''
+	Writes a compact trace file: after the header, one record per traced
+	step holding the pc and only the registers that changed since the
+	previous record, all as variable-length integers. `dump_trace` turns it
+	back into the text of `TextTrace`.
+
+	header: MAGIC, has register filter (0/1), [count, addresses]
+	record: pc, number of changes, (address, value) per change
+	'''
+	def __init__(self, path : str, filter : Optional[TraceFilter] = None):
+		super().__init__(filter)
+		self.f = open(path, mode='wb')
+		self.out = bytearray(MAGIC)
+		if self.filter.regs is None:
+			put_varint(self.out, 0)
+		else:
+			put_varint(self.out, 1)
+			put_varint(self.out, len(self.filter.regs))
+			for addr in self.filter.regs:
+				put_signed(self.out, addr)
+		self.selected = set(self.filter.regs) if self.filter.regs is not None else None
+		# the value of every register as of the last record
+		self.written : Dict[int, int] = {}
+
+	def emit(self, pc : int, changes : List[Tuple[int, int]]):
+		written, selected = self.written, self.selected
+		record = [pc, 0]
+		for addr, value in changes:
+			if (selected is None or addr in selected) and written.get(addr) != value:
+				written[addr] = value
+				record.append(addr << 1 if addr >= 0 else (-addr << 1) - 1)
+				record.append(value << 1 if value >= 0 else (-value << 1) - 1)
+		record[1] = (len(record) - 2) >> 1
+		out = self.out
+		for n in record:
+			if n < 0x80:
+				out.append(n)
+			else:
+				put_varint(out, n)
+		if len(out) >= BUFFER_BYTES:
+			self.flush()
+
+	def flush(self):
+		self.f.write(self.out)
+		self.out.clear()
+
+	def close(self):
+		self.flush()
+		self.f.close()
+
+def read_trace(path : str):
+	'''
+	Yield `(pc, changes)` for every record of a binary trace, `changes`
+	being the `(address, value)` of the registers that changed. The
+	register filter of the trace comes first, as `(None, addrs)`.
+	'''
+	with open(path, mode='rb') as f:
+		data = f.read()
+	if not data.startswith(MAGIC):
+		raise Exception(f"{path}: not an rmsim trace")
+	pos = len(MAGIC)
+	has_filter, pos = get_varint(data, pos)
+	addrs = None
+	if has_filter:
+		count, pos = get_varint(data, pos)
+		addrs = []
+		for _ in range(count):
+			addr, pos = get_signed(data, pos)
+			addrs.append(addr)
+	yield None, addrs
+
+	while pos < len(data):
+		pc, pos = get_varint(data, pos)
+		count, pos = get_varint(data, pos)
+		changes = []
+		for _ in range(count):
+			addr, pos = get_signed(data, pos)
+			value, pos = get_signed(data, pos)
+			changes.append((addr, value))
+		yield pc, changes
+
+def dump_trace(path : str, f):
+	''' Write a binary trace as the text `TextTrace` writes. '''
+	records = read_trace(path)
+	_, addrs = next(records)
+	text = TextTrace(f, TraceFilter(addrs))
+	for pc, changes in records:
+		text.emit(pc, changes)
+	text.close()
+
+def run_traced(program : Program, regs : List[int], tracer : Tracer,
+		limit : Optional[int] = None) -> Tuple[Dict[int, int], int, int]:
+	'''
+	Run `program` from the `registers` line `regs` step by step for at most
+	`limit` steps, applying the filter of `tracer` inline so steps that are
+	not traced cost next to nothing. Return the touched registers by
+	address, the number of steps and the pc the machine stopped at.
+	'''
+	ops, slots, targets = program.ops, program.slots, program.targets
+	values, touched, addrs = program.bind(regs)
+	pcs, every = tracer.filter.pcs, tracer.filter.every
+	countdown = every
+	n = len(program)
+	dirty = set(slot for slot in range(len(values)) if touched[slot])
+	if pcs is None or 0 in pcs:
+		tracer.emit(0, [(addrs[slot], values[slot]) for slot in dirty])
+		dirty.clear()
+
+	pc, steps = 0, 0
+	while limit is None or steps < limit:
+		op = ops[pc]
+		a = slots[pc]
+		if op == OP_DECJZ:
+			touched[a] = True
+			dirty.add(a)
+			if values[a]:
+				values[a] -= 1
+				pc += 1
+			else:
+				pc = targets[pc]
+		elif op == OP_INC:
+			touched[a] = True
+			dirty.add(a)
+			values[a] += 1
+			pc += 1
+		elif op == OP_ADD:
+			touched[a] = True
+			dirty.add(a)
+			values[a] += targets[pc]
+			pc += 1
+		elif op == OP_NOP:
+			pc += 1
+		else:
+			break
+		steps += 1
+		if pc < n and (pcs is None or pc in pcs):
+			countdown -= 1
+			if countdown == 0:
+				countdown = every
+				tracer.emit(pc, [(addrs[slot], values[slot]) for slot in dirty])
+				dirty.clear()
+	return {addrs[slot]: values[slot] for slot in range(len(values)) if touched[slot]}, steps, pc
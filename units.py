@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+from defaults import MEMO_SIZE
+from link import *
+from loops import TransferLoop
+
+class CallUnit:
+	'''
+	The instructions `start..end-1` expanded from one macro call of the
+	program, run as a unit: entered only at `start`, left at one of
+	`exits`.
+
+	Only the registers the unit tests with `decjz` (`tested`) decide what it
+	does; the ones it only increments (`added`) just grow by an amount that
+	does not depend on their value. So the effect of a call is a function
+	of the tested values: their new values, the amounts added, the exit and
+	the number of steps. That is what a `UnitCache` stores.
+	'''
+	def __init__(self, start : int, end : int, name : str, line : int,
+			tested : List[int], added : List[int], exits : List[int]):
+		self.start = start
+		self.end = end
+		self.name = name
+		self.line = line
+		self.tested = tested
+		self.added = added
+		self.slots = tested + added
+		self.exits = exits
+
+	def __repr__(self) -> str:
+		return f"CallUnit({self.name} pc {self.start}..{self.end - 1}, line {self.line + 1})"
+
+def find_units(program : Program, loops : Dict[int, TransferLoop] = {}) -> Dict[int, CallUnit]:
+	'''
+	The call units of `program` worth memoizing, keyed by start pc: the
+	expansions of top-level macro calls (instructions of one source line
+	with the same outermost macro) that contain a backward branch and are
+	only entered at their first instruction. Units a transfer loop enters
+	or leaves are skipped.
+	'''
+	n = len(program)
+	ops, targets, slots = program.ops, program.targets, program.slots
+
+	ranges = []
+	pc = 0
+	while pc < n:
+		if program.macros[pc] is None:
+			pc += 1
+			continue
+		line, name = program.lines[pc], program.macros[pc].split('>')[0]
+		start = pc
+		while pc < n and program.macros[pc] is not None and program.lines[pc] == line and \
+				program.macros[pc].split('>')[0] == name:
+			pc += 1
+		ranges.append((start, pc, name, line))
+
+	# pcs some jump lands on, with the jump
+	entries : Dict[int, List[int]] = {}
+	for pc in range(n):
+		if ops[pc] == OP_DECJZ:
+			entries.setdefault(targets[pc], []).append(pc)
+
+	units = {}
+	for start, end, name, line in ranges:
+		inside = range(start, end)
+		if any(not source in inside for target in range(start + 1, end) for source in entries.get(target, [])):
+			continue
+		if not any(ops[pc] == OP_DECJZ and start <= targets[pc] <= pc for pc in inside):
+			continue
+		if any((header in inside) != (header + loop.length - 1 in inside) for header, loop in loops.items()):
+			continue
+		tested, added, exits = [], [], set([end])
+		for pc in inside:
+			if ops[pc] == OP_DECJZ:
+				if not slots[pc] in tested:
+					tested.append(slots[pc])
+				if not targets[pc] in inside:
+					exits.add(targets[pc])
+		for pc in inside:
+			if (ops[pc] == OP_INC or ops[pc] == OP_ADD) and not slots[pc] in tested and not slots[pc] in added:
+				added.append(slots[pc])
+		units[start] = CallUnit(start, end, name, line, tested, added, sorted(exits))
+	return units
+
+class Summary:
+	'''
+	The effect of one call of a unit: the tested registers afterwards, the
+	amounts added to the other ones, the slots it touched, the exit pc and
+	the number of steps.
+	'''
+	def __init__(self, tested : Tuple[int, ...], added : List[int], touched : List[int], exit : int, steps : int):
+		self.tested = tested
+		self.added = added
+		self.touched = touched
+		self.exit = exit
+		self.steps = steps
+
+class UnitCache:
+	'''
+	Bounded LRU table of call unit summaries, keyed by the unit and the
+	values of its tested registers, with hit and miss counts.
+	'''
+	def __init__(self, size : int = MEMO_SIZE):
+		if size <= 0:
+			raise Exception("the summary cache size must be positive")
+		self.size = size
+		self.table : 'OrderedDict[Tuple[int, ...], Summary]' = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		# start pc -> [hits, misses, steps skipped]
+		self.per_unit : Dict[int, List[int]] = {}
+
+	def get(self, key : Tuple[int, ...]) -> Optional[Summary]:
+		summary = self.table.get(key)
+		stats = self.per_unit.setdefault(key[0], [0, 0, 0])
+		if summary is None:
+			self.misses += 1
+			stats[1] += 1
+			return None
+		self.table.move_to_end(key)
+		self.hits += 1
+		stats[0] += 1
+		stats[2] += summary.steps
+		return summary
+
+	def put(self, key : Tuple[int, ...], summary : Summary):
+		self.table[key] = summary
+		if len(self.table) > self.size:
+			self.table.popitem(last=False)
+			self.evictions += 1
+
+	def report(self, f, units : Dict[int, CallUnit]):
+		calls = self.hits + self.misses
+		rate = f"{100 * self.hits / calls:.1f}%" if calls > 0 else "-"
+		f.write(f"call units: {len(units)}, calls {calls}, hits {self.hits} ({rate}), misses {self.misses}, "
+			f"evictions {self.evictions}, {len(self.table)}/{self.size} summaries\n")
+		for start, (hits, misses, skipped) in sorted(self.per_unit.items(), key=lambda item: -item[1][2]):
+			unit = units[start]
+			span = f"{unit.start}..{unit.end - 1}"
+			f.write(f"  {unit.name:<12} line {unit.line + 1:>5}  pc {span:>13}  hits {hits:>8}  misses {misses:>8}  "
+				f"steps skipped {skipped}\n")
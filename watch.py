@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+from typing import Any, List, Union, Optional, Tuple, Dict, Callable
+
+from cache import imports_of, resolve_import
+from frontend import Lexer, Parser
+from link import Program, link
+from macro import expander, file_stamp
+from optimize import optimize
+from scan import scan_program
+
+# seconds between two looks at the watched files
+DEFAULT_INTERVAL = 0.05
+
+PHASES = ('parse', 'expand', 'optimize', 'link', 'run')
+
+class Watcher:
+	'''
+	Runs the program at `path` (optimized at -O`level`) whenever it or a
+	macro file it imports, directly or not, changes on disk.
+
+	Only what an edit affects is redone: the program is parsed again only
+	when its own file changed, and the macro expander parses a macro file
+	again only when it changed and flattens the files importing it again
+	from their kept parse. The linked program is handed to `run`; the
+	files parsed and flattened again and the time of every phase are
+	printed to `log` after each run. Errors are reported and watching
+	goes on until interrupted.
+	'''
+	def __init__(self, path : str, level : int, run : Callable[[Program], Any],
+			interval : float = DEFAULT_INTERVAL, log = sys.stderr):
+		self.path = path
+		self.level = level
+		self.run = run
+		self.interval = interval
+		self.log = log
+		# watched file -> its stamp when last read, None if it was missing
+		self.stamps : Dict[str, Optional[Tuple[int, int]]] = {}
+		# the stamp and parse of the program file, reused while it is unchanged
+		self.parsed_stamp = None
+		self.parsed = None
+		self.times : Dict[str, float] = {}
+
+	def watch(self):
+		''' Run the program now and after every change, until interrupted. '''
+		try:
+			self.update(self.current(), None)
+			while True:
+				time.sleep(self.interval)
+				stamps = self.current()
+				if stamps != self.stamps:
+					changed = [file for file in stamps if stamps[file] != self.stamps.get(file)]
+					self.update(stamps, changed)
+		except KeyboardInterrupt:
+			pass
+
+	def current(self) -> Dict[str, Optional[Tuple[int, int]]]:
+		return {file: stamp_of(file) for file in self.stamps or [resolve_import(self.path)]}
+
+	def update(self, stamps : Dict[str, Optional[Tuple[int, int]]], changed : Optional[List[str]]):
+		# stamps are taken before the files are read, so an edit made while
+		# building is seen by the next look
+		self.stamps = stamps
+		if changed is not None:
+			self.log.write(f"rmsim watch: {', '.join(map(self.name, changed))} changed\n")
+		ok = False
+		try:
+			program = self.build()
+			ok = self.timed('run', self.run, program) is not False
+		except (Exception, SystemExit) as e:
+			message = str(e) if isinstance(e, Exception) else ''
+			if message:
+				self.log.write(f"rmsim: {message}\n")
+		finally:
+			files = self.import_graph()
+			self.stamps = {file: stamps[file] if file in stamps else stamp_of(file) for file in files}
+		self.report(ok, changed is None or set(files) != set(stamps))
+
+	def build(self) -> Program:
+		self.times = {}
+		expander.parsed = set()
+		expander.relinked = set()
+		stamp = file_stamp(self.path)
+		if self.parsed is None or stamp != self.parsed_stamp:
+			self.parsed = None
+			if self.level == 0:
+				# plain programs are linked straight from the file
+				with open(self.path, mode='r') as f:
+					program = self.timed('parse', scan_program, f)
+				if program is not None:
+					self.parsed_stamp = stamp
+					return program
+			self.parsed = self.timed('parse', parse_main, self.path)
+			self.parsed_stamp = stamp
+		(regs, labels, instrs), imports = self.parsed
+		# the expander and the optimizer may add to the labels
+		program = self.timed('expand', expander.expand, regs, dict(labels), instrs, imports)
+		program = self.timed('optimize', optimize, *program, self.level)
+		return self.timed('link', link, *program)
+
+	def timed(self, phase : str, f, *args):
+		start = time.perf_counter()
+		try:
+			return f(*args)
+		finally:
+			self.times[phase] = self.times.get(phase, 0) + time.perf_counter() - start
+
+	def import_graph(self) -> List[str]:
+		''' The program file and every file it imports, directly or not, by absolute path. '''
+		files = [resolve_import(self.path)]
+		seen = set(files)
+		for file in files:
+			try:
+				with open(file, mode='r') as f:
+					content = f.read()
+			except (OSError, UnicodeDecodeError):
+				continue
+			for imported in imports_of(content):
+				if not imported in seen:
+					seen.add(imported)
+					files.append(imported)
+		return files
+
+	def name(self, file : str) -> str:
+		return os.path.relpath(file)
+
+	def report(self, ok : bool, moved : bool):
+		parsed = sorted(expander.parsed)
+		relinked = sorted(expander.relinked)
+		if parsed:
+			self.log.write(f"  parsed   {', '.join(map(self.name, parsed))}\n")
+		if relinked:
+			self.log.write(f"  relinked {', '.join(map(self.name, relinked))}\n")
+		times = "  ".join(f"{phase} {1000 * self.times[phase]:.1f} ms" for phase in PHASES if phase in self.times)
+		total = 1000 * sum(self.times.values())
+		self.log.write(f"  {times}  total {total:.1f} ms{'' if ok else ' (failed)'}\n")
+		if moved:
+			self.log.write(f"rmsim watch: watching {len(self.stamps)} file{'s' if len(self.stamps) != 1 else ''}\n")
+		self.log.flush()
+
+def parse_main(path : str):
+	''' The `(regs, labels, instrs)` of the program at `path` and its imports, macro calls unexpanded. '''
+	with open(path, mode='r') as f:
+		parser = Parser(Lexer(f))
+		imports = parser.parse_imports()
+		return parser.parse_input(), imports
+
+def stamp_of(file : str) -> Optional[Tuple[int, int]]:
+	try:
+		return file_stamp(file)
+	except OSError:
+		return None
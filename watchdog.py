@@ -0,0 +1,95 @@
+import time
+from typing import Any, List, Union, Optional, Tuple, Dict
+
+# statuses of a run
+HALTED = 'halted'
+STEP_LIMIT = 'step_limit'
+TIME_LIMIT = 'time_limit'
+REGISTER_LIMIT = 'register_limit'
+CYCLE = 'cycle'
+
+# steps between two checks of a Watchdog
+CHECK_EVERY = 1 << 16
+# steps sampled after a stop to find the pc range the machine is stuck in
+PC_WINDOW = 1 << 12
+
+class Budget:
+	'''
+	Limits of one run, None meaning unlimited: the number of steps, the wall
+	clock seconds, and the magnitude of any register. With `cycles`, runs
+	that provably loop forever are stopped as well.
+	'''
+	def __init__(self, steps : Optional[int] = None, seconds : Optional[float] = None,
+			register : Optional[int] = None, cycles=False):
+		self.steps = steps
+		self.seconds = seconds
+		self.register = register
+		self.cycles = cycles
+
+	def sampled(self) -> bool:
+		''' Whether the run has to be checked while it runs, not only counted. '''
+		return self.seconds is not None or self.register is not None or self.cycles
+
+class Watchdog:
+	'''
+	Checks a run against a `Budget` at sample points, about every
+	CHECK_EVERY steps, so the cost per step is nil.
+
+	Cycles are found with Brent's algorithm over the sampled states (pc and
+	the registers the program mentions): the state at every sample is
+	compared with one saved snapshot, which moves to the current state
+	whenever the number of samples since it was taken reaches the next power
+	of two. The machine is deterministic and the run between two samples
+	depends only on the state, so meeting a state again proves the run never
+	halts; a loop of period p is caught within O(p) samples of entering it.
+	Registers that grow without bound never repeat and are left to the
+	register budget.
+	'''
+	def __init__(self, budget : Budget):
+		self.budget = budget
+		self.deadline = time.monotonic() + budget.seconds if budget.seconds is not None else None
+		self.snapshot = None
+		self.snapshot_hash = 0
+		self.power = 1
+		self.distance = 0
+
+	def check(self, pc : int, steps : int, values) -> Optional[str]:
+		'''
+		The status the run has to stop with, None to go on. `values` are the
+		register values in a fixed order.
+		'''
+		budget = self.budget
+		if budget.steps is not None and steps >= budget.steps:
+			return STEP_LIMIT
+		if self.deadline is not None and time.monotonic() >= self.deadline:
+			return TIME_LIMIT
+		if budget.register is not None and len(values) > 0 and \
+				(max(values) > budget.register or min(values) < -budget.register):
+			return REGISTER_LIMIT
+		if budget.cycles and self.revisited(pc, values):
+			return CYCLE
+		return None
+
+	def revisited(self, pc : int, values) -> bool:
+		state = (pc, tuple(values))
+		h = hash(state)
+		if self.snapshot is not None and h == self.snapshot_hash and state == self.snapshot:
+			return True
+		self.distance += 1
+		if self.snapshot is None or self.distance == self.power:
+			self.snapshot = state
+			self.snapshot_hash = h
+			self.power *= 2
+			self.distance = 0
+		return False
+
+def describe(status : str, steps : int, pcs : Optional[Tuple[int, int]]) -> str:
+	''' One line explaining why a run stopped. '''
+	reasons = {
+		STEP_LIMIT: "step budget exhausted",
+		TIME_LIMIT: "time budget exhausted",
+		REGISTER_LIMIT: "register budget exceeded",
+		CYCLE: "the program loops forever",
+	}
+	where = f" in pc {pcs[0]}..{pcs[1]}" if pcs is not None else ""
+	return f"stopped after {steps} steps{where}: {reasons.get(status, status)}"